@@ -0,0 +1,169 @@
+"""
+A/B comparison of unconstrained vs schema-constrained tool calls (GUIDED_TOOL_CALLS).
+
+Starts two middleware instances against the same upstream, one with
+GUIDED_TOOL_CALLS off and one with it on, and replays the same synthetic Claude
+Code sessions (from load_test.py) through each in turn. For every arm it reports:
+
+    latency / TTFT   client-side p50/p95/p99
+    tool calls       parsed calls, from the middleware's qwen_middleware_tool_parse_total
+    first try        calls parsed by the fast paths (stream / json / native)
+    fallback         calls that needed brace extraction or lenient repair
+    failed           tags found but no call could be extracted (the client sees raw text)
+
+Against fake_vllm.py (the default) the guided arm shows the parse outcomes the
+constraint produces, but its latency says nothing about grammar overhead. Run it
+against a real vLLM (>= 0.8.5, xgrammar backend) with --vllm-api-base to measure
+that. The arms run one after the other, so prefix caching may favour the second.
+Use --reverse to check.
+
+Requires prometheus_client in the middleware environment for the parse columns.
+
+Usage:
+    python bench_guided.py                                            # offline, fake upstream
+    python bench_guided.py --messy-ratio 0.6 --sessions 32
+    python bench_guided.py --vllm-api-base http://127.0.0.1:8001/v1 --sessions 16 --turns 6
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+import httpx
+
+from load_test import (FAKE_VLLM, HERE, MIDDLEWARE, free_port, run_sessions, start_process, stop_process,
+                       summary_ms, wait_ready)
+
+PARSE_METRIC_RE = re.compile(r'^qwen_middleware_tool_parse_total\{([^}]*)\}\s+([0-9.eE+-]+)$', re.MULTILINE)
+LABEL_RE = re.compile(r'(\w+)="([^"]*)"')
+FIRST_TRY_STRATEGIES = {"stream", "json", "native"}
+
+
+def start_middleware(port, vllm_api_base, guided, log_level):
+    env = dict(os.environ, QWEN_MW_GUIDED_TOOL_CALLS=json.dumps(guided))
+    log = open(os.devnull, "w")
+    proc = subprocess.Popen([
+        sys.executable, MIDDLEWARE, "--host", "127.0.0.1", "--port", str(port),
+        "--vllm-api-base", vllm_api_base, "--log-level", log_level,
+    ], stdout=log, stderr=subprocess.STDOUT, cwd=HERE, env=env)
+    proc.log, proc.name = log, f"middleware (guided={guided})"
+    return proc
+
+
+def parse_outcomes(base_url):
+    """Tool-call parse counters by class, or None when /metrics is unavailable."""
+    resp = httpx.get(f"{base_url}/metrics", timeout=10)
+    if resp.status_code != 200:
+        return None
+    counts = {"tool_calls": 0, "first_try": 0, "fallback": 0, "failed": 0}
+    for labels, value in PARSE_METRIC_RE.findall(resp.text):
+        labels = dict(LABEL_RE.findall(labels))
+        n = int(float(value))
+        if labels.get("outcome") != "success":
+            counts["failed"] += n
+            continue
+        counts["tool_calls"] += n
+        counts["first_try" if labels.get("strategy") in FIRST_TRY_STRATEGIES else "fallback"] += n
+    return counts
+
+
+async def run_arm(base_url, args):
+    started = time.perf_counter()
+    samples = await run_sessions(f"{base_url}/v1/messages", args.sessions, args.turns, args)
+    return samples, time.perf_counter() - started
+
+
+def build_arm_report(samples, elapsed, outcomes):
+    ok = [s for s in samples if s["status"] == 200]
+    report = {
+        "requests": len(samples),
+        "ok": len(ok),
+        "duration_s": round(elapsed, 3),
+        "latency_ms": summary_ms([s["latency"] for s in ok]),
+        "ttft_ms": summary_ms([s["ttft"] for s in ok if s["ttft"] is not None]),
+        "parse": outcomes,
+    }
+    if outcomes:
+        attempted = outcomes["tool_calls"] + outcomes["failed"]
+        report["fallback_or_failed_rate"] = round((outcomes["fallback"] + outcomes["failed"]) / attempted, 4) if attempted else 0.0
+    return report
+
+
+def print_reports(reports):
+    arms = list(reports)
+    print(f"{'':<26}" + "".join(f"{arm:>16}" for arm in arms))
+
+    def row(label, values):
+        print(f"{label:<26}" + "".join(f"{v:>16}" for v in values))
+
+    row("requests ok", [f"{r['ok']}/{r['requests']}" for r in reports.values()])
+    for q in ("p50", "p95", "p99"):
+        row(f"latency {q} (ms)", [r["latency_ms"][q] if r["latency_ms"][q] is not None else "n/a" for r in reports.values()])
+    row("TTFT p50 (ms)", [r["ttft_ms"]["p50"] if r["ttft_ms"]["p50"] is not None else "n/a" for r in reports.values()])
+    if all(r["parse"] for r in reports.values()):
+        for key in ("tool_calls", "first_try", "fallback", "failed"):
+            row(key.replace("_", " "), [r["parse"][key] for r in reports.values()])
+        row("fallback + failed rate", [f"{r['fallback_or_failed_rate']:.2%}" for r in reports.values()])
+    else:
+        print("\n(parse outcomes unavailable: install prometheus_client for the middleware's /metrics)")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--vllm-api-base", help="real vLLM to test against (default: start fake_vllm.py)")
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--sessions", type=int, default=32)
+    ap.add_argument("--turns", type=int, default=6)
+    ap.add_argument("--stream-ratio", type=float, default=1.0)
+    ap.add_argument("--result-kb", type=int, default=4)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--timeout", type=float, default=600.0)
+    ap.add_argument("--reverse", action="store_true", help="run the guided arm first")
+    ap.add_argument("--log-level", default="WARNING")
+    ap.add_argument("--json", help="also write the report to this file")
+    group = ap.add_argument_group("fake upstream (only when it is started by this script)")
+    group.add_argument("--ttft", type=float, default=0.05)
+    group.add_argument("--tpot", type=float, default=0.0)
+    group.add_argument("--tool-ratio", type=float, default=0.9)
+    group.add_argument("--messy-ratio", type=float, default=0.3)
+    args = ap.parse_args()
+
+    procs = []
+    reports = {}
+    try:
+        vllm_api_base = args.vllm_api_base
+        if vllm_api_base is None:
+            port = free_port()
+            procs.append(start_process([
+                sys.executable, FAKE_VLLM, "--port", str(port), "--ttft", str(args.ttft), "--tpot", str(args.tpot),
+                "--tool-ratio", str(args.tool_ratio), "--messy-ratio", str(args.messy_ratio), "--seed", str(args.seed),
+            ], "fake_vllm.py"))
+            wait_ready(f"http://127.0.0.1:{port}/health", procs[-1])
+            vllm_api_base = f"http://127.0.0.1:{port}/v1"
+
+        arms = [("unconstrained", False), ("guided", True)]
+        for name, guided in reversed(arms) if args.reverse else arms:
+            port = free_port()
+            proc = start_middleware(port, vllm_api_base, guided, args.log_level)
+            procs.append(proc)
+            base_url = f"http://127.0.0.1:{port}"
+            wait_ready(f"{base_url}/upstream/stats", proc)
+            samples, elapsed = asyncio.run(run_arm(base_url, args))
+            reports[name] = build_arm_report(samples, elapsed, parse_outcomes(base_url))
+            stop_process(procs.pop())
+    finally:
+        for proc in reversed(procs):
+            stop_process(proc)
+
+    print_reports(reports)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"arms": reports, "config": {k: v for k, v in vars(args).items() if k != "json"}}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Benchmark for the JSON path of a non-streaming request in middleware_fix_qwen.py.
+
+Builds a Claude request with a long agentic history (Read tool_use / tool_result
+turns) and a vLLM response carrying a large Write call, then measures the CPU
+time per request spent in each step:
+
+    request decode -> upstream encode -> upstream decode -> parse + convert -> response encode
+
+Three pipelines are compared:
+    legacy   the previous code path: stdlib json everywhere, tool arguments
+             dumped to a string by parse_hermes_xml and loaded back during conversion
+    stdlib   the current code path with orjson disabled (the fallback)
+    orjson   the current code path with orjson (skipped if not installed)
+
+Every pipeline must produce the same Claude response; the benchmark fails otherwise.
+
+Usage:
+    python bench_json.py                                # 200 turns, 8 KB results, 32 KB Write
+    python bench_json.py --turns 500 --result-kb 32     # longer history
+"""
+import argparse
+import json
+import logging
+import time
+
+from fastapi.responses import JSONResponse
+
+import middleware_fix_qwen as mw
+
+STEPS = ["request_decode", "upstream_encode", "upstream_decode", "parse_convert", "response_encode"]
+
+TOOLS = [
+    {"name": "Read", "description": "Read a file from disk.", "input_schema": {
+        "type": "object", "properties": {"file_path": {"type": "string"}, "offset": {"type": "integer"}},
+        "required": ["file_path"]}},
+    {"name": "Write", "description": "Write a file to disk.", "input_schema": {
+        "type": "object", "properties": {"file_path": {"type": "string"}, "content": {"type": "string"}},
+        "required": ["file_path", "content"]}},
+    {"name": "Bash", "description": "Run a shell command.", "input_schema": {
+        "type": "object", "properties": {"command": {"type": "string"}}, "required": ["command"]}},
+]
+
+
+def source_text(size_kb, seed):
+    """Code-like text with non-ASCII comments, the typical tool_result payload."""
+    line = f"    value_{seed} = compute(data, mode=\"fast\")  # 计算结果并缓存 {{cache}}\n"
+    return line * (size_kb * 1024 // len(line.encode("utf-8")) + 1)
+
+
+def build_claude_request(turns, result_kb):
+    messages = [{"role": "user", "content": "请阅读项目中的模块并修复缓存相关的问题。"}]
+    for i in range(turns):
+        messages.append({"role": "assistant", "content": [
+            {"type": "text", "text": f"先看一下第 {i} 个模块。"},
+            {"type": "tool_use", "id": f"toolu_{i:04d}", "name": "Read", "input": {"file_path": f"/src/module_{i}.py"}},
+        ]})
+        messages.append({"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": f"toolu_{i:04d}", "content": source_text(result_kb, i)},
+        ]})
+    return {"model": "claude-sonnet", "max_tokens": 8192, "tools": TOOLS, "messages": messages}
+
+
+def build_upstream_response(write_kb):
+    call = {"name": "Write", "arguments": {"file_path": "/src/cache.py", "content": source_text(write_kb, "fix")}}
+    content = f"修复如下:\n<tool_call>\n{json.dumps(call, ensure_ascii=False)}\n</tool_call>"
+    return {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 60000, "completion_tokens": 9000, "total_tokens": 69000},
+    }
+
+
+def parse_and_convert(openai_result, legacy):
+    message = openai_result["choices"][0]["message"]
+    tool_calls = mw.parse_hermes_xml(message["content"])
+    if legacy:
+        # previous behaviour: arguments serialized to a JSON string, loaded back in conversion
+        for call in tool_calls:
+            call["function"]["arguments"] = json.dumps(call["function"]["arguments"])
+    message["tool_calls"] = tool_calls
+    return mw.convert_openai_response_to_claude(openai_result)
+
+
+def run_pipeline(mode, body_bytes, openai_req, upstream_bytes, timings):
+    legacy = mode == "legacy"
+    clock = time.process_time
+
+    t0 = clock()
+    body = json.loads(body_bytes) if legacy else mw.json_loads(body_bytes)
+    t1 = clock()
+    if legacy:
+        # what httpx does for json=...
+        upstream_body = json.dumps(openai_req, ensure_ascii=False, separators=(",", ":"), allow_nan=False).encode("utf-8")
+    else:
+        upstream_body = mw.json_dumps(openai_req)
+    t2 = clock()
+    openai_result = json.loads(upstream_bytes) if legacy else mw.json_loads(upstream_bytes)
+    t3 = clock()
+    claude_response = parse_and_convert(openai_result, legacy)
+    t4 = clock()
+    response = JSONResponse(claude_response) if legacy else mw.FastJSONResponse(claude_response)
+    t5 = clock()
+
+    for step, elapsed in zip(STEPS, (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4)):
+        timings[step] += elapsed
+    assert body and upstream_body
+    return response.body
+
+
+def normalized(response_body):
+    resp = json.loads(response_body)
+    for block in resp["content"]:
+        block.pop("id", None)  # tool call ids are random
+    return resp
+
+
+def bench(mode, body_bytes, openai_req, upstream_bytes, min_seconds):
+    saved_orjson = mw.orjson
+    if mode != "orjson":
+        mw.orjson = None
+    try:
+        timings = dict.fromkeys(STEPS, 0.0)
+        runs = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < min_seconds or runs < 3:
+            output = run_pipeline(mode, body_bytes, openai_req, upstream_bytes, timings)
+            runs += 1
+    finally:
+        mw.orjson = saved_orjson
+    return {step: total / runs for step, total in timings.items()}, output
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--turns", type=int, default=200, help="tool_use/tool_result rounds in the history")
+    ap.add_argument("--result-kb", type=int, default=8, help="size of each tool_result")
+    ap.add_argument("--write-kb", type=int, default=32, help="size of the Write call in the model output")
+    ap.add_argument("--min-seconds", type=float, default=1.0, help="minimum timing window per pipeline")
+    args = ap.parse_args()
+    # parse_hermes_xml and the converters log diagnostics; keep them out of the report
+    mw.logger.setLevel(logging.ERROR)
+
+    claude_req = build_claude_request(args.turns, args.result_kb)
+    body_bytes = json.dumps(claude_req, ensure_ascii=False).encode("utf-8")
+    openai_req, _ = mw.build_openai_request(claude_req)
+    upstream_bytes = json.dumps(build_upstream_response(args.write_kb), ensure_ascii=False).encode("utf-8")
+    print(f"request {len(body_bytes) / 1024:.0f} KB ({len(claude_req['messages'])} messages), "
+          f"upstream body {len(mw.json_dumps(openai_req)) / 1024:.0f} KB, "
+          f"upstream response {len(upstream_bytes) / 1024:.0f} KB\n")
+
+    modes = ["legacy", "stdlib"] + (["orjson"] if mw.orjson is not None else [])
+    results = {}
+    reference = None
+    mismatches = 0
+    for mode in modes:
+        results[mode], output = bench(mode, body_bytes, openai_req, upstream_bytes, args.min_seconds)
+        if reference is None:
+            reference = normalized(output)
+        elif normalized(output) != reference:
+            mismatches += 1
+            print(f"MISMATCH: {mode} produced a different Claude response")
+
+    print(f"{'step (ms CPU/request)':<24}" + "".join(f"{mode:>10}" for mode in modes))
+    for step in STEPS + ["total"]:
+        row = [sum(r.values()) if step == "total" else r[step] for r in results.values()]
+        print(f"{step:<24}" + "".join(f"{v * 1e3:>10.2f}" for v in row))
+
+    legacy_total = sum(results["legacy"].values())
+    for mode in modes[1:]:
+        total = sum(results[mode].values())
+        print(f"\n{mode}: {(legacy_total - total) * 1e3:.2f} ms CPU saved per request "
+              f"({legacy_total / total:.1f}x faster than legacy)", end="")
+    print()
+    if mw.orjson is None:
+        print("\norjson is not installed (pip install orjson); only the stdlib fallback was measured")
+    raise SystemExit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
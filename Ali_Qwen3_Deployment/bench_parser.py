@@ -0,0 +1,91 @@
+"""
+Microbenchmark for the tool-call extractor in middleware_fix_qwen.py.
+
+Runs the production parse_hermes_xml over tool_call_corpus.jsonl (outputs in the
+shapes Qwen actually produces) plus synthetic large Write payloads, checks every
+result against the expected tool calls, and reports the time per call.
+
+Usage:
+    python bench_parser.py                 # corpus + 100 KB Write payloads
+    python bench_parser.py --size-kb 500   # larger payloads
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+from middleware_fix_qwen import logger, parse_hermes_xml
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tool_call_corpus.jsonl")
+
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def large_write_cases(size_kb):
+    """Large Write calls in the clean shape and in the shapes that need fallbacks."""
+    line = "    result = compute(value, options={'mode': \"fast\"})  # {braces} in code\n"
+    content = line * (size_kb * 1024 // len(line))
+    args = {"file_path": "/app/generated.py", "content": content}
+    expect = [["Write", args]]
+    clean = json.dumps({"name": "Write", "arguments": args})
+    raw_newlines = clean.replace("\\n", "\n")
+    return [
+        {"id": f"write_{size_kb}kb_clean", "content": f"<tool_call>\n{clean}\n</tool_call>", "expect": expect},
+        {"id": f"write_{size_kb}kb_chatter", "content": f"<tool_call>\nSure:\n{clean}\nDone.\n</tool_call>", "expect": expect},
+        {"id": f"write_{size_kb}kb_raw_newlines", "content": f"<tool_call>\n{raw_newlines}\n</tool_call>", "expect": expect},
+        {"id": f"write_{size_kb}kb_unclosed", "content": f"<tool_call>\n{clean[:-2]}", "expect": expect},
+    ]
+
+
+def run_parser(content):
+    return parse_hermes_xml(content)
+
+
+def summarize(tool_calls):
+    return [[c["function"]["name"], c["function"]["arguments"]] for c in tool_calls]
+
+
+def time_case(content, min_seconds):
+    runs = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_seconds or runs < 3:
+        run_parser(content)
+        runs += 1
+        elapsed = time.perf_counter() - start
+    return elapsed / runs
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--size-kb", type=int, default=100, help="size of the synthetic Write payloads")
+    ap.add_argument("--min-seconds", type=float, default=0.2, help="minimum timing window per case")
+    args = ap.parse_args()
+    # parse_hermes_xml logs diagnostics; keep them out of the report
+    logger.setLevel(logging.ERROR)
+
+    cases = load_corpus() + large_write_cases(args.size_kb)
+    failures = 0
+    total = 0.0
+    print(f"{'case':<32} {'size':>9} {'us/call':>10}  result")
+    for case in cases:
+        got = summarize(run_parser(case["content"]))
+        ok = got == case["expect"]
+        failures += not ok
+        per_call = time_case(case["content"], args.min_seconds)
+        total += per_call
+        print(f"{case['id']:<32} {len(case['content']):>9} {per_call * 1e6:>10.1f}  {'ok' if ok else 'MISMATCH'}")
+        if not ok:
+            print(f"    expected: {json.dumps(case['expect'], ensure_ascii=False)[:200]}")
+            print(f"    got:      {json.dumps(got, ensure_ascii=False)[:200]}")
+
+    print(f"\n{len(cases)} cases, {failures} mismatches, {total * 1e3:.2f} ms total per corpus pass")
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Report the prompt tokens saved by tool-definition compaction (TOOL_COMPACT_* settings).
+
+Renders the tool prompt that middleware_fix_qwen.py injects, once with the full
+definitions and once compacted. It prints the tokens per tool and the tokens
+saved per request, and checks that the compacted prompt is byte-identical across
+repeated builds, which prefix caching relies on.
+
+Tools come from one of:
+    (default)        the Claude Code tool set used by load_test.py
+    --tools FILE     a JSON list of Claude tools, or a Claude request body with "tools"
+    --capture FILE   requests recorded with CAPTURE_PATH. Savings are reported per
+                     request, which is what --drop-unused needs since it depends on
+                     each session's history.
+
+Tokens are counted the way the middleware counts them: with the Qwen tokenizer when
+transformers and the model files are available, otherwise with its character estimate.
+
+Usage:
+    python bench_tool_compaction.py
+    python bench_tool_compaction.py --description-max-chars 400 --param-description-max-chars 0
+    python bench_tool_compaction.py --capture captures/traffic.jsonl.gz --drop-unused
+"""
+import argparse
+import json
+import logging
+import statistics
+
+import middleware_fix_qwen as mw
+
+
+def claude_tools_to_raw(tools):
+    """Claude tool definitions -> the {name, description, parameters} form the middleware renders."""
+    return [{"name": t["name"], "description": t.get("description", ""), "parameters": t.get("input_schema", {})}
+            for t in tools]
+
+
+def load_requests(args):
+    if args.capture:
+        from replay_capture import iter_capture
+
+        return [r["request"] for r in iter_capture(args.capture) if r["request"].get("tools")]
+    if args.tools:
+        with open(args.tools, encoding="utf-8") as f:
+            data = json.load(f)
+        tools = data["tools"] if isinstance(data, dict) else data
+    else:
+        from load_test import CLAUDE_CODE_TOOLS as tools
+    return [{"tools": tools, "messages": [{"role": "user", "content": "hi"}]}]
+
+
+def per_tool_report(raw_tools, body):
+    compacted = {t["name"]: t for t in mw.prompt_tool_definitions(raw_tools, body)}
+    print(f"{'tool':<28}{'full':>10}{'compacted':>12}{'saved':>10}")
+    for tool in raw_tools:
+        full = mw.tool_definition_tokens([tool])
+        small = mw.tool_definition_tokens([compacted[tool["name"]]]) if tool["name"] in compacted else 0
+        note = "" if tool["name"] in compacted else "  (dropped)"
+        print(f"{tool['name'][:27]:<28}{full:>10}{small:>12}{full - small:>10}{note}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = ap.add_mutually_exclusive_group()
+    source.add_argument("--tools", help="JSON file with Claude tool definitions")
+    source.add_argument("--capture", nargs="+", help="capture files recorded by the middleware")
+    ap.add_argument("--description-max-chars", type=int, default=mw.TOOL_DESCRIPTION_MAX_CHARS)
+    ap.add_argument("--param-description-max-chars", type=int, default=mw.TOOL_PARAM_DESCRIPTION_MAX_CHARS)
+    ap.add_argument("--drop-unused", action="store_true", help="also leave out tools never used in the session")
+    ap.add_argument("--keep-tools", nargs="*", default=mw.TOOL_COMPACT_KEEP_TOOLS,
+                    help="tools always kept with --drop-unused (wildcards allowed)")
+    args = ap.parse_args()
+    mw.logger.setLevel(logging.ERROR)
+
+    mw.TOOL_COMPACT_ENABLED = True
+    mw.TOOL_DESCRIPTION_MAX_CHARS = args.description_max_chars
+    mw.TOOL_PARAM_DESCRIPTION_MAX_CHARS = args.param_description_max_chars
+    mw.TOOL_COMPACT_DROP_UNUSED = args.drop_unused
+    mw.TOOL_COMPACT_KEEP_TOOLS = args.keep_tools
+
+    requests = load_requests(args)
+    if not requests:
+        raise SystemExit("no requests with tools found")
+    tokenizer = "Qwen tokenizer" if mw.get_tokenizer() is not None else "character estimate (transformers not available)"
+    print(f"token counts: {tokenizer}\n")
+
+    first = requests[0]
+    raw_tools = claude_tools_to_raw(first["tools"])
+    per_tool_report(raw_tools, first)
+
+    saved, full_tokens, unstable = [], [], 0
+    for body in requests:
+        raw_tools = claude_tools_to_raw(body["tools"])
+        prompt = mw.render_tool_system_prompt(mw.prompt_tool_definitions(raw_tools, body))
+        mw.tool_compaction_cache.data.clear()
+        if mw.render_tool_system_prompt(mw.prompt_tool_definitions(claude_tools_to_raw(body["tools"]), body)) != prompt:
+            unstable += 1
+        full = mw.tool_definition_tokens(raw_tools)
+        full_tokens.append(full)
+        saved.append(full - mw.tool_definition_tokens(mw.prompt_tool_definitions(raw_tools, body)))
+
+    print(f"\nrequests                {len(requests)}")
+    print(f"tool prompt tokens      {statistics.mean(full_tokens):.0f} per request before compaction")
+    print(f"tokens saved            {statistics.mean(saved):.0f} per request on average "
+          f"(min {min(saved)}, max {max(saved)}, {statistics.mean(saved) / statistics.mean(full_tokens):.0%})")
+    print(f"deterministic output    {'yes' if not unstable else f'NO ({unstable} requests differ between builds)'}")
+    raise SystemExit(1 if unstable else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""
+Offline stand-in for a vLLM OpenAI-compatible server, for load-testing the middleware.
+
+Serves /v1/chat/completions (streaming and non-streaming), /v1/models and /health.
+Each completion waits --ttft seconds before the first token and --tpot seconds per
+output token, then answers with a canned output: plain text, a clean <tool_call>, or
+one of the messy Qwen variants from tool_call_corpus.jsonl (single quotes, code
+fences, trailing commas, truncated calls, ...). Stop strings in the request are
+honoured the way vLLM does, so the middleware sees the same truncated tags.
+
+The output is chosen from a hash of the request body, so replaying the same
+sessions gives the same responses. The service time of every request is recorded
+under its X-Request-Id header (the middleware forwards it) and returned by
+GET /fake/timings, which lets load_test.py report the latency the middleware adds.
+
+Requests that carry OpenAI `tools` (the middleware's TOOL_CALL_MODE = "native") are
+answered the way vLLM with --enable-auto-tool-choice --tool-call-parser hermes does:
+calls that parse as JSON come back as structured tool_calls, the rest as plain text.
+With --no-tool-parser such requests get the 400 a vLLM without those flags returns.
+
+Requests with a structural_tag response_format (GUIDED_TOOL_CALLS) get what constrained
+decoding would produce: once the model writes the trigger <tool_call>, the call itself
+is well-formed, so the messy corpus variants that start with that tag come out clean.
+With --no-structural-tag such requests get a 400, like a vLLM without that support.
+
+With --capture, the server instead answers with the vLLM outputs recorded by the
+middleware (CAPTURE_PATH), chunk boundaries and native-mode tool calls included. Each output is looked up by the
+X-Request-Id that replay_capture.py --backend sends.
+
+Usage:
+    python fake_vllm.py --port 8001
+    python fake_vllm.py --port 8001 --ttft 0.2 --tpot 0.02 --tool-ratio 0.8 --messy-ratio 0.3
+    python fake_vllm.py --port 8001 --capture captures/traffic.jsonl.gz
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import zlib
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tool_call_corpus.jsonl")
+CHARS_PER_TOKEN = 4
+MAX_TIMINGS = 100_000
+TOOL_CALL_RE = re.compile(r"<tool_call>\s*(.*?)\s*</tool_call>", re.DOTALL)
+NO_TOOL_PARSER_ERROR = '"auto" tool choice requires --enable-auto-tool-choice and --tool-call-parser to be set'
+NO_STRUCTURAL_TAG_ERROR = "1 validation error for ChatCompletionRequest\nresponse_format.type\n  Input should be 'text', 'json_object' or 'json_schema'"
+
+TEXT_OUTPUTS = [
+    "The change is in place. The cache now invalidates entries when the config file changes, "
+    "and the existing tests cover the reload path.",
+    "I found the issue: the retry loop never resets its backoff counter after a successful call. "
+    "Resetting it in the success branch fixes the slowdown you saw.",
+    "All tests pass. Summary of the changes:\n\n- moved parsing into `parse_config`\n"
+    "- added a regression test for empty files\n- removed the unused `legacy_mode` flag",
+]
+
+
+def clean_tool_outputs():
+    """Well-formed calls in the shape Qwen produces most of the time."""
+    write_body = "def handler(event):\n    return {\"status\": \"ok\", \"items\": event.get(\"items\", [])}\n" * 20
+    calls = [
+        ("Let me look at the file first.", {"name": "Read", "arguments": {"file_path": "/app/src/service.py"}}),
+        ("Running the tests.", {"name": "Bash", "arguments": {"command": "python -m pytest -q tests/"}}),
+        ("Searching for usages.", {"name": "Grep", "arguments": {"pattern": "load_config\\(", "path": "/app"}}),
+        ("Finding the modules.", {"name": "Glob", "arguments": {"pattern": "src/**/*.py"}}),
+        ("Writing the fix.", {"name": "Write", "arguments": {"file_path": "/app/src/handler.py", "content": write_body}}),
+        ("Updating the call site.", {"name": "Edit", "arguments": {
+            "file_path": "/app/src/service.py", "old_string": "retries = 0", "new_string": "retries = 3"}}),
+    ]
+    return [f"{text}\n<tool_call>\n{json.dumps(call)}\n</tool_call>" for text, call in calls]
+
+
+def messy_tool_outputs(path=CORPUS_PATH):
+    with open(path, encoding="utf-8") as f:
+        return [case for case in map(json.loads, filter(str.strip, f)) if case["expect"]]
+
+
+def guided_output(case):
+    """A corpus case as structural_tag decoding would emit it: free text up to the trigger, then clean calls."""
+    content = case["content"]
+    start = content.find("<tool_call>")
+    if start == -1:
+        return content  # the trigger never appears, so the constraint never engages
+    return content[:start] + "".join(
+        f'<tool_call>\n{{"name": {json.dumps(name)}, "arguments": {json.dumps(arguments)}}}\n</tool_call>'
+        for name, arguments in case["expect"])
+
+
+def apply_stop(text, stop):
+    """Cut at the first stop string, excluding it (vLLM semantics)."""
+    if isinstance(stop, str):
+        stop = [stop]
+    cut = len(text)
+    for s in stop or []:
+        pos = text.find(s)
+        if pos != -1:
+            cut = min(cut, pos)
+    return text[:cut], cut < len(text)
+
+
+def extract_tool_calls(text):
+    """Split an output into (content, tool_calls) like vLLM's hermes tool parser; unparseable calls stay text."""
+    calls = []
+    for match in TOOL_CALL_RE.finditer(text):
+        try:
+            call = json.loads(match.group(1))
+            calls.append({"id": f"chatcmpl-tool-{os.urandom(8).hex()}", "type": "function",
+                          "function": {"name": call["name"], "arguments": json.dumps(call.get("arguments", {}))}})
+        except (ValueError, KeyError, TypeError):
+            return text, []
+    if not calls:
+        return text, []
+    return text[:text.find("<tool_call>")].strip(), calls
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def create_app(args):
+    app = FastAPI()
+    clean = clean_tool_outputs()
+    messy = messy_tool_outputs()
+    timings = {}
+    recorded = None
+    if args.capture:
+        from replay_capture import iter_capture, replay_request_id
+        recorded = {replay_request_id(i): r["upstream"] for i, r in enumerate(iter_capture(args.capture))}
+
+    def pick_output(raw, has_tools, guided):
+        rng = random.Random(zlib.crc32(raw) ^ args.seed)
+        if not has_tools or rng.random() >= args.tool_ratio:
+            return rng.choice(TEXT_OUTPUTS)
+        if rng.random() < args.messy_ratio:
+            case = rng.choice(messy)
+            return guided_output(case) if guided else case["content"]
+        return rng.choice(clean)
+
+    def record(request_id, started, first_token):
+        if request_id is None:
+            return
+        if len(timings) >= MAX_TIMINGS:
+            timings.pop(next(iter(timings)))
+        now = time.monotonic()
+        timings[request_id] = {"service": now - started, "ttft": (first_token or now) - started}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        started = time.monotonic()
+        raw = await request.body()
+        body = json.loads(raw)
+        request_id = request.headers.get("x-request-id")
+        # prompt mode drives tools through a <tools> system prompt, native mode sends OpenAI tools
+        native = bool(body.get("tools"))
+        has_tools = native or any("<tools>" in (m.get("content") or "") for m in body.get("messages", []) if m["role"] == "system")
+        guided = (body.get("response_format") or {}).get("type") == "structural_tag"
+        tool_calls = []
+        if native and args.no_tool_parser:
+            return JSONResponse({"object": "error", "message": NO_TOOL_PARSER_ERROR, "type": "BadRequestError", "code": 400},
+                                status_code=400)
+        if guided and args.no_structural_tag:
+            return JSONResponse({"object": "error", "message": NO_STRUCTURAL_TAG_ERROR, "type": "BadRequestError", "code": 400},
+                                status_code=400)
+        if recorded is not None:
+            upstream = recorded.get(request_id)
+            if upstream is None:
+                return JSONResponse({"error": f"no recorded output for request id {request_id!r}"}, status_code=404)
+            chunks, finish_reason, usage = upstream["chunks"], upstream.get("finish_reason") or "stop", upstream.get("usage")
+            text = "".join(chunks)
+            tool_calls = upstream.get("tool_calls") or []  # native-mode records
+        else:
+            text, _ = apply_stop(pick_output(raw, has_tools, guided), body.get("stop"))
+            finish_reason, usage = "stop", None
+            if native:
+                content, tool_calls = extract_tool_calls(text)
+                if tool_calls:
+                    text, finish_reason = content, "tool_calls"
+            chunks = [text[i:i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+        if not usage:
+            prompt_tokens = estimate_tokens(json.dumps(body.get("messages", []), ensure_ascii=False))
+            completion_tokens = estimate_tokens(text + "".join(c["function"]["arguments"] for c in tool_calls))
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                     "total_tokens": prompt_tokens + completion_tokens}
+        completion_id = f"chatcmpl-{os.urandom(8).hex()}"
+
+        if not body.get("stream"):
+            await asyncio.sleep(args.ttft + args.tpot * len(chunks))
+            record(request_id, started, None)
+            message = {"role": "assistant", "content": (text or None) if tool_calls else text}
+            if tool_calls:
+                message["tool_calls"] = tool_calls
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": usage,
+            })
+
+        def sse(delta, finish_reason=None, **extra):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "model": body.get("model"),
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}], **extra}
+            return f"data: {json.dumps(chunk)}\n\n"
+
+        async def generate():
+            await asyncio.sleep(args.ttft)
+            first_token = time.monotonic()
+            yield sse({"role": "assistant", "content": ""})
+            for piece in chunks:
+                if args.tpot:
+                    await asyncio.sleep(args.tpot)
+                yield sse({"content": piece})
+            for index, call in enumerate(tool_calls):
+                # name first, then the arguments in token-sized pieces, as vLLM streams them
+                yield sse({"tool_calls": [{"index": index, "id": call["id"], "type": "function",
+                                           "function": {"name": call["function"]["name"], "arguments": ""}}]})
+                arguments = call["function"]["arguments"]
+                for i in range(0, len(arguments), CHARS_PER_TOKEN):
+                    if args.tpot:
+                        await asyncio.sleep(args.tpot)
+                    yield sse({"tool_calls": [{"index": index, "function": {"arguments": arguments[i:i + CHARS_PER_TOKEN]}}]})
+            yield sse({}, finish_reason)
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield f"data: {json.dumps({'id': completion_id, 'choices': [], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+            record(request_id, started, first_token)
+
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    @app.get("/fake/timings")
+    async def fake_timings():
+        """Return and clear the recorded service times, keyed by X-Request-Id."""
+        result = dict(timings)
+        timings.clear()
+        return result
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": args.model, "object": "model"}]}
+
+    @app.get("/health")
+    async def health():
+        return {}
+
+    return app
+
+
+def build_arg_parser():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8001)
+    ap.add_argument("--ttft", type=float, default=0.05, help="seconds before the first token")
+    ap.add_argument("--tpot", type=float, default=0.0, help="seconds per output token (4 chars)")
+    ap.add_argument("--tool-ratio", type=float, default=0.7, help="share of tool-enabled requests answered with a tool call")
+    ap.add_argument("--messy-ratio", type=float, default=0.3, help="share of tool calls taken from the messy corpus")
+    ap.add_argument("--seed", type=int, default=0, help="changes which canned output each request gets")
+    ap.add_argument("--model", default="Qwen/Qwen3-235B-A22B-Instruct")
+    ap.add_argument("--no-tool-parser", action="store_true",
+                    help="reject requests with OpenAI tools, like vLLM started without --enable-auto-tool-choice")
+    ap.add_argument("--no-structural-tag", action="store_true",
+                    help="reject structural_tag response formats, like a vLLM without structured output support")
+    ap.add_argument("--capture", nargs="+", help="serve the outputs recorded in these capture files (see replay_capture.py)")
+    return ap
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
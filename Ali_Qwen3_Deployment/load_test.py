@@ -0,0 +1,414 @@
+"""
+Load test for middleware_fix_qwen.py: latency added by the middleware, throughput and CPU cost.
+
+Replays synthetic Claude Code sessions against the middleware at a fixed concurrency.
+Each session carries the Claude Code system prompt and tool set. It grows its history
+turn by turn with the assistant's replies and tool_result blocks, exactly as the
+client does. By default the script starts fake_vllm.py and the middleware on free
+local ports, so it runs offline on a laptop.
+
+Reported per run:
+    added latency   client latency minus the fake upstream's own service time (p50/p95/p99)
+    added TTFT      client time-to-first-token minus the upstream's, streaming requests only
+    throughput      completed requests per second
+    CPU/request     middleware process CPU time per request (from GET /upstream/stats)
+
+The exit status is non-zero when a --max-* threshold is exceeded, so a change can be
+gated on it.
+
+Usage:
+    python load_test.py                                        # 16 concurrent sessions, 64 sessions x 8 turns
+    python load_test.py --concurrency 64 --stream-ratio 0.5 --tpot 0.005
+    python load_test.py --json report.json --max-p99-ms 50 --max-cpu-ms 20
+    python load_test.py --url http://127.0.0.1:8000 --fake-url http://127.0.0.1:8001   # already running
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MIDDLEWARE = os.path.join(HERE, "middleware_fix_qwen.py")
+FAKE_VLLM = os.path.join(HERE, "fake_vllm.py")
+
+SYSTEM_PROMPT = "\n\n".join([
+    "You are an interactive CLI tool that helps users with software engineering tasks. "
+    "Use the instructions below and the tools available to you to assist the user.",
+    "# Tone and style\nYou should be concise, direct, and to the point. Your output will be displayed "
+    "on a command line interface. Only use tools to complete tasks, never to communicate with the user.",
+    "# Following conventions\nWhen making changes to files, first understand the file's code conventions. "
+    "Mimic code style, use existing libraries and utilities, and follow existing patterns. "
+    "Never assume that a given library is available, even if it is well known.",
+    "# Doing tasks\nUse the available search tools to understand the codebase and the user's query. "
+    "Implement the solution using all tools available to you. Verify the solution if possible with tests. "
+    "When you have completed a task, run the lint and typecheck commands if they were provided.",
+    "# Tool usage policy\nWhen doing file search, prefer to use the Grep and Glob tools. "
+    "You have the capability to call multiple tools in a single response. "
+    "When multiple independent pieces of information are requested, batch your tool calls together.",
+] * 3)
+
+
+def tool(name, description, properties, required):
+    return {"name": name, "description": description, "input_schema": {
+        "type": "object", "properties": properties, "required": required, "additionalProperties": False,
+        "$schema": "http://json-schema.org/draft-07/schema#"}}
+
+
+STR = {"type": "string"}
+CLAUDE_CODE_TOOLS = [
+    tool("Bash", "Executes a given bash command in a persistent shell session with optional timeout, "
+         "ensuring proper handling and security measures. " * 4,
+         {"command": {**STR, "description": "The command to execute"},
+          "timeout": {"type": "number", "description": "Optional timeout in milliseconds (max 600000)"},
+          "description": {**STR, "description": "Clear, concise description of what this command does in 5-10 words"}},
+         ["command"]),
+    tool("Glob", "Fast file pattern matching tool that works with any codebase size. "
+         "Supports glob patterns like \"**/*.js\". Returns matching file paths sorted by modification time. " * 2,
+         {"pattern": {**STR, "description": "The glob pattern to match files against"},
+          "path": {**STR, "description": "The directory to search in"}},
+         ["pattern"]),
+    tool("Grep", "A powerful search tool built on ripgrep. Supports full regex syntax. "
+         "Filter files with glob parameter or type parameter. " * 3,
+         {"pattern": {**STR, "description": "The regular expression pattern to search for"},
+          "path": {**STR, "description": "File or directory to search in"},
+          "glob": {**STR, "description": "Glob pattern to filter files"},
+          "output_mode": {"type": "string", "enum": ["content", "files_with_matches", "count"]}},
+         ["pattern"]),
+    tool("LS", "Lists files and directories in a given path. The path parameter must be an absolute path.",
+         {"path": {**STR, "description": "The absolute path to the directory to list"},
+          "ignore": {"type": "array", "items": STR, "description": "List of glob patterns to ignore"}},
+         ["path"]),
+    tool("Read", "Reads a file from the local filesystem. You can access any file directly by using this tool. "
+         "By default, it reads up to 2000 lines starting from the beginning of the file. " * 3,
+         {"file_path": {**STR, "description": "The absolute path to the file to read"},
+          "offset": {"type": "number", "description": "The line number to start reading from"},
+          "limit": {"type": "number", "description": "The number of lines to read"}},
+         ["file_path"]),
+    tool("Edit", "Performs exact string replacements in files. You must use your Read tool at least once "
+         "in the conversation before editing. " * 3,
+         {"file_path": {**STR, "description": "The absolute path to the file to modify"},
+          "old_string": {**STR, "description": "The text to replace"},
+          "new_string": {**STR, "description": "The text to replace it with"},
+          "replace_all": {"type": "boolean", "default": False}},
+         ["file_path", "old_string", "new_string"]),
+    tool("Write", "Writes a file to the local filesystem. This tool will overwrite the existing file "
+         "if there is one at the provided path. " * 3,
+         {"file_path": {**STR, "description": "The absolute path to the file to write"},
+          "content": {**STR, "description": "The content to write to the file"}},
+         ["file_path", "content"]),
+    tool("TodoWrite", "Use this tool to create and manage a structured task list for your current coding session. " * 4,
+         {"todos": {"type": "array", "items": {"type": "object", "properties": {
+             "content": {**STR, "minLength": 1}, "status": {"type": "string", "enum": ["pending", "in_progress", "completed"]},
+             "priority": {"type": "string", "enum": ["high", "medium", "low"]}, "id": STR},
+             "required": ["content", "status", "priority", "id"]}}},
+         ["todos"]),
+]
+
+TASKS = [
+    "The integration tests in tests/test_api.py started failing after the last merge. Find out why and fix it.",
+    "Add a --dry-run flag to the deploy script that prints the actions instead of running them.",
+    "Refactor the config loader so environment variables override values from the YAML file.",
+    "The service leaks database connections under load. Track down the leak and add a regression test.",
+]
+FOLLOW_UPS = ["Looks good, continue.", "Please also update the README.", "Run the tests again.", "Go on."]
+
+
+def tool_result_text(name, tool_input, size_kb, rng):
+    """Plausible tool output of roughly size_kb."""
+    target = name if isinstance(name, str) else "tool"
+    lines = [f"{target}: {json.dumps(tool_input, ensure_ascii=False)[:120]}"]
+    size = size_kb * 1024
+    n = 1
+    while sum(map(len, lines)) < size:
+        lines.append(f"{n:>5}\t    result_{rng.randrange(1000)} = process(items[{n}], retries=3)  # keep order")
+        n += 1
+    return "\n".join(lines)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def summary_ms(values):
+    return {f"p{q}": round(v * 1e3, 2) if (v := percentile(values, q)) is not None else None for q in (50, 95, 99)}
+
+
+# ----------------------------------------------------------------------------- processes
+
+def start_process(cmd, name):
+    log = tempfile.TemporaryFile(mode="w+")
+    proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, cwd=HERE)
+    proc.log, proc.name = log, name
+    return proc
+
+
+def wait_ready(url, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            proc.log.seek(0)
+            raise SystemExit(f"{proc.name} exited during startup:\n{proc.log.read()[-4000:]}")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"{proc.name} did not become ready at {url} within {timeout}s")
+
+
+def stop_process(proc):
+    proc.terminate()
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+# ----------------------------------------------------------------------------- client
+
+async def send_streaming(client, url, body, headers, started):
+    """POST with stream=true and rebuild the assistant content from the SSE events."""
+    blocks, partial, ttft = [], {}, None
+    async with client.stream("POST", url, json=body, headers=headers) as resp:
+        if resp.status_code != 200:
+            await resp.aread()
+            return resp.status_code, None, None
+        async for line in resp.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            event = json.loads(line[5:])
+            kind = event["type"]
+            if kind == "content_block_start":
+                blocks.append(dict(event["content_block"]))
+            elif kind == "content_block_delta":
+                if ttft is None:
+                    ttft = time.perf_counter() - started
+                delta = event["delta"]
+                if delta["type"] == "text_delta":
+                    blocks[event["index"]]["text"] += delta["text"]
+                else:
+                    partial[event["index"]] = partial.get(event["index"], "") + delta["partial_json"]
+            elif kind == "content_block_stop" and event["index"] in partial:
+                blocks[event["index"]]["input"] = json.loads(partial.pop(event["index"]) or "{}")
+    return 200, blocks, ttft
+
+
+async def send_plain(client, url, body, headers):
+    resp = await client.post(url, json=body, headers=headers)
+    if resp.status_code != 200:
+        return resp.status_code, None
+    return 200, resp.json()["content"]
+
+
+async def run_session(client, url, session_id, turns, args, samples):
+    rng = random.Random(args.seed * 1_000_003 + session_id)
+    messages = [{"role": "user", "content": rng.choice(TASKS)}]
+    for turn in range(turns):
+        stream = rng.random() < args.stream_ratio
+        request_id = f"lt-{session_id}-{turn}-{os.urandom(3).hex()}"
+        body = {"model": "claude-sonnet-4", "max_tokens": 8192, "system": SYSTEM_PROMPT,
+                "tools": CLAUDE_CODE_TOOLS, "messages": messages, "stream": stream}
+        headers = {"x-request-id": request_id}
+        started = time.perf_counter()
+        ttft = None
+        try:
+            if stream:
+                status, content, ttft = await send_streaming(client, url, body, headers, started)
+            else:
+                status, content = await send_plain(client, url, body, headers)
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            status, content = type(e).__name__, None
+        samples.append({"request_id": request_id, "stream": stream, "status": status,
+                        "latency": time.perf_counter() - started, "ttft": ttft})
+        if status != 200:
+            return
+
+        messages.append({"role": "assistant", "content": content or [{"type": "text", "text": "(no output)"}]})
+        tool_uses = [b for b in content or [] if b["type"] == "tool_use"]
+        if tool_uses:
+            messages.append({"role": "user", "content": [
+                {"type": "tool_result", "tool_use_id": b["id"],
+                 "content": tool_result_text(b["name"], b.get("input"), args.result_kb, rng)}
+                for b in tool_uses
+            ]})
+        else:
+            messages.append({"role": "user", "content": rng.choice(FOLLOW_UPS)})
+
+
+async def run_sessions(url, n_sessions, turns, args, first_session=0):
+    samples = []
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits, trust_env=False) as client:
+        queue = iter(range(first_session, first_session + n_sessions))
+
+        async def worker():
+            for session_id in queue:
+                await run_session(client, url, session_id, turns, args, samples)
+
+        await asyncio.gather(*(worker() for _ in range(min(args.concurrency, n_sessions))))
+    return samples
+
+
+def middleware_cpu(base_url):
+    return httpx.get(f"{base_url}/upstream/stats", timeout=10).json()["process"]["cpu_seconds"]
+
+
+# ----------------------------------------------------------------------------- report
+
+def build_report(samples, timings, cpu_seconds, elapsed, args):
+    ok = [s for s in samples if s["status"] == 200]
+    added, added_ttft = [], []
+    for s in ok:
+        upstream = timings.get(s["request_id"])
+        if upstream is None:
+            continue
+        added.append(s["latency"] - upstream["service"])
+        if s["ttft"] is not None:
+            added_ttft.append(s["ttft"] - upstream["ttft"])
+    errors = {}
+    for s in samples:
+        if s["status"] != 200:
+            errors[str(s["status"])] = errors.get(str(s["status"]), 0) + 1
+    return {
+        "requests": len(samples),
+        "ok": len(ok),
+        "errors": errors,
+        "error_rate": round(1 - len(ok) / len(samples), 4) if samples else 0.0,
+        "duration_s": round(elapsed, 3),
+        "requests_per_s": round(len(ok) / elapsed, 2) if elapsed else None,
+        "latency_ms": summary_ms([s["latency"] for s in ok]),
+        "added_latency_ms": summary_ms(added),
+        "added_ttft_ms": summary_ms(added_ttft),
+        "unmatched_timings": len(ok) - len(added),
+        "cpu_ms_per_request": round(cpu_seconds / len(ok) * 1e3, 3) if ok and cpu_seconds is not None else None,
+        "config": {k: v for k, v in vars(args).items() if k != "json"},
+    }
+
+
+def print_report(report):
+    def row(label, stats):
+        print(f"{label:<24}" + "  ".join(f"{k} {v:>8.2f} ms" if v is not None else f"{k}      n/a" for k, v in stats.items()))
+
+    print(f"{'requests':<24}{report['ok']} ok / {report['requests']} "
+          f"(errors: {report['errors'] or 'none'}) in {report['duration_s']:.1f} s")
+    print(f"{'throughput':<24}{report['requests_per_s']} req/s")
+    row("latency", report["latency_ms"])
+    row("added latency", report["added_latency_ms"])
+    row("added TTFT (stream)", report["added_ttft_ms"])
+    cpu = report["cpu_ms_per_request"]
+    print(f"{'middleware CPU':<24}{f'{cpu:.2f} ms/request' if cpu is not None else 'n/a'}")
+    if report["unmatched_timings"]:
+        print(f"\nwarning: {report['unmatched_timings']} requests had no upstream timing "
+              f"(is the upstream fake_vllm.py?); they are left out of the added latency")
+
+
+def check_gates(report, args):
+    failures = []
+    p99 = report["added_latency_ms"]["p99"]
+    if args.max_p99_ms is not None and (p99 is None or p99 > args.max_p99_ms):
+        failures.append(f"added latency p99 {p99} ms > {args.max_p99_ms} ms")
+    cpu = report["cpu_ms_per_request"]
+    if args.max_cpu_ms is not None and (cpu is None or cpu > args.max_cpu_ms):
+        failures.append(f"CPU {cpu} ms/request > {args.max_cpu_ms} ms")
+    if report["error_rate"] > args.max_error_rate:
+        failures.append(f"error rate {report['error_rate']} > {args.max_error_rate}")
+    return failures
+
+
+def build_arg_parser():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--url", help="middleware base URL (default: start one on a free port)")
+    ap.add_argument("--fake-url", help="fake_vllm.py base URL (default: start one on a free port)")
+    ap.add_argument("--concurrency", type=int, default=16, help="sessions in flight at once")
+    ap.add_argument("--sessions", type=int, default=64, help="sessions to replay")
+    ap.add_argument("--turns", type=int, default=8, help="requests per session")
+    ap.add_argument("--stream-ratio", type=float, default=1.0, help="share of streaming requests (Claude Code streams)")
+    ap.add_argument("--result-kb", type=int, default=4, help="size of each tool_result added to the history")
+    ap.add_argument("--warmup", type=int, default=2, help="sessions run before measuring")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--timeout", type=float, default=300.0, help="per-request timeout in seconds")
+    ap.add_argument("--log-level", default="WARNING", help="log level of the spawned middleware")
+    group = ap.add_argument_group("fake upstream (only when it is started by this script)")
+    group.add_argument("--ttft", type=float, default=0.05)
+    group.add_argument("--tpot", type=float, default=0.0)
+    group.add_argument("--tool-ratio", type=float, default=0.7)
+    group.add_argument("--messy-ratio", type=float, default=0.3)
+    group = ap.add_argument_group("gates")
+    group.add_argument("--max-p99-ms", type=float, help="fail if the added latency p99 exceeds this")
+    group.add_argument("--max-cpu-ms", type=float, help="fail if middleware CPU per request exceeds this")
+    group.add_argument("--max-error-rate", type=float, default=0.0, help="fail above this share of failed requests")
+    ap.add_argument("--json", help="also write the report to this file")
+    return ap
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    procs = []
+    try:
+        fake_url = args.fake_url
+        if fake_url is None:
+            port = free_port()
+            fake_url = f"http://127.0.0.1:{port}"
+            procs.append(start_process([
+                sys.executable, FAKE_VLLM, "--port", str(port), "--ttft", str(args.ttft), "--tpot", str(args.tpot),
+                "--tool-ratio", str(args.tool_ratio), "--messy-ratio", str(args.messy_ratio), "--seed", str(args.seed),
+            ], "fake_vllm.py"))
+            wait_ready(f"{fake_url}/health", procs[-1])
+        base_url = args.url
+        if base_url is None:
+            port = free_port()
+            base_url = f"http://127.0.0.1:{port}"
+            procs.append(start_process([
+                sys.executable, MIDDLEWARE, "--host", "127.0.0.1", "--port", str(port),
+                "--vllm-api-base", f"{fake_url}/v1", "--log-level", args.log_level,
+            ], "middleware"))
+            wait_ready(f"{base_url}/upstream/stats", procs[-1])
+
+        url = f"{base_url}/v1/messages"
+        if args.warmup:
+            asyncio.run(run_sessions(url, args.warmup, min(args.turns, 2), args, first_session=-args.warmup))
+        httpx.get(f"{fake_url}/fake/timings", timeout=10)  # drop warmup timings
+
+        cpu_before = middleware_cpu(base_url)
+        started = time.perf_counter()
+        samples = asyncio.run(run_sessions(url, args.sessions, args.turns, args))
+        elapsed = time.perf_counter() - started
+        cpu_seconds = middleware_cpu(base_url) - cpu_before
+        timings = httpx.get(f"{fake_url}/fake/timings", timeout=30).json()
+    finally:
+        for proc in reversed(procs):
+            stop_process(proc)
+
+    report = build_report(samples, timings, cpu_seconds, elapsed, args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    failures = check_gates(report, args)
+    for failure in failures:
+        print(f"GATE FAILED: {failure}")
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,102 +1,2060 @@
 import os
+import sys
+import argparse
 import json
 import re
 import uvicorn
 import httpx
 import time
-import ast
+import functools
+import hashlib
+import asyncio
+import contextlib
+import bisect
+import math
+import random
+import heapq
+import queue
+import atexit
+import logging
+import logging.handlers
+import contextvars
+import gzip
+import threading
+import fnmatch
+from collections import OrderedDict
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+
+try:
+    # 可选依赖: pip install prometheus_client，未安装时 /metrics 不可用，其余功能不受影响
+    import prometheus_client
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+except ImportError:
+    prometheus_client = None
+
+try:
+    # 可选依赖: pip install orjson，JSON 编解码快数倍；未安装时退回标准库 json，行为一致
+    import orjson
+except ImportError:
+    orjson = None
 
 # ================= 用户配置区域 =================
 # 您的 vLLM 服务地址
 VLLM_API_BASE = "http://localhost:8001/v1"
 
-# 中间件监听端口
-PORT = 4000
+# 多副本部署时列出所有 vLLM 副本地址，中间件内置负载均衡 (默认只有 VLLM_API_BASE 一个)
+VLLM_API_BASES = [VLLM_API_BASE]
+# 负载均衡策略: least_requests (最少在途请求) / least_tokens (最少在途 Prompt+max_tokens)
+UPSTREAM_BALANCE = "least_requests"
+# 主动健康检查间隔 (秒)，检查 /health 与 /v1/models
+UPSTREAM_HEALTH_INTERVAL = 10.0
+# 连续失败 N 次后摘除副本，冷却 M 秒后由健康检查重新加入
+UPSTREAM_MAX_FAILURES = 3
+UPSTREAM_EJECT_SECONDS = 30.0
+# 前缀亲和路由: 按稳定前缀 (system + 工具 Prompt + 第一条 user 消息) 一致性哈希，同一会话固定到持有其 KV 缓存的副本
+UPSTREAM_PREFIX_AFFINITY = True
+# 有界负载: 副本在途请求超过平均值的该倍数时，沿哈希环顺延到下一个副本
+UPSTREAM_AFFINITY_LOAD_FACTOR = 1.25
+# 哈希环上每个副本的虚拟节点数
+UPSTREAM_HASH_VNODES = 100
+# 记录各前缀上次路由结果的条目上限 (用于统计亲和命中与节省的 Prefill Token)
+PREFIX_AFFINITY_CACHE_SIZE = 10000
+
+# 上游连接池: 最大连接数 / 最大空闲 Keep-Alive 连接数 / 空闲连接保留秒数
+UPSTREAM_MAX_CONNECTIONS = 256
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = 64
+UPSTREAM_KEEPALIVE_EXPIRY = 60.0
+# 使用 HTTP/2 连接 vLLM (需要 pip install h2，未安装时退回 HTTP/1.1)
+UPSTREAM_HTTP2 = False
+# 与 vLLM 同机部署时可走 Unix Domain Socket (vLLM 以 --uds 启动)，例如 "/tmp/vllm.sock"；None 表示走 TCP
+UPSTREAM_UDS_PATH = None
+# 超时 (秒): 建立连接 / 两次读取之间 / 等待连接池空闲连接 / 流式请求等待响应头 (首字节)
+UPSTREAM_CONNECT_TIMEOUT = 5.0
+UPSTREAM_READ_TIMEOUT = 600.0
+UPSTREAM_POOL_TIMEOUT = 30.0
+UPSTREAM_FIRST_BYTE_TIMEOUT = 60.0
+# 连接被拒绝、连接超时、首字节超时等请求尚未被处理的失败可换副本重试 (指数退避 + 随机抖动)
+UPSTREAM_RETRIES = 2
+UPSTREAM_RETRY_BACKOFF = 0.2
+
+# 准入控制: 同时在途请求数上限与在途 Token 预算 (Prompt + max_tokens 之和)，避免 vLLM 调度器频繁抢占长上下文请求
+ADMISSION_MAX_INFLIGHT_REQUESTS = 32
+ADMISSION_TOKEN_BUDGET = 1000000
+# 超出上限的请求进入等待队列 (按优先级、再按到达顺序)；队列满时返回 429 overloaded_error
+ADMISSION_QUEUE_SIZE = 128
+# 排队超过该秒数仍未被放行时返回 429
+ADMISSION_QUEUE_TIMEOUT = 300.0
+# 客户端可通过该请求头指定优先级 (整数，越大越优先，默认 0)
+ADMISSION_PRIORITY_HEADER = "x-request-priority"
+
+# 等待 vLLM 时每隔多少秒检查一次客户端是否已断开 (断开后关闭上游连接，vLLM 随之中止生成)
+DISCONNECT_POLL_INTERVAL = 0.5
+# 估算节省的 GPU 时间时使用的解码速度 (token/s)，流式请求优先使用实测速度
+ESTIMATED_DECODE_TOKENS_PER_SECOND = 30.0
+
+# 中间件监听地址与端口
+HOST = "0.0.0.0"
+PORT = 4000
+# 工作进程数: JSON 编解码与长历史转换是 CPU 密集型，多进程可按核数扩展吞吐
+# 各进程的缓存 (Token 计数、消息转换、工具 Prompt、前缀路由记录) 相互独立；准入控制的上限按进程数平分
+WORKERS = 1
+
+# 您的自定义模型名称 (在这里写死)
+TARGET_MODEL_NAME = "Qwen/Qwen3-235B-A22B-Instruct" 
+
+# vLLM 的 API Key (在这里写死)
+VLLM_API_KEY = "empty"
+
+# 上下文限制 (80k)
+MAX_CONTEXT_TOKENS = 80000 
+
+# 本地 Qwen3 分词器 (本地目录，或已下载到 HF 缓存的模型名；不会联网下载)，用于精确计算 Prompt Token 数；加载失败时退回字符估算
+TOKENIZER_PATH = TARGET_MODEL_NAME
+# 每条消息 Token 数缓存条目上限 (按消息内容哈希，长会话只需对新增轮次分词)
+TOKEN_CACHE_SIZE = 50000
+
+# 超出上下文限制时在服务端自动压缩，而不是直接返回 400 (需要时改为 True)
+AUTO_COMPACT_ENABLED = False
+# 最近 N 条消息保持原样 (不截断、不丢弃)
+COMPACT_KEEP_LAST_MESSAGES = 6
+# 较早的 tool_result 超过该长度时只保留首尾摘录
+COMPACT_TOOL_RESULT_MAX_CHARS = 2000
+COMPACT_TOOL_RESULT_HEAD_CHARS = 1200
+COMPACT_TOOL_RESULT_TAIL_CHARS = 600
+# 丢弃旧消息时按该步长对齐截断点，截断点在多轮之间保持不变，vLLM 前缀缓存不会每轮失效
+COMPACT_DROP_STEP = 20
+
+# 工具定义 Prompt 缓存条目上限 (按 tools 数组哈希)
+TOOL_PROMPT_CACHE_SIZE = 64
+
+# 工具定义压缩: 截断过长的描述、去掉 schema 中的冗余字段，减少每轮重复发送的 Prompt Token
+# 只影响注入的工具 Prompt (native 模式下为转发的 tools)，参数修复与约束解码仍使用完整 schema；结果确定，不影响前缀缓存
+TOOL_COMPACT_ENABLED = False
+# 工具描述 / 参数描述的最大字符数 (在句子或段落边界截断)，0 表示去掉，None 表示不截断
+TOOL_DESCRIPTION_MAX_CHARS = 800
+TOOL_PARAM_DESCRIPTION_MAX_CHARS = 200
+# 从 schema 中去掉的字段 (additionalProperties 为 schema 对象时有实际含义，保留)
+TOOL_SCHEMA_DROP_KEYS = ["$schema", "additionalProperties", "examples", "example", "title"]
+# 省略本会话从未调用过的工具 (需要时改为 True)；TOOL_COMPACT_KEEP_TOOLS 中的工具始终保留，支持通配符 (如 "mcp__github__*")
+# 注意: 会话中首次调用新工具时工具 Prompt 随之变化，该会话的前缀缓存失效一次
+TOOL_COMPACT_DROP_UNUSED = False
+TOOL_COMPACT_KEEP_TOOLS = ["Task", "Bash", "Glob", "Grep", "LS", "Read", "Edit", "MultiEdit", "Write", "TodoWrite"]
+
+# 历史消息转换缓存 (按消息内容)：条目上限与内存上限 (按字符数估算，键中保留原始内容，计为结果的 2 倍)
+CONVERSION_CACHE_SIZE = 20000
+CONVERSION_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# 工具调用模式:
+#   prompt: 注入工具定义 Prompt 与提醒，由中间件解析输出中的 <tool_call> XML (默认，对 vLLM 无要求)
+#   native: 把 tools / tool_choice 原样转发给 vLLM，直接使用其返回的结构化 tool_calls，
+#           需以 --enable-auto-tool-choice --tool-call-parser hermes 启动 vLLM
+TOOL_CALL_MODE = "prompt"
+# prompt 模式下用 vLLM 结构化输出 (response_format: structural_tag) 约束 <tool_call> 区域:
+# 模型一旦输出 <tool_call>，工具名与参数按本次请求各工具的 input_schema 受约束解码，首次即可解析
+# 需 vLLM >= 0.8.5 且结构化输出后端为 xgrammar；native 模式下不生效 (tool_choice 为 any/tool 时 vLLM 自身会约束)
+GUIDED_TOOL_CALLS = False
+# vLLM 拒绝 native 工具调用 / 结构化输出参数 (未开启工具解析器、版本过旧) 时关闭该特性的时长 (秒)，之后再尝试
+UPSTREAM_FEATURE_FALLBACK_SECONDS = 300.0
+
+# 工具参数修复规则 (别名、包装、缺省字段、类型转换)，启动时编译
+TOOL_ARG_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tool_arg_rules.json")
+
+# 日志: 级别 (DEBUG 时输出模型输出与工具调用原文预览)、JSON Lines 格式 (False 为可读文本)
+LOG_LEVEL = "INFO"
+LOG_JSON = True
+# 预览内容的最大字符数，以及输出 DEBUG 预览的请求比例 (0~1)
+LOG_PREVIEW_CHARS = 200
+LOG_PREVIEW_SAMPLE_RATE = 1.0
+# 日志队列长度: 由后台线程写出，队列满时丢弃而不是阻塞事件循环
+LOG_QUEUE_SIZE = 10000
+
+# 流量录制 (默认关闭): 把 Claude 请求与 vLLM 输出成对写入 gzip 压缩的 JSONL，用 replay_capture.py 回放复现性能问题
+# 例如 "captures/traffic.jsonl.gz"；多进程模式下每个工作进程写入 <路径>.<pid>
+CAPTURE_PATH = None
+# 录制比例 (0~1)
+CAPTURE_SAMPLE_RATE = 1.0
+# 匿名化: 文本逐字符替换为占位符 (长度与结构不变)，保留工具名、参数名与 XML/JSON 标记，解析结果不受影响
+CAPTURE_ANONYMIZE = True
+# 单条记录 (压缩前) 超过上限时跳过；文件 (压缩前) 写满后停止录制
+CAPTURE_MAX_RECORD_BYTES = 8 * 1024 * 1024
+CAPTURE_MAX_FILE_BYTES = 1024 * 1024 * 1024
+# 待写入记录的队列上限，写入跟不上时丢弃
+CAPTURE_QUEUE_SIZE = 1000
+
+# 响应缓存 (默认关闭): CI 与脚本化 Agent 常重复发送完全相同的确定性请求 (temperature 为 0)，命中时直接返回，不再占用 GPU
+# 按转换后的 OpenAI 请求规范化哈希；流式与非流式请求共用缓存
+RESPONSE_CACHE_ENABLED = False
+RESPONSE_CACHE_TTL_SECONDS = 3600.0
+# 内存层: 条目上限与内存上限 (按序列化后的字节数)
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+RESPONSE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# 磁盘层 (可选): 目录路径，内存层淘汰或重启后仍可命中，多进程共享；总大小超过上限时删除最旧的条目
+RESPONSE_CACHE_DIR = None
+RESPONSE_CACHE_DISK_MAX_BYTES = 1024 * 1024 * 1024
+# 请求带该请求头 (值非 0/false) 时跳过缓存读取，新结果仍会写入缓存
+RESPONSE_CACHE_BYPASS_HEADER = "X-Cache-Bypass"
+
+# 在途请求合并 (默认关闭): 客户端重试与并发扇出常在第一个请求仍在生成时发出完全相同的确定性请求
+# 开启后相同请求 (与响应缓存相同的规范化哈希) 不再访问 vLLM: 流式请求订阅在途请求的输出，非流式请求等待其结果
+SINGLE_FLIGHT_ENABLED = False
+# 每个在途请求最多合并的等待者数，超过后的相同请求照常访问 vLLM
+SINGLE_FLIGHT_MAX_WAITERS = 32
+# ===========================================
+
+# ================= 配置加载 =================
+# 以上常量均可被覆盖，优先级: 命令行参数 > 环境变量 QWEN_MW_<常量名> > 配置文件 (JSON，键为常量名) > 默认值
+CONFIG_ENV_PREFIX = "QWEN_MW_"
+CONFIG_KEYS = [name for name in list(globals()) if name.isupper() and name != "CONFIG_ENV_PREFIX"]
+# 配置项的类型按默认值确定；默认值表达不了的在这里声明:
+# 可设为 null (None) 的项及其非空时的类型，列表项的元素类型
+CONFIG_NULLABLE = {
+    "UPSTREAM_UDS_PATH": str,
+    "TOOL_DESCRIPTION_MAX_CHARS": int,
+    "TOOL_PARAM_DESCRIPTION_MAX_CHARS": int,
+    "CAPTURE_PATH": str,
+    "RESPONSE_CACHE_DIR": str,
+}
+CONFIG_LIST_ITEMS = {"VLLM_API_BASES": str, "TOOL_SCHEMA_DROP_KEYS": str, "TOOL_COMPACT_KEEP_TOOLS": str}
+_undeclared = [key for key in CONFIG_KEYS if key not in CONFIG_NULLABLE and (
+    globals()[key] is None or isinstance(globals()[key], list) and key not in CONFIG_LIST_ITEMS)]
+if _undeclared:
+    raise RuntimeError(f"配置项缺少类型声明 (CONFIG_NULLABLE / CONFIG_LIST_ITEMS): {', '.join(_undeclared)}")
+
+def build_arg_parser():
+    ap = argparse.ArgumentParser(description="Claude 协议兼容中间件 (Claude /v1/messages -> vLLM /chat/completions)")
+    ap.add_argument("--config", help="JSON 配置文件，键为配置区域中的常量名 (如 VLLM_API_BASE)")
+    ap.add_argument("--host", help="监听地址")
+    ap.add_argument("--port", type=int, help="监听端口")
+    ap.add_argument("--workers", type=int, help="工作进程数")
+    ap.add_argument("--vllm-api-base", action="append", help="vLLM 地址 (可重复指定多个副本)")
+    ap.add_argument("--model", help="vLLM 中的模型名称")
+    ap.add_argument("--api-key", help="vLLM 的 API Key")
+    ap.add_argument("--max-context-tokens", type=int, help="上下文 Token 上限")
+    ap.add_argument("--log-level", help="日志级别 (DEBUG / INFO / WARNING / ERROR)")
+    return ap
+
+def config_type(key):
+    """配置项的 (类型, 列表元素类型, 是否可为 None)"""
+    if key in CONFIG_NULLABLE:
+        return CONFIG_NULLABLE[key], None, True
+    default = globals()[key]
+    if isinstance(default, list):
+        return list, CONFIG_LIST_ITEMS[key], False
+    return type(default), None, False
+
+def _parse_config_value(key, raw):
+    """环境变量为字符串: 字符串项原样使用 (可为 None 的项 "null" 表示 None)，否则按 JSON 解析 (数字、布尔、列表、null)，类型由 _coerce_config_value 校验"""
+    expected, _, nullable = config_type(key)
+    if expected is str:
+        return None if nullable and raw == "null" else raw
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return raw
+
+_INVALID = object()
+
+def _coerce_scalar(value, expected):
+    """按类型转换单个值，无法转换时返回 _INVALID"""
+    if expected is bool:
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+            return value.strip().lower() == "true"
+    elif expected in (int, float):
+        if isinstance(value, str):
+            with contextlib.suppress(ValueError):
+                value = float(value) if expected is float else int(value)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            if expected is float:
+                return float(value)
+            if float(value).is_integer():
+                return int(value)
+    elif isinstance(value, expected):
+        return value
+    return _INVALID
+
+def _coerce_config_value(key, value):
+    """
+    按声明的类型校验并转换配置值 (命令行、环境变量、配置文件共用)，不符时带上配置项名退出
+    布尔值接受任意大小写的 true/false；整数项接受整数值的浮点数；列表逐项校验；null 只用于可为 None 的项
+    """
+    expected, item_type, nullable = config_type(key)
+    if value is None and nullable:
+        return None
+    if item_type is not None:
+        if isinstance(value, list):
+            items = [_coerce_scalar(item, item_type) for item in value]
+            if not any(item is _INVALID for item in items):
+                return items
+        type_name = f"list[{item_type.__name__}]"
+    else:
+        result = _coerce_scalar(value, expected)
+        if result is not _INVALID:
+            return result
+        type_name = expected.__name__
+    if nullable:
+        type_name += " 或 null"
+    raise SystemExit(f"❌ 配置项 {key} 的值无效: {value!r} (应为 {type_name})")
+
+def load_config(argv=None):
+    """
+    应用配置覆盖并返回被覆盖的项
+    argv 不为 None 时解析命令行，并写回环境变量: 多进程模式下子进程导入本模块时读取同一份配置
+    """
+    if argv is not None:
+        args = build_arg_parser().parse_args(argv)
+        cli = {
+            "CONFIG": args.config and os.path.abspath(args.config),
+            "HOST": args.host,
+            "PORT": args.port,
+            "WORKERS": args.workers,
+            "VLLM_API_BASE": args.vllm_api_base and args.vllm_api_base[0],
+            "VLLM_API_BASES": args.vllm_api_base,
+            "TARGET_MODEL_NAME": args.model,
+            "VLLM_API_KEY": args.api_key,
+            "MAX_CONTEXT_TOKENS": args.max_context_tokens,
+            "LOG_LEVEL": args.log_level and args.log_level.upper(),
+        }
+        for key, value in cli.items():
+            if value is not None:
+                os.environ[CONFIG_ENV_PREFIX + key] = value if isinstance(value, str) else json.dumps(value)
+    
+    overrides = {}
+    config_path = os.environ.get(CONFIG_ENV_PREFIX + "CONFIG")
+    if config_path:
+        with open(config_path, encoding="utf-8") as f:
+            overrides.update({k.upper(): v for k, v in json.load(f).items() if not k.startswith("_")})
+    for key in CONFIG_KEYS:
+        raw = os.environ.get(CONFIG_ENV_PREFIX + key)
+        if raw is not None:
+            overrides[key] = _parse_config_value(key, raw)
+    unknown = sorted(set(overrides) - set(CONFIG_KEYS))
+    if unknown:
+        raise SystemExit(f"❌ 未知配置项: {', '.join(unknown)}")
+    overrides = {key: _coerce_config_value(key, value) for key, value in overrides.items()}
+    # 由其他配置派生的默认值跟随来源变化
+    if "VLLM_API_BASE" in overrides and "VLLM_API_BASES" not in overrides:
+        overrides["VLLM_API_BASES"] = [overrides["VLLM_API_BASE"]]
+    if "TARGET_MODEL_NAME" in overrides and "TOKENIZER_PATH" not in overrides:
+        overrides["TOKENIZER_PATH"] = overrides["TARGET_MODEL_NAME"]
+    globals().update(overrides)
+    return overrides
+
+CONFIG_OVERRIDES = load_config(sys.argv[1:] if __name__ == "__main__" else None)
+
+# ================= 日志 =================
+logger = logging.getLogger("qwen_middleware")
+request_id_var = contextvars.ContextVar("request_id", default="-")
+preview_sampled_var = contextvars.ContextVar("preview_sampled", default=True)
+declared_tools_var = contextvars.ContextVar("declared_tools", default=frozenset())  # 本次请求声明的工具名 (指标标签白名单)
+
+class JsonLogFormatter(logging.Formatter):
+    """每条日志一行 JSON: 时间、级别、request_id、消息，以及 extra={"fields": {...}} 中的附加字段"""
+    
+    def format(self, record):
+        entry = {
+            "ts": f"{self.formatTime(record, '%Y-%m-%dT%H:%M:%S')}.{int(record.msecs):03d}",
+            "level": record.levelname,
+            "request_id": getattr(record, "request_id", "-"),
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """写入有界队列，满时丢弃并计数，事件循环永远不会阻塞在日志 I/O 上"""
+    
+    dropped = 0
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+def _attach_request_id(record):
+    # 在调用方 (事件循环) 上下文中读取 request_id，写出线程中已无法获取
+    record.request_id = request_id_var.get()
+    return True
+
+def setup_logging():
+    """日志经队列交给后台线程写到 stdout (重复导入本模块时替换之前的 handler，避免重复输出)"""
+    for handler in list(logger.handlers):
+        if hasattr(handler, "listener"):
+            handler.listener.stop()
+        logger.removeHandler(handler)
+    output = logging.StreamHandler(sys.stdout)
+    if LOG_JSON:
+        output.setFormatter(JsonLogFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(message)s"))
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(_attach_request_id)
+    logger.addHandler(queue_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    queue_handler.listener = logging.handlers.QueueListener(queue_handler.queue, output)
+    queue_handler.listener.start()
+    atexit.register(queue_handler.listener.stop)
+
+def log_preview_enabled():
+    """模型输出 / 工具调用原文预览只在 DEBUG 级别且本请求被抽样时生成，WARNING 级别下完全跳过"""
+    return preview_sampled_var.get() and logger.isEnabledFor(logging.DEBUG)
+
+def preview(text, limit=LOG_PREVIEW_CHARS):
+    """截断日志中的长内容"""
+    if not isinstance(text, str):
+        text = repr(text)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}...(+{len(text) - limit} chars)"
+
+def start_request_log(request):
+    """为请求分配 request_id (优先使用客户端传入的 X-Request-Id) 并决定是否抽样输出预览"""
+    request_id = request.headers.get("x-request-id") or f"req_{os.urandom(6).hex()}"
+    request_id_var.set(request_id)
+    preview_sampled_var.set(random.random() < LOG_PREVIEW_SAMPLE_RATE)
+    return request_id
+
+setup_logging()
+if CONFIG_OVERRIDES:
+    logger.info("⚙️ 配置覆盖: %s", ", ".join(sorted(k for k in CONFIG_OVERRIDES if k != "VLLM_API_KEY")))
+
+# ================= JSON 编解码 =================
+# 请求解码、上游编码、上游解码与响应编码都走这里，长历史请求的 JSON 处理是主要 CPU 开销之一
+def json_loads(data):
+    """解析 JSON (str 或 bytes)，优先使用 orjson"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj):
+    """编码为紧凑的 UTF-8 JSON bytes，与 Starlette JSONResponse 的输出格式一致"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass  # 超出 64 位的整数等 orjson 不支持的值，交给标准库
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """使用 json_dumps 编码的 JSONResponse"""
+    def render(self, content):
+        return json_dumps(content)
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    响应结束后 (包括客户端断开、body 从未开始迭代) 一定关闭 body 生成器并调用 on_close
+    Starlette 取消 stream_response 时不会 aclose body，生成器的 finally 可能永远不执行，资源释放不能只依赖它
+    """
+    def __init__(self, content, on_close=None, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+    
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                with contextlib.suppress(Exception):
+                    await aclose()
+            if self.on_close is not None:
+                result = self.on_close()
+                if asyncio.iscoroutine(result):
+                    await result
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global client
+    if client is None:
+        # 在工作进程启动时创建 (多进程模式下位于 fork/spawn 之后)，连接池不会跨进程共享
+        client = create_upstream_client()
+    await asyncio.to_thread(load_tokenizer)
+    health_task = asyncio.create_task(upstream_pool.health_check_loop())
+    try:
+        yield
+    finally:
+        health_task.cancel()
+        await client.aclose()
+        # uvicorn 收到 SIGTERM 后会以默认信号处理退出，atexit 不一定执行，在这里写完录制文件的 gzip 尾部
+        traffic_recorder.close()
+
+app = FastAPI(lifespan=lifespan)
+
+def create_upstream_client():
+    """按配置创建上游 HTTP 客户端: 连接池与 Keep-Alive、分阶段超时、可选 HTTP/2 或 Unix Socket"""
+    http2 = UPSTREAM_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("⚠️ 未安装 h2 (pip install h2)，上游连接退回 HTTP/1.1")
+            http2 = False
+    transport = httpx.AsyncHTTPTransport(
+        http2=http2,
+        uds=UPSTREAM_UDS_PATH,
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+    )
+    timeout = httpx.Timeout(
+        connect=UPSTREAM_CONNECT_TIMEOUT,
+        read=UPSTREAM_READ_TIMEOUT,
+        write=UPSTREAM_READ_TIMEOUT,
+        pool=UPSTREAM_POOL_TIMEOUT,
+    )
+    # trust_env=False: 禁止读取系统代理环境变量 (HTTP_PROXY 等)，确保请求直接发送给局域网/本地 vLLM
+    return httpx.AsyncClient(transport=transport, timeout=timeout, trust_env=False)
+
+client = None
+
+def connection_pool_stats():
+    """
+    上游 httpx 连接池的实际状态 (含健康检查占用的连接): 打开的连接数、正在使用 / 空闲的连接数、等待连接的请求数
+    读取的是 httpcore 连接池的内部结构，取不到时返回 None
+    """
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    connections = getattr(pool, "connections", None)
+    if connections is None:
+        return None
+    try:
+        active = sum(not connection.is_idle() for connection in connections)
+        queued = sum(request.is_queued() for request in getattr(pool, "_requests", ()))
+    except AttributeError:
+        return None
+    return {"connections": len(connections), "active": active, "idle": len(connections) - active, "queued": queued}
+
+# ================= Prometheus 指标 =================
+# 各阶段耗时分布: 毫秒级的转换/解析与分钟级的 vLLM 调用共用一组桶
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+if prometheus_client is not None:
+    # 使用独立的 registry: 多进程模式下子进程会以 __mp_main__ 与模块名各导入一次，不能重复注册到全局 REGISTRY
+    METRICS_REGISTRY = prometheus_client.CollectorRegistry()
+    prometheus_client.ProcessCollector(registry=METRICS_REGISTRY)
+    STAGE_SECONDS = prometheus_client.Histogram(
+        "qwen_middleware_stage_seconds", "Time spent in each pipeline stage", ["stage"], buckets=LATENCY_BUCKETS, registry=METRICS_REGISTRY)
+    UPSTREAM_TTFB_SECONDS = prometheus_client.Histogram(
+        "qwen_middleware_upstream_ttfb_seconds", "Time to first byte from vLLM (first content chunk when streaming)", ["stream"], buckets=LATENCY_BUCKETS, registry=METRICS_REGISTRY)
+    UPSTREAM_SECONDS = prometheus_client.Histogram(
+        "qwen_middleware_upstream_seconds", "Total vLLM request time", ["stream"], buckets=LATENCY_BUCKETS, registry=METRICS_REGISTRY)
+    TOKENS_TOTAL = prometheus_client.Counter(
+        "qwen_middleware_tokens_total", "Tokens processed by vLLM (rate() gives throughput)", ["kind"], registry=METRICS_REGISTRY)
+    TOOL_PARSE_TOTAL = prometheus_client.Counter(
+        "qwen_middleware_tool_parse_total", "Tool-call parse outcomes", ["tool", "strategy", "outcome"], registry=METRICS_REGISTRY)
+    REQUESTS_IN_FLIGHT = prometheus_client.Gauge(
+        "qwen_middleware_requests_in_flight", "Requests being handled by the middleware (including queued)", registry=METRICS_REGISTRY)
+    STREAMS_IN_FLIGHT = prometheus_client.Gauge(
+        "qwen_middleware_streams_in_flight", "Streaming responses currently being relayed", registry=METRICS_REGISTRY)
+else:
+    STAGE_SECONDS = UPSTREAM_TTFB_SECONDS = UPSTREAM_SECONDS = TOKENS_TOTAL = TOOL_PARSE_TOTAL = None
+    REQUESTS_IN_FLIGHT = STREAMS_IN_FLIGHT = None
+
+def metric_observe(histogram, value, *labels):
+    if histogram is not None:
+        (histogram.labels(*labels) if labels else histogram).observe(value)
+
+def metric_inc(metric, amount=1, *labels):
+    if metric is not None:
+        (metric.labels(*labels) if labels else metric).inc(amount)
+
+def metric_dec(gauge, amount=1):
+    if gauge is not None:
+        gauge.dec(amount)
+
+@contextlib.contextmanager
+def observe_stage(stage):
+    """记录一个处理阶段的耗时"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric_observe(STAGE_SECONDS, time.perf_counter() - start, stage)
+
+def record_tool_parse(tool, strategy, outcome="success"):
+    """工具调用解析结果: strategy 为 stream (增量解析) / json / brace / lenient / native (vLLM 解析)"""
+    # 工具名来自模型输出，只有本次请求声明过的工具名作为标签，其余归为 other，标签集合不会被异常输出撑大
+    label = tool if isinstance(tool, str) and tool in declared_tools_var.get() else "other"
+    metric_inc(TOOL_PARSE_TOTAL, 1, label, strategy or "none", outcome)
+
+
+def estimate_tokens(text):
+    return len(text) // 3
+
+_MISSING = object()
+
+class LRUCache:
+    """基于 OrderedDict 的 LRU 缓存，记录命中/未命中次数；可选按 sizeof(value) 限制总大小"""
+    
+    def __init__(self, maxsize, max_bytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key, default=None):
+        value = self.data.get(key, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def put(self, key, value):
+        if self.max_bytes is not None:
+            old = self.data.get(key, _MISSING)
+            if old is not _MISSING:
+                self.bytes -= self.sizeof(old)
+            self.bytes += self.sizeof(value)
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize or (self.max_bytes is not None and self.bytes > self.max_bytes and self.data):
+            _, evicted = self.data.popitem(last=False)
+            if self.max_bytes is not None:
+                self.bytes -= self.sizeof(evicted)
+    
+    def pop(self, key):
+        value = self.data.pop(key, _MISSING)
+        if value is _MISSING:
+            return None
+        if self.max_bytes is not None:
+            self.bytes -= self.sizeof(value)
+        return value
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+# ================= 上游 vLLM 副本池 =================
+class UpstreamBackend:
+    """单个 vLLM 副本的状态: 在途请求数、在途 Token 数、健康状况与熔断 (摘除) 时间"""
+    
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.outstanding = 0
+        self.inflight_tokens = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.total_requests = 0
+        self.total_failures = 0
+    
+    def breaker_open(self, now):
+        """熔断器: 冷却期内直接拒绝；冷却结束后 (半开) 只放行一个探测请求，成功则关闭"""
+        if not self.ejected_until:
+            return False
+        return now < self.ejected_until or self.outstanding > 0
+    
+    def available(self, now):
+        return self.healthy and not self.breaker_open(now)
+    
+    def stats(self):
+        return {
+            "base_url": self.base_url,
+            "healthy": self.healthy,
+            "breaker": "closed" if not self.ejected_until else ("open" if time.monotonic() < self.ejected_until else "half_open"),
+            "outstanding": self.outstanding,
+            "inflight_tokens": self.inflight_tokens,
+            "total_requests": self.total_requests,
+            "total_failures": self.total_failures,
+        }
+
+class UpstreamPool:
+    """
+    多副本负载均衡: 按最少在途请求 (或最少在途 Token) 选择副本
+    连续失败的副本会被摘除，冷却后经健康检查通过再重新加入
+    """
+    
+    def __init__(self, base_urls, balance="least_requests", affinity=False):
+        self.backends = [UpstreamBackend(url) for url in base_urls]
+        self.balance = balance
+        self.rr = 0
+        self.affinity = affinity
+        # 一致性哈希环: 增减副本时只有少量前缀改变归属
+        self.ring = sorted(
+            (self.hash_key(f"{b.base_url}#{i}"), b)
+            for b in self.backends for i in range(UPSTREAM_HASH_VNODES)
+        )
+        self.ring_keys = [h for h, _ in self.ring]
+        # 前缀键 -> (上次路由的副本, 上次 Prompt Token 数)
+        self.prefix_routes = LRUCache(PREFIX_AFFINITY_CACHE_SIZE)
+        self.affinity_stats = {"hits": 0, "misses": 0, "new_prefixes": 0, "spills": 0, "reused_prefill_tokens": 0}
+        self.transport_stats = {"retries": 0, "connect_errors": 0, "first_byte_timeouts": 0, "breaker_opens": 0, "fast_failures": 0}
+    
+    @staticmethod
+    def hash_key(key):
+        return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+    
+    def pick_affinity(self, prefix_key, exclude=()):
+        """
+        有界负载一致性哈希: 从前缀哈希位置沿环查找第一个可用且未过载的副本
+        过载上限 = ceil(LOAD_FACTOR * (总在途 + 1) / 可用副本数)，只有副本过载或不可用时才会偏离首选副本
+        返回 (副本, 是否偏离首选副本)
+        """
+        now = time.monotonic()
+        available = [b for b in self.backends if b not in exclude and b.available(now)]
+        if not available:
+            return None, False
+        bound = math.ceil(UPSTREAM_AFFINITY_LOAD_FACTOR * (sum(b.outstanding for b in available) + 1) / len(available))
+        start = bisect.bisect(self.ring_keys, self.hash_key(prefix_key))
+        preferred = None
+        for i in range(len(self.ring)):
+            backend = self.ring[(start + i) % len(self.ring)][1]
+            if preferred is None:
+                preferred = backend
+            if backend in available and backend.outstanding < bound:
+                return backend, backend is not preferred
+        return None, False
+    
+    def pick(self, exclude=()):
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b not in exclude and b.available(now)]
+        if not candidates:
+            # 健康检查全部失败时仍然尝试未熔断的副本，避免健康检查误判导致整体不可用
+            candidates = [b for b in self.backends if b not in exclude and not b.breaker_open(now)]
+        if not candidates:
+            return None
+        # 轮转起点，负载相同时均匀分布
+        self.rr = (self.rr + 1) % len(candidates)
+        candidates = candidates[self.rr:] + candidates[:self.rr]
+        if self.balance == "least_tokens":
+            return min(candidates, key=lambda b: (b.inflight_tokens, b.outstanding))
+        return min(candidates, key=lambda b: (b.outstanding, b.inflight_tokens))
+    
+    def acquire(self, tokens, exclude=(), prefix_key=None, prompt_tokens=0, record=True):
+        """选择副本并计入在途；record=False 时仍按前缀亲和选择，但不统计亲和命中 (同一请求的重试)"""
+        backend = None
+        if self.affinity and prefix_key is not None:
+            backend, spilled = self.pick_affinity(prefix_key, exclude)
+            if backend is not None and record:
+                self.record_affinity(prefix_key, backend, prompt_tokens, spilled)
+        if backend is None:
+            backend = self.pick(exclude)
+        if backend is not None:
+            backend.outstanding += 1
+            backend.inflight_tokens += tokens
+            backend.total_requests += 1
+        return backend
+    
+    def record_affinity(self, prefix_key, backend, prompt_tokens, spilled):
+        """统计前缀亲和: 与上一轮落在同一副本时，上一轮的 Prompt 可直接复用 vLLM 前缀缓存"""
+        stats = self.affinity_stats
+        if spilled:
+            stats["spills"] += 1
+        previous = self.prefix_routes.get(prefix_key)
+        if previous is None:
+            stats["new_prefixes"] += 1
+        elif previous[0] is backend:
+            stats["hits"] += 1
+            stats["reused_prefill_tokens"] += min(previous[1], prompt_tokens)
+        else:
+            stats["misses"] += 1
+        self.prefix_routes.put(prefix_key, (backend, prompt_tokens))
+    
+    def release(self, backend, tokens, ok=True):
+        backend.outstanding -= 1
+        backend.inflight_tokens -= tokens
+        if ok:
+            if backend.ejected_until:
+                logger.info("✅ 副本 %s 探测请求成功，熔断关闭", backend.base_url)
+            backend.consecutive_failures = 0
+            backend.ejected_until = 0.0
+            return
+        backend.total_failures += 1
+        backend.consecutive_failures += 1
+        # 半开状态的探测请求失败，或连续失败达到阈值: 打开熔断
+        if backend.ejected_until or backend.consecutive_failures >= UPSTREAM_MAX_FAILURES:
+            backend.ejected_until = time.monotonic() + UPSTREAM_EJECT_SECONDS
+            self.transport_stats["breaker_opens"] += 1
+            logger.warning("🚫 副本 %s 连续失败 %d 次，熔断 %ss", backend.base_url, backend.consecutive_failures, UPSTREAM_EJECT_SECONDS)
+    
+    def retry_after(self):
+        """所有副本熔断时，距最早恢复探测的秒数"""
+        now = time.monotonic()
+        waits = [b.ejected_until - now for b in self.backends if b.ejected_until]
+        return max(1, math.ceil(min(waits))) if waits else 1
+    
+    async def check(self, backend):
+        """健康检查: /health 返回 200 且 /v1/models 中包含目标模型"""
+        root = backend.base_url[:-3] if backend.base_url.endswith("/v1") else backend.base_url
+        try:
+            health = await client.get(f"{root}/health", timeout=5.0)
+            models = await client.get(
+                f"{backend.base_url}/models",
+                headers={"Authorization": f"Bearer {VLLM_API_KEY}"},
+                timeout=5.0
+            )
+            served = {m.get("id") for m in models.json().get("data", [])} if models.status_code == 200 else set()
+            healthy = health.status_code == 200 and TARGET_MODEL_NAME in served
+        except (httpx.HTTPError, ValueError):
+            healthy = False
+        except Exception:
+            # 意料之外的错误 (如 /v1/models 返回的不是对象) 同样视为不健康，不能让健康检查任务退出
+            logger.exception("❌ 副本 %s 健康检查异常", backend.base_url)
+            healthy = False
+        if healthy != backend.healthy:
+            if healthy:
+                logger.info("✅ 副本 %s 健康检查恢复", backend.base_url)
+            else:
+                logger.warning("❌ 副本 %s 健康检查失败", backend.base_url)
+        backend.healthy = healthy
+        if healthy and backend.ejected_until and time.monotonic() >= backend.ejected_until and not backend.outstanding:
+            backend.consecutive_failures = 0
+            backend.ejected_until = 0.0
+    
+    async def health_check_loop(self):
+        while True:
+            await asyncio.gather(*(self.check(b) for b in self.backends))
+            await asyncio.sleep(UPSTREAM_HEALTH_INTERVAL)
+    
+    def stats(self):
+        routed = self.affinity_stats["hits"] + self.affinity_stats["misses"]
+        outstanding = sum(b.outstanding for b in self.backends)
+        return {
+            "backends": [b.stats() for b in self.backends],
+            "transport": {
+                **self.transport_stats,
+                "outstanding": outstanding,
+                # 中间件自己的在途请求数 / 连接数上限，不是连接池的实际占用 (见 connection_pool)
+                "inflight_ratio": round(outstanding / UPSTREAM_MAX_CONNECTIONS, 4),
+                "connection_pool": connection_pool_stats(),
+            },
+            "prefix_affinity": {
+                **self.affinity_stats,
+                "hit_rate": round(self.affinity_stats["hits"] / routed, 4) if routed else 0.0,
+                "tracked_prefixes": len(self.prefix_routes),
+            },
+        }
+
+upstream_pool = UpstreamPool(VLLM_API_BASES, UPSTREAM_BALANCE, UPSTREAM_PREFIX_AFFINITY)
+
+class UpstreamUnavailable(Exception):
+    """所有副本都处于熔断状态，快速失败而不是等待超时"""
+    
+    def __init__(self, retry_after):
+        super().__init__(f"All vLLM upstreams are unavailable, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class UpstreamFirstByteTimeout(httpx.TimeoutException):
+    """在 UPSTREAM_FIRST_BYTE_TIMEOUT 内没有收到响应头"""
+
+# 请求尚未被 vLLM 处理的失败，换副本重试是安全的
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, UpstreamFirstByteTimeout)
+
+async def send_upstream(openai_req, request_tokens, prefix_key=None, prompt_tokens=0):
+    """
+    选择副本并以流式方式打开 /chat/completions 请求 (调用方负责读取响应并 release 副本)
+    可重试的失败换副本重试，退避时间为 [0, BACKOFF * 2^n) 内的随机值，避免多个请求同时重连
+    返回 (backend, response)
+    """
+    stats = upstream_pool.transport_stats
+    tried = []
+    # 只编码一次，重试时复用同一份 body
+    content = json_dumps(openai_req)
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        # 亲和命中每个请求只统计一次: 故障转移的重试不再计入命中率
+        backend = upstream_pool.acquire(request_tokens, exclude=tried, prefix_key=prefix_key, prompt_tokens=prompt_tokens, record=not tried)
+        if backend is None and tried:
+            # 其他副本均不可用时允许重试同一个副本
+            backend = upstream_pool.acquire(request_tokens)
+        if backend is None:
+            stats["fast_failures"] += 1
+            raise UpstreamUnavailable(upstream_pool.retry_after())
+        request = client.build_request(
+            "POST",
+            f"{backend.base_url}/chat/completions",
+            content=content,
+            # 透传 request_id: vLLM (--enable-request-id-headers) 与压测用的 fake_vllm.py 日志可按它关联
+            headers={"Authorization": f"Bearer {VLLM_API_KEY}", "Content-Type": "application/json",
+                     "X-Request-Id": request_id_var.get()}
+        )
+        handed_off = False
+        # 只有 HTTP 层的失败计入副本熔断；客户端断开导致的取消与本地异常与副本健康无关
+        healthy = True
+        try:
+            timeout = UPSTREAM_FIRST_BYTE_TIMEOUT if openai_req.get("stream") else None
+            try:
+                response = await asyncio.wait_for(client.send(request, stream=True), timeout)
+            except asyncio.TimeoutError:
+                stats["first_byte_timeouts"] += 1
+                raise UpstreamFirstByteTimeout(f"No response headers within {UPSTREAM_FIRST_BYTE_TIMEOUT}s", request=request)
+            handed_off = True
+            return backend, response
+        except httpx.HTTPError as e:
+            healthy = False
+            if not isinstance(e, RETRYABLE_ERRORS):
+                raise
+            stats["connect_errors"] += not isinstance(e, UpstreamFirstByteTimeout)
+            if attempt == UPSTREAM_RETRIES:
+                raise
+            error = e
+        finally:
+            # 响应交给调用方之前的任何退出路径 (包括意外异常) 都释放副本
+            if not handed_off:
+                upstream_pool.release(backend, request_tokens, ok=healthy)
+        tried.append(backend)
+        stats["retries"] += 1
+        delay = random.uniform(0, UPSTREAM_RETRY_BACKOFF * 2 ** attempt)
+        logger.warning("🔁 副本 %s 请求失败 (%r)，%.2fs 后重试 (%d/%d)", backend.base_url, error, delay, attempt + 1, UPSTREAM_RETRIES)
+        await asyncio.sleep(delay)
+
+# ================= 客户端断开检测 =================
+class ClientDisconnected(Exception):
+    """等待 vLLM 期间客户端断开了连接"""
+
+cancellation_stats = {"cancelled_requests": 0, "cancelled_streams": 0, "cancelled_while_queued": 0, "gpu_seconds_saved": 0.0}
+
+def record_cancellation(max_tokens, generated_tokens, elapsed, stream=False):
+    """
+    记录一次因客户端断开而中止的生成
+    节省的 GPU 时间按 max_tokens 的剩余量 / 解码速度估算 (上限估计，模型可能提前结束)
+    """
+    rate = generated_tokens / elapsed if generated_tokens and elapsed > 0 else ESTIMATED_DECODE_TOKENS_PER_SECOND
+    remaining = max(0, max_tokens - generated_tokens)
+    if not generated_tokens:
+        # 非流式请求不知道已生成多少，扣除已等待的时间
+        saved = max(0.0, max_tokens / rate - elapsed)
+    else:
+        saved = remaining / rate
+    cancellation_stats["cancelled_streams" if stream else "cancelled_requests"] += 1
+    cancellation_stats["gpu_seconds_saved"] += saved
+    logger.info("🔌 客户端已断开，已取消 vLLM 生成 (已运行 %.1fs，估计节省 %.1f GPU 秒)", elapsed, saved)
+
+async def cancel_on_disconnect(request, awaitable, keep_alive=None):
+    """
+    等待 awaitable 的同时轮询客户端连接，断开时取消它并抛出 ClientDisconnected
+    keep_alive(): 客户端断开后仍返回 True 时继续等待 (在途请求合并: 还有相同请求在等待结果)
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await request.is_disconnected() and not (keep_alive and keep_alive()):
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+
+# ================= 流量录制 =================
+# 录制的是中间件的输入 (Claude 请求体) 与 vLLM 的原始输出 (流式时保留 chunk 边界)，
+# 回放时可以离线重跑转换与解析，也可以由 fake_vllm.py 原样返回给中间件
+CAPTURE_FORMAT_VERSION = 1
+# 匿名化时保留的词: 工具调用标记、各种工具调用形态的键名与 JSON / Python 字面量
+CAPTURE_KEEP_WORDS = frozenset({
+    "tool_call", "tool_code", "json", "name", "arguments", "function", "parameters", "tool",
+    "true", "false", "null", "True", "False", "None",
+})
+# 这些字段的值是协议枚举或 ID，不含用户内容，原样保留
+CAPTURE_KEEP_FIELDS = frozenset({"type", "role", "model", "id", "tool_use_id", "media_type", "stream", "max_tokens"})
+# \uXXXX 转义换成固定字符，其他转义原样保留，避免把合法的 JSON 文本改坏
+_CAPTURE_WORD_RE = re.compile(r"\\u[0-9a-fA-F]{4}|\\.|\w+")
+_CAPTURE_MASK_TABLE = str.maketrans(
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789",
+    "x" * 26 + "X" * 26 + "1" * 10,
+)
+_CAPTURE_NON_ASCII_RE = re.compile(r"[^\x00-\x7f]")
+
+def _schema_words(schema, words):
+    """收集 JSON Schema 中的参数名 (properties 的键)"""
+    if isinstance(schema, dict):
+        for key, value in schema.items():
+            if key == "properties" and isinstance(value, dict):
+                words.update(value)
+            _schema_words(value, words)
+    elif isinstance(schema, list):
+        for item in schema:
+            _schema_words(item, words)
+
+@functools.lru_cache(maxsize=1)
+def _tool_rule_words():
+    """参数修复规则中的工具名与参数别名: 匿名化后仍需被规则识别，修复结果才与原始流量一致"""
+    words = set(TOOL_ARG_RULES)
+    for rule in [DEFAULT_TOOL_ARG_RULE, *TOOL_ARG_RULES.values()]:
+        words.update(word for pair in rule.renames + rule.listify for word in pair)
+        words.update(rule.coerce)
+        words.update(word for word in (rule.wrap_list, rule.wrap_string) if word)
+        if rule.wrap_item:
+            words.update((rule.wrap_item["when_key"], rule.wrap_item["into"]))
+        words.update(rule.wrap_extra)
+        for field, defaults in rule.item_defaults.items():
+            words.add(field)
+            words.update(defaults)
+    return frozenset(words)
+
+def anonymize_text(text, keep):
+    """逐词替换: 保留 keep 中的词，其余字母 -> x/X、数字 -> 1、非 ASCII 字符 -> 中"""
+    def mask(match):
+        word = match.group(0)
+        if word.startswith("\\"):
+            return "\\u4e2d" if word.startswith("\\u") else word
+        if word in keep:
+            return word
+        return _CAPTURE_NON_ASCII_RE.sub("中", word.translate(_CAPTURE_MASK_TABLE))
+    return _CAPTURE_WORD_RE.sub(mask, text)
+
+def anonymize_value(value, keep):
+    if isinstance(value, str):
+        return anonymize_text(value, keep)
+    if isinstance(value, dict):
+        return {k: v if k in CAPTURE_KEEP_FIELDS else anonymize_value(v, keep) for k, v in value.items()}
+    if isinstance(value, list):
+        return [anonymize_value(v, keep) for v in value]
+    return value
+
+def anonymize_capture(record):
+    """匿名化一条录制记录: 请求与模型输出使用同一份保留词表 (工具名 + 参数名 + 修复规则中的别名)"""
+    keep = set(CAPTURE_KEEP_WORDS) | _tool_rule_words()
+    for tool in record["request"].get("tools") or []:
+        if isinstance(tool, dict):
+            keep.add(tool.get("name"))
+            _schema_words(tool.get("input_schema"), keep)
+    upstream = record["upstream"]
+    # 拼接后整体替换再按原边界切回，避免跨 chunk 的词 (如 <tool_call>) 被拆开替换
+    masked = anonymize_text("".join(upstream["chunks"]), keep)
+    chunks, pos = [], 0
+    for chunk in upstream["chunks"]:
+        chunks.append(masked[pos:pos + len(chunk)])
+        pos += len(chunk)
+    upstream = {**upstream, "chunks": chunks}
+    if upstream.get("tool_calls"):
+        # native 模式的结构化工具调用: 参数为 JSON 字符串，键名 (参数名) 在保留词表中，结构不变
+        upstream["tool_calls"] = [
+            {**call, "function": {**call["function"], "arguments": anonymize_text(call["function"]["arguments"], keep)}}
+            for call in upstream["tool_calls"]
+        ]
+    return {**record, "anonymized": True, "request": anonymize_value(record["request"], keep), "upstream": upstream}
+
+class TrafficRecorder:
+    """
+    按比例录制请求与 vLLM 输出
+    匿名化、序列化与压缩都在后台线程完成，请求路径上只做一次入队；队列满时丢弃
+    """
+    def __init__(self, path, sample_rate=1.0, anonymize=True, max_record_bytes=CAPTURE_MAX_RECORD_BYTES,
+                 max_file_bytes=CAPTURE_MAX_FILE_BYTES, queue_size=CAPTURE_QUEUE_SIZE):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.anonymize = anonymize
+        self.max_record_bytes = max_record_bytes
+        self.max_file_bytes = max_file_bytes
+        self.queue = queue.Queue(queue_size)
+        self.thread = None
+        self.full = False
+        self.bytes_written = 0
+        self.stats_counts = {"recorded": 0, "dropped_queue_full": 0, "skipped_oversize": 0, "errors": 0}
+    
+    @property
+    def enabled(self):
+        return self.path is not None and not self.full
+    
+    def sampled(self):
+        """本次请求是否录制 (请求开始时决定一次)"""
+        return self.enabled and random.random() < self.sample_rate
+    
+    def submit(self, record):
+        if not self.enabled:
+            return
+        if self.thread is None:
+            # 首次录制时才启动线程: 多进程模式下位于工作进程内，文件名带上 pid
+            if WORKERS > 1:
+                self.path = f"{self.path}.{os.getpid()}"
+            self.thread = threading.Thread(target=self._run, name="traffic-recorder", daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.stats_counts["dropped_queue_full"] += 1
+    
+    def _run(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 追加模式: 每次启动写入新的 gzip member，gzip 模块可以连续读出
+        with gzip.open(self.path, "ab") as f:
+            dirty = False
+            while True:
+                try:
+                    record = self.queue.get(timeout=1.0)
+                except queue.Empty:
+                    if dirty:
+                        f.flush()
+                        dirty = False
+                    continue
+                if record is None:
+                    return
+                try:
+                    dirty |= self._write(f, record)
+                except Exception as e:
+                    self.stats_counts["errors"] += 1
+                    logger.warning("⚠️ 流量录制写入失败: %s", e)
+    
+    def _write(self, f, record):
+        if self.anonymize:
+            record = anonymize_capture(record)
+        line = json_dumps(record) + b"\n"
+        if len(line) > self.max_record_bytes:
+            self.stats_counts["skipped_oversize"] += 1
+            return False
+        if self.bytes_written + len(line) > self.max_file_bytes:
+            self.full = True
+            logger.warning("⚠️ 流量录制文件已达上限 (%d MB)，停止录制", self.max_file_bytes // (1024 * 1024))
+            return False
+        f.write(line)
+        self.bytes_written += len(line)
+        self.stats_counts["recorded"] += 1
+        return True
+    
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=10)
+    
+    def stats(self):
+        return {
+            "enabled": self.path is not None,
+            "path": self.path,
+            "full": self.full,
+            "bytes_written": self.bytes_written,
+            "queue_depth": self.queue.qsize(),
+            **self.stats_counts,
+        }
+
+traffic_recorder = TrafficRecorder(
+    CAPTURE_PATH, CAPTURE_SAMPLE_RATE, CAPTURE_ANONYMIZE, CAPTURE_MAX_RECORD_BYTES, CAPTURE_MAX_FILE_BYTES, CAPTURE_QUEUE_SIZE
+)
+
+def capture_exchange(body, request_id, stream, upstream):
+    """
+    提交一条录制记录
+    upstream: {"chunks": [content 片段], "tool_calls" (仅 native 模式), "finish_reason", "usage", "ttfb_seconds", "seconds"}
+    """
+    traffic_recorder.submit({
+        "v": CAPTURE_FORMAT_VERSION,
+        "ts": round(time.time(), 3),
+        "request_id": request_id,
+        "stream": stream,
+        "anonymized": False,
+        "request": body,
+        "upstream": upstream,
+    })
+
+# ================= 响应缓存 =================
+def is_deterministic(openai_req):
+    """贪心解码 (temperature 为 0) 时相同请求的输出相同，才可以缓存"""
+    return openai_req.get("temperature") == 0
+
+def response_cache_key(openai_req, raw_tools):
+    """
+    按转换后的 OpenAI 请求 (键排序的规范化 JSON) 计算缓存键；stream 相关字段不参与，流式与非流式共用
+    原始工具定义决定参数修复结果，一并计入 (工具定义压缩时 Prompt 相同不代表 schema 相同)
+    """
+    request = {k: v for k, v in openai_req.items() if k not in ("stream", "stream_options")}
+    material = {"request": request, "tools": raw_tools}
+    if orjson is not None:
+        data = orjson.dumps(material, option=orjson.OPT_SORT_KEYS)
+    else:
+        data = json.dumps(material, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+def normalized_output(upstream):
+    """流量录制格式的 vLLM 输出 {"chunks", "tool_calls", ...} -> {"content", "tool_calls", "finish_reason", "usage"}"""
+    return {
+        "content": "".join(upstream["chunks"]),
+        "tool_calls": upstream.get("tool_calls"),
+        "finish_reason": upstream["finish_reason"],
+        "usage": upstream.get("usage"),
+    }
+
+class ResponseCache:
+    """
+    确定性请求的响应缓存: 内存 LRU (按条目数与字节数淘汰) + 可选的磁盘层 (多进程共享，按总大小淘汰最旧的条目)
+    缓存的是归一化后的 vLLM 输出 {"content", "tool_calls", "finish_reason", "usage"}，命中后按正常流程解析工具调用并转换为 Claude 响应
+    """
+    def __init__(self, enabled, ttl, max_entries, max_bytes, directory=None, disk_max_bytes=0):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.memory = LRUCache(max_entries, max_bytes=max_bytes, sizeof=lambda item: item[1])
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_bytes = None  # 首次写入时扫描目录得到
+        self.stats_counts = {"hits_memory": 0, "hits_disk": 0, "misses": 0, "bypassed": 0, "stores": 0, "expired": 0, "disk_errors": 0}
+        self.lock = threading.Lock()  # 磁盘读写在线程池中执行，计数与 disk_bytes 的更新需要加锁
+    
+    def count(self, name):
+        with self.lock:
+            self.stats_counts[name] += 1
+    
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+    
+    async def get(self, key):
+        item = self.memory.get(key)
+        if item is not None:
+            expires, _, value = item
+            if time.time() < expires:
+                self.count("hits_memory")
+                return value
+            self.memory.pop(key)
+            self.count("expired")
+        if self.directory:
+            item = await asyncio.to_thread(self._read_disk, key)
+            if item is not None:
+                expires, size, value = item
+                self.memory.put(key, (expires, size, value))
+                self.count("hits_disk")
+                return value
+        self.count("misses")
+        return None
+    
+    def put(self, key, upstream):
+        """upstream: {"chunks": [content 片段], "tool_calls", "finish_reason", "usage"} (与流量录制的格式相同)"""
+        if not upstream.get("finish_reason"):
+            return  # 不完整的输出不缓存
+        value = normalized_output(upstream)
+        data = json_dumps({"expires": time.time() + self.ttl, "value": value})
+        self.memory.put(key, (time.time() + self.ttl, len(data), value))
+        self.count("stores")
+        if self.directory:
+            # 磁盘写入交给线程池，不阻塞事件循环
+            asyncio.get_running_loop().run_in_executor(None, self._write_disk, key, data)
+    
+    def _read_disk(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            entry = json_loads(data)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.count("disk_errors")
+            logger.warning("⚠️ 响应缓存读取失败 %s: %s", path, e)
+            return None
+        try:
+            expires, value = float(entry["expires"]), entry["value"]
+            if not isinstance(value, dict):
+                raise TypeError(type(value).__name__)
+        except (KeyError, TypeError, ValueError) as e:
+            # 格式不对的条目 (其他版本写入或被截断) 按未命中处理并删除
+            self.count("disk_errors")
+            logger.warning("⚠️ 响应缓存条目无效，已删除 %s: %r", path, e)
+            self._remove_disk(path, len(data))
+            return None
+        if time.time() >= expires:
+            self.count("expired")
+            self._remove_disk(path, len(data))
+            return None
+        return expires, len(data), value
+    
+    def _remove_disk(self, path, size):
+        with contextlib.suppress(OSError):
+            os.remove(path)
+            with self.lock:
+                if self.disk_bytes is not None:
+                    self.disk_bytes = max(0, self.disk_bytes - size)
+    
+    def _write_disk(self, key, data):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(key)
+            # 先写临时文件再改名，其他进程不会读到写了一半的条目
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            with self.lock:
+                if self.disk_bytes is None:
+                    self.disk_bytes = sum(e.stat().st_size for e in os.scandir(self.directory) if e.name.endswith(".json"))
+                # 覆盖已有条目时先扣掉旧文件的大小
+                with contextlib.suppress(FileNotFoundError):
+                    self.disk_bytes -= os.stat(path).st_size
+                os.replace(tmp_path, path)
+                self.disk_bytes += len(data)
+                if self.disk_bytes > self.disk_max_bytes:
+                    self._evict_disk()
+        except OSError as e:
+            self.count("disk_errors")
+            logger.warning("⚠️ 响应缓存写入失败: %s", e)
+    
+    def _evict_disk(self):
+        """按修改时间删除最旧的条目，直到总大小降到上限的 90%"""
+        entries = sorted(
+            (e.stat().st_mtime, e.stat().st_size, e.path) for e in os.scandir(self.directory) if e.name.endswith(".json")
+        )
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.disk_max_bytes * 0.9:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+                total -= size
+        self.disk_bytes = total
+    
+    def stats(self):
+        with self.lock:
+            counts = dict(self.stats_counts)
+            disk_bytes = self.disk_bytes
+        hits = counts["hits_memory"] + counts["hits_disk"]
+        lookups = hits + counts["misses"]
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.memory),
+            "bytes": self.memory.bytes,
+            "disk_bytes": disk_bytes,
+            **counts,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        }
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_DIR, RESPONSE_CACHE_DISK_MAX_BYTES
+)
+
+# ================= 在途请求合并 =================
+class InflightRequest:
+    """一个在途的确定性请求 (leader)；相同请求 (follower) 订阅它的输出或等待它的结果，不再访问 vLLM"""
+    def __init__(self, key, stream, request_id):
+        loop = asyncio.get_running_loop()
+        self.key = key
+        self.stream = stream
+        self.request_id = request_id
+        self.handoff = loop.create_future()    # 流式 leader 开始输出 (True) 或在此之前失败 (False)
+        self.result = loop.create_future()     # 完整的 vLLM 输出 (归一化格式，与响应缓存相同)，失败时为 None
+        self.events = []                       # 流式 leader 已输出的 Claude SSE 事件
+        self.changed = asyncio.Event()
+        self.done = False
+        self.error = None
+        self.task = None                       # 流式: 读取 vLLM 并广播事件的后台任务
+        self.leader_attached = True
+        self.followers = 0
+    
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+class InflightRequests:
+    """
+    在途请求合并: 按规范化哈希登记在途的确定性请求，相同请求到达时挂到已有请求上
+    流式 leader 的输出由后台任务读取并缓存为 SSE 事件，leader 与流式 follower 都从中订阅，
+    leader 断开后只要还有 follower 就继续生成；非流式 follower (或 leader 为非流式时) 等待完整结果
+    """
+    def __init__(self, enabled, max_waiters):
+        self.enabled = enabled
+        self.max_waiters = max_waiters
+        self.flights = {}
+        self.stats_counts = {"leaders": 0, "coalesced": 0, "waiter_limit": 0, "leader_failures": 0}
+    
+    def get(self, key):
+        """可以挂靠的在途请求；等待者已满时返回 None (调用方照常访问 vLLM)"""
+        flight = self.flights.get(key)
+        if flight is not None and flight.followers >= self.max_waiters:
+            self.stats_counts["waiter_limit"] += 1
+            return None
+        return flight
+    
+    def lead(self, key, stream, request_id):
+        """登记为 leader；已有相同的在途请求 (等待者已满) 时返回 None"""
+        if key in self.flights:
+            return None
+        flight = self.flights[key] = InflightRequest(key, stream, request_id)
+        self.stats_counts["leaders"] += 1
+        return flight
+    
+    def finish(self, flight, upstream_result):
+        """leader 拿到完整输出: 唤醒等待结果的 follower，之后到达的相同请求不再挂靠"""
+        if not flight.result.done() and upstream_result.get("finish_reason"):
+            flight.result.set_result(normalized_output(upstream_result))
+        self.abandon(flight)
+    
+    def abandon(self, flight):
+        """leader 结束 (可重复调用); 未拿到结果时等待中的 follower 收到 None，各自访问 vLLM"""
+        if not flight.handoff.done():
+            flight.handoff.set_result(False)
+        if not flight.result.done():
+            flight.result.set_result(None)
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+    
+    def detach(self, flight, leader=False):
+        """客户端离开 (订阅由响应的 on_close 调用); leader 与所有 follower 都离开且输出未结束时取消生成 (上游连接随之关闭)"""
+        if leader:
+            if not flight.leader_attached:
+                return
+            flight.leader_attached = False
+        else:
+            flight.followers -= 1
+        if not flight.leader_attached and not flight.followers and flight.task and not flight.done:
+            self.abandon(flight)    # 之后到达的相同请求不再挂到被取消的请求上
+            flight.task.cancel()
+    
+    def broadcast(self, flight, events, on_close):
+        """流式 leader: 后台读取 events 并缓存，返回 leader 自己的订阅；on_close 在后台任务结束时一定会被调用 (释放上游)"""
+        flight.task = asyncio.create_task(self._pump(flight, events, on_close))
+        flight.task.add_done_callback(lambda _: self.abandon(flight))
+        flight.handoff.set_result(True)
+        return self.subscribe(flight)
+    
+    async def _pump(self, flight, events, on_close):
+        try:
+            async for event in events:
+                flight.events.append(event)
+                flight.notify()
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            flight.notify()
+            with contextlib.suppress(Exception):
+                await events.aclose()
+            await on_close()
+    
+    async def subscribe(self, flight):
+        """从头输出流式 leader 的 SSE 事件，跟上后等待新事件；上游出错时把错误抛给客户端"""
+        index = 0
+        while True:
+            changed = flight.changed
+            while index < len(flight.events):
+                yield flight.events[index]
+                index += 1
+            if flight.done:
+                if flight.error is not None:
+                    raise flight.error
+                return
+            await changed.wait()
+    
+    async def follow(self, request, flight, stream):
+        """
+        挂到在途请求上: 返回 ("events", SSE 生成器) 或 ("result", vLLM 输出)；
+        leader 在输出之前失败时返回 None，由调用方自己访问 vLLM
+        """
+        flight.followers += 1
+        self.stats_counts["coalesced"] += 1
+        try:
+            if stream and flight.stream:
+                if await cancel_on_disconnect(request, asyncio.shield(flight.handoff)):
+                    return "events", self.subscribe(flight)    # 响应结束时由 on_close detach
+            else:
+                result = await cancel_on_disconnect(request, asyncio.shield(flight.result))
+                if result is not None:
+                    self.detach(flight)
+                    return "result", result
+        except ClientDisconnected:
+            self.detach(flight)
+            raise
+        self.detach(flight)
+        self.stats_counts["coalesced"] -= 1
+        self.stats_counts["leader_failures"] += 1
+        return None
+    
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "max_waiters": self.max_waiters,
+            "inflight": len(self.flights),
+            "waiters": sum(f.followers for f in self.flights.values()),
+            **self.stats_counts,
+        }
+
+inflight_requests = InflightRequests(SINGLE_FLIGHT_ENABLED, SINGLE_FLIGHT_MAX_WAITERS)
+
+# ================= 准入控制 =================
+class AdmissionRejected(Exception):
+    """等待队列已满或排队超时"""
+    
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """
+    按在途请求数与在途 Token 预算放行请求，超出部分在有界队列中等待
+    队列按 (优先级降序, 到达顺序) 排列；队首放不下时后面的请求也不插队，避免大请求饿死
+    """
+    
+    def __init__(self, max_requests, token_budget, queue_size):
+        self.max_requests = max_requests
+        self.token_budget = token_budget
+        self.queue_size = queue_size
+        self.inflight_requests = 0
+        self.inflight_tokens = 0
+        self.queue = []     # 堆: (-priority, seq, tokens, future)
+        self.seq = 0
+        self.service_time = 10.0    # 请求耗时的指数滑动平均，用于估算 retry-after
+        self.stats_counters = {"admitted": 0, "queued": 0, "rejected": 0, "timeouts": 0, "total_wait_ms": 0.0, "max_wait_ms": 0.0}
+    
+    def fits(self, tokens):
+        if self.inflight_requests == 0:
+            # 单个请求超出预算时也要能执行，否则会永远排队
+            return True
+        return self.inflight_requests < self.max_requests and self.inflight_tokens + tokens <= self.token_budget
+    
+    def retry_after(self):
+        return max(1, math.ceil(self.service_time * (len(self.queue) + 1) / self.max_requests))
+    
+    def admit(self, tokens):
+        self.inflight_requests += 1
+        self.inflight_tokens += tokens
+        self.stats_counters["admitted"] += 1
+    
+    async def acquire(self, tokens, priority=0):
+        """放行时返回排队等待的秒数；队列满或排队超时抛出 AdmissionRejected"""
+        if not self.queue and self.fits(tokens):
+            self.admit(tokens)
+            return 0.0
+        if len(self.queue) >= self.queue_size:
+            self.stats_counters["rejected"] += 1
+            raise AdmissionRejected(f"Request queue is full ({len(self.queue)} waiting)", self.retry_after())
+        
+        future = asyncio.get_running_loop().create_future()
+        self.seq += 1
+        entry = (-priority, self.seq, tokens, future)
+        heapq.heappush(self.queue, entry)
+        self.stats_counters["queued"] += 1
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), ADMISSION_QUEUE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # 超时/取消与放行同时发生: 已经计入在途，交还名额
+                self.release(tokens)
+            else:
+                future.cancel()
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.stats_counters["timeouts"] += 1
+            raise AdmissionRejected(f"Request waited more than {ADMISSION_QUEUE_TIMEOUT}s in queue", self.retry_after())
+        waited = time.monotonic() - start
+        self.stats_counters["total_wait_ms"] += waited * 1000
+        self.stats_counters["max_wait_ms"] = max(self.stats_counters["max_wait_ms"], waited * 1000)
+        return waited
+    
+    def release(self, tokens, elapsed=None):
+        self.inflight_requests -= 1
+        self.inflight_tokens -= tokens
+        if elapsed is not None:
+            self.service_time = 0.9 * self.service_time + 0.1 * elapsed
+        # 按顺序放行队首能放下的请求
+        while self.queue and self.fits(self.queue[0][2]):
+            _, _, tokens, future = heapq.heappop(self.queue)
+            if future.done():
+                continue
+            self.admit(tokens)
+            future.set_result(None)
+    
+    def stats(self):
+        queued = self.stats_counters["queued"] - self.stats_counters["timeouts"]
+        return {
+            **self.stats_counters,
+            "inflight_requests": self.inflight_requests,
+            "inflight_tokens": self.inflight_tokens,
+            "queue_depth": len(self.queue),
+            "avg_wait_ms": round(self.stats_counters["total_wait_ms"] / queued, 1) if queued else 0.0,
+        }
+
+# 多进程模式下每个进程各自计数，上限按进程数平分
+admission = AdmissionController(
+    max(1, ADMISSION_MAX_INFLIGHT_REQUESTS // WORKERS),
+    max(1, ADMISSION_TOKEN_BUDGET // WORKERS),
+    max(1, ADMISSION_QUEUE_SIZE // WORKERS)
+)
+
+# ================= Token 计数 =================
+# Qwen ChatML 模板: <|im_start|>{role}\n{content}<|im_end|>\n，结尾追加 <|im_start|>assistant\n
+CHAT_TEMPLATE_TOKENS_PER_MESSAGE = 5
+CHAT_TEMPLATE_GENERATION_PROMPT_TOKENS = 3
+
+_tokenizer = None
+_tokenizer_failed = False
+token_cache = LRUCache(TOKEN_CACHE_SIZE)
+tool_prompt_cache = LRUCache(TOOL_PROMPT_CACHE_SIZE)
+tool_compaction_cache = LRUCache(TOOL_PROMPT_CACHE_SIZE)
+conversion_cache = LRUCache(CONVERSION_CACHE_SIZE, max_bytes=CONVERSION_CACHE_MAX_BYTES, sizeof=lambda text: 2 * len(text))
+
+def load_tokenizer():
+    """
+    加载本地分词器 (transformers 为可选依赖)，只读本地文件，不联网下载，也不执行模型仓库中的代码
+    服务启动时在线程中调用一次 (见 lifespan)，不在请求路径上阻塞事件循环
+    """
+    global _tokenizer, _tokenizer_failed
+    if _tokenizer is None and not _tokenizer_failed:
+        try:
+            from transformers import AutoTokenizer
+            _tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, local_files_only=True)
+            logger.info("🔤 已加载分词器: %s", TOKENIZER_PATH)
+        except Exception as e:
+            _tokenizer_failed = True
+            logger.warning("⚠️ 无法加载分词器 (%s): %s，Token 数改用字符估算", TOKENIZER_PATH, e)
+    return _tokenizer
+
+def get_tokenizer():
+    """已加载的分词器，不可用时返回 None；离线脚本 (没有运行中的事件循环) 首次调用时同步加载"""
+    if _tokenizer is None and not _tokenizer_failed:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return load_tokenizer()
+    return _tokenizer
+
+def count_text_tokens(text):
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return estimate_tokens(text)
+    return len(tokenizer.encode(text, add_special_tokens=False))
+
+def message_text(content):
+    """OpenAI 消息 content 可能是字符串或 [{type: text, text: ...}] 列表"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return ""
+
+def message_token_counts(openai_messages):
+    """
+    逐条计算消息的 Token 数 (含 ChatML 模板开销)
+    每条消息的结果按 (role, content) 哈希缓存，长会话只需对新增的消息分词
+    """
+    counts = []
+    for msg in openai_messages:
+        text = message_text(msg.get("content"))
+        if msg.get("tool_calls"):
+            # native 模式的历史工具调用: 按渲染后的 <tool_call> JSON 计数
+            text += "".join(f'{{"name": "{c["function"]["name"]}", "arguments": {c["function"]["arguments"]}}}' for c in msg["tool_calls"])
+        key = hashlib.blake2b(f"{msg.get('role')}\0{text}".encode("utf-8"), digest_size=16).digest()
+        tokens = token_cache.get(key)
+        if tokens is None:
+            tokens = count_text_tokens(text) + CHAT_TEMPLATE_TOKENS_PER_MESSAGE
+            token_cache.put(key, tokens)
+        counts.append(tokens)
+    return counts
+
+def count_prompt_tokens(openai_messages):
+    """计算发送给 vLLM 的 Prompt Token 数 (含注入的工具 Prompt 与 ChatML 模板开销)"""
+    return CHAT_TEMPLATE_GENERATION_PROMPT_TOKENS + sum(message_token_counts(openai_messages))
+
+def count_request_tokens(openai_req):
+    """
+    计算完整请求的 Prompt Token 数
+    native 模式下工具定义由 vLLM 的 chat template 渲染进 system，按内容相同的工具 Prompt 计入
+    """
+    tokens = count_prompt_tokens(openai_req["messages"])
+    if openai_req.get("tools"):
+        tokens += tool_definition_tokens([tool["function"] for tool in openai_req["tools"]])
+    return tokens
+
+def tool_definition_tokens(tools):
+    """工具定义 Prompt 的 Token 数 (不含消息模板开销)"""
+    tool_prompt = {"role": "system", "content": generate_tool_system_prompt(tools)}
+    return message_token_counts([tool_prompt])[0] - CHAT_TEMPLATE_TOKENS_PER_MESSAGE
+
+# ================= 工具参数修复规则 =================
+class ToolArgRule:
+    """
+    编译后的单个工具参数修复规则 (由 tool_arg_rules.json 生成)
+    依次执行: 包装 (wrap_list / wrap_string / wrap_item) -> 重命名 -> 包装为列表 -> 类型转换 -> 列表项缺省字段
+    """
+    __slots__ = ("renames", "listify", "coerce", "wrap_list", "wrap_string", "wrap_item", "wrap_extra", "item_defaults")
+    
+    def __init__(self, spec):
+        self.renames = [(src, dst) for src, dst in spec.get("renames", {}).items() if dst]
+        self.listify = list(spec.get("listify", {}).items())
+        self.coerce = dict(spec.get("coerce", {}))
+        self.wrap_list = spec.get("wrap_list")
+        self.wrap_string = spec.get("wrap_string")
+        self.wrap_item = spec.get("wrap_item")
+        self.wrap_extra = dict(spec.get("wrap_extra", {}))
+        self.item_defaults = dict(spec.get("item_defaults", {}))
+    
+    def is_empty(self):
+        return not (self.renames or self.listify or self.coerce or self.wrap_list
+                    or self.wrap_string or self.wrap_item or self.item_defaults)
+    
+    def stream_fixes(self):
+        """
+        只含顶层键重命名与类型转换的规则可在流式输出中边生成边修复 (类型转换在值闭合时进行)
+        返回 (重命名表, 类型转换表)；None 表示需要缓冲后整体修复
+        """
+        if self.listify or self.wrap_list or self.wrap_string or self.wrap_item or self.item_defaults:
+            return None
+        if self.coerce.keys() & {key for pair in self.renames for key in pair}:
+            # 别名是否重命名要到对象结束才确定，其值该按哪个键转换也要等到那时
+            return None
+        return dict(self.renames), self.coerce
+    
+    def for_schema(self, schema):
+        """
+        按请求中工具的 input_schema 裁剪规则: 只保留目标字段存在于 schema 的修复，
+        并根据 schema 中的 integer/number/boolean 字段自动补充类型转换。规则为空时返回 None
+        """
+        props = (schema or {}).get("properties")
+        if not isinstance(props, dict):
+            return None if self.is_empty() else self
+        rule = ToolArgRule({})
+        rule.renames = [(src, dst) for src, dst in self.renames if dst in props and src not in props]
+        rule.listify = [(src, dst) for src, dst in self.listify if dst in props and src not in props]
+        rule.coerce = {key: kind for key, kind in self.coerce.items() if key in props}
+        for key, prop in props.items():
+            if isinstance(prop, dict) and prop.get("type") in _COERCERS:
+                rule.coerce[key] = prop["type"]
+        rule.wrap_list = self.wrap_list if self.wrap_list in props else None
+        rule.wrap_string = self.wrap_string if self.wrap_string in props else None
+        rule.wrap_item = self.wrap_item if self.wrap_item and self.wrap_item["into"] in props else None
+        rule.wrap_extra = {key: value for key, value in self.wrap_extra.items() if key in props}
+        rule.item_defaults = {key: value for key, value in self.item_defaults.items() if key in props}
+        return None if rule.is_empty() else rule
+    
+    def apply(self, args):
+        """修复参数，返回 (修复后的参数, 修复说明列表)"""
+        fixes = []
+        if isinstance(args, list) and self.wrap_list:
+            args = {self.wrap_list: args, **self.wrap_extra}
+            fixes.append(f"list->{self.wrap_list}")
+        elif isinstance(args, str) and self.wrap_string:
+            args = {self.wrap_string: args}
+            fixes.append(f"str->{self.wrap_string}")
+        elif (isinstance(args, dict) and self.wrap_item
+              and self.wrap_item["into"] not in args and self.wrap_item["when_key"] in args):
+            args = {self.wrap_item["into"]: [args], **self.wrap_extra}
+            fixes.append(f"item->{self.wrap_item['into']}")
+        if not isinstance(args, dict):
+            return args, fixes
+        
+        for src, dst in self.renames:
+            if src in args and dst not in args:
+                args[dst] = args.pop(src)
+                fixes.append(f"{src}->{dst}")
+        for src, dst in self.listify:
+            if src in args and dst not in args:
+                args[dst] = [args.pop(src)]
+                fixes.append(f"{src}->[{dst}]")
+        for key, kind in self.coerce.items():
+            value = args.get(key)
+            if isinstance(value, str):
+                try:
+                    args[key] = _COERCERS[kind](value)
+                    fixes.append(f"{key}:{kind}")
+                except ValueError:
+                    pass
+        for field, defaults in self.item_defaults.items():
+            items = args.get(field)
+            if not isinstance(items, list):
+                continue
+            for idx, item in enumerate(items):
+                if not isinstance(item, dict):
+                    continue
+                for key, value in defaults.items():
+                    if key not in item:
+                        item[key] = f"todo_{int(time.time())}_{idx}" if value == "$auto_id" else value
+                        fixes.append(f"{field}[{idx}].{key}")
+        return args, fixes
+
+def _coerce_bool(value):
+    lowered = value.strip().lower()
+    if lowered in ("true", "false"):
+        return lowered == "true"
+    raise ValueError(value)
+
+_COERCERS = {"integer": int, "number": float, "boolean": _coerce_bool}
+
+def load_tool_arg_rules(path=TOOL_ARG_RULES_PATH):
+    """加载并编译工具参数修复规则，返回 ({工具名: 规则}, 默认规则)"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        logger.warning("⚠️ 未找到工具参数修复规则文件: %s，跳过参数修复", path)
+        config = {}
+    
+    common = config.get("*", {})
+    registry = {}
+    for entry in config.get("tools", []):
+        # 工具规则继承共用规则，renames 合并 (值为 null 表示取消)
+        spec = {**common, **entry, "renames": {**common.get("renames", {}), **entry.get("renames", {})}}
+        rule = ToolArgRule(spec)
+        for name in entry["names"]:
+            registry[name] = rule
+    return registry, ToolArgRule(common)
+
+TOOL_ARG_RULES, DEFAULT_TOOL_ARG_RULE = load_tool_arg_rules()
+
+@functools.lru_cache(maxsize=256)
+def _rule_for_schema(name, shape):
+    schema = None if shape is None else {"properties": {key: {"type": kind} for key, kind in shape}}
+    return TOOL_ARG_RULES.get(name, DEFAULT_TOOL_ARG_RULE).for_schema(schema)
+
+def resolve_tool_arg_rules(tools):
+    """按本次请求的工具定义生成 {工具名: 规则或 None}，未受影响的工具为 None (零开销)"""
+    rules = {}
+    for tool in tools or []:
+        props = (tool.get("parameters") or {}).get("properties")
+        # 只有字段名与类型影响裁剪结果，用它们作为缓存键
+        shape = None
+        if isinstance(props, dict):
+            shape = tuple(sorted((key, prop.get("type") if isinstance(prop, dict) else None) for key, prop in props.items()))
+        rules[tool["name"]] = _rule_for_schema(tool["name"], shape)
+    return rules
+
+def get_tool_arg_rule(name, tool_rules=None):
+    """优先使用本次请求按 schema 裁剪后的规则，否则使用静态规则表"""
+    if tool_rules is not None and name in tool_rules:
+        return tool_rules[name]
+    return TOOL_ARG_RULES.get(name, DEFAULT_TOOL_ARG_RULE)
+
+def normalize_tool_arguments(name, args, tool_rules=None):
+    """针对特定工具修复模型输出的参数 (别名、包装、缺省字段、类型)"""
+    rule = get_tool_arg_rule(name, tool_rules)
+    if rule is None:
+        return args
+    args, fixes = rule.apply(args)
+    if fixes:
+        logger.info("⚠️ [%s] 参数修复: %s", name, ", ".join(fixes))
+    return args
+
+# ================= 工具调用提取 (单遍扫描) =================
+TOOL_TAGS = ("tool_call", "tool_code")
+# 直接在原文上匹配 (不搜索 lower() 后的副本: 部分字符小写后长度会变，下标对不上原文)
+TOOL_TAG_RE = re.compile(r"<(/?)(tool_call|tool_code)>", re.IGNORECASE)
+TOOL_CLOSE_TAG_RES = {tag: re.compile(f"</{tag}>", re.IGNORECASE) for tag in TOOL_TAGS}
+
+def scan_tool_call_blocks(content):
+    """
+    单遍扫描 (一次 finditer) 文本中的 <tool_call>/<tool_code> 标签 (大小写不敏感)
+    返回 (块列表 [(块起点, 块终点, 标签名, 内部文本)], 块外残留闭合标签的 [(起点, 终点)])
+    未闭合的块延伸到下一个开标签或文本末尾；块内另一种标签的闭合标签属于内部文本
+    """
+    blocks = []
+    strays = []
+    opened = None   # 当前块的开标签 match
+    for m in TOOL_TAG_RE.finditer(content):
+        closing = m.group(1)
+        if opened is None:
+            if closing:
+                strays.append(m.span())
+            else:
+                opened = m
+            continue
+        tag = opened.group(2).lower()
+        if not closing:
+            blocks.append((opened.start(), m.start(), tag, content[opened.end():m.start()]))
+            opened = m
+        elif m.group(2).lower() == tag:
+            blocks.append((opened.start(), m.end(), tag, content[opened.end():m.start()]))
+            opened = None
+    if opened is not None:
+        blocks.append((opened.start(), len(content), opened.group(2).lower(), content[opened.end():]))
+    return blocks, strays
+
+def iter_tool_call_blocks(content):
+    """逐个产出 (块起点, 块终点, 标签名, 内部文本)"""
+    return scan_tool_call_blocks(content)[0]
+
+def strip_tool_call_blocks(content, scan=None):
+    """移除文本中的工具调用块及残留的闭合标签，只保留思考文本；scan: 已有的 scan_tool_call_blocks 结果"""
+    blocks, strays = scan if scan is not None else scan_tool_call_blocks(content)
+    spans = sorted([(start, end) for start, end, _, _ in blocks] + strays)
+    parts = []
+    pos = 0
+    for start, end in spans:
+        parts.append(content[pos:start])
+        pos = end
+    parts.append(content[pos:])
+    return "".join(parts).strip()
+
+def strip_code_fence(text):
+    """去掉 ```json ... ``` 包裹"""
+    text = text.strip()
+    if text.startswith("```"):
+        line_end = text.find("\n")
+        if line_end != -1:
+            text = text[line_end + 1:]
+        else:
+            text = text[7:] if text[3:7].lower() == "json" else text[3:]
+    if text.endswith("```"):
+        text = text[:-3]
+    return text.strip()
 
-# 您的自定义模型名称 (在这里写死)
-TARGET_MODEL_NAME = "Qwen/Qwen3-235B-A22B-Instruct" 
+# 字符串体 (展开循环写法，C 层一次匹配完整个字符串，不会逐字符回溯)
+_STRING_BODY = {
+    '"': re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL),
+    "'": re.compile(r"[^'\\]*(?:\\.[^'\\]*)*", re.DOTALL),
+}
+_BRACE_SCAN = re.compile(r"""[{}"']""")
 
-# vLLM 的 API Key (在这里写死)
-VLLM_API_KEY = "empty"
+def find_json_object_span(text):
+    """
+    定位第一个平衡的 {...} 块 (忽略字符串内的括号，支持单/双引号字符串)
+    返回子串；括号未闭合 (输出被截断) 时返回从 { 到末尾的部分；没有 { 时返回 None
+    """
+    start = text.find("{")
+    if start == -1:
+        return None
+    depth = 0
+    i = start
+    n = len(text)
+    while i < n:
+        m = _BRACE_SCAN.search(text, i)
+        if not m:
+            break
+        ch = m.group()
+        i = m.end()
+        if ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i]
+        else:
+            # 跳过字符串
+            i = _STRING_BODY[ch].match(text, i).end() + 1
+    return text[start:]
 
-# 上下文限制 (80k)
-MAX_CONTEXT_TOKENS = 80000 
-# ===========================================
+_CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t"}
+_PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_ESCAPE_OR_DQUOTE = re.compile(r'(\\.)|"', re.DOTALL)
+_BAREWORD = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
 
-app = FastAPI()
-# trust_env=False: 禁止读取系统代理环境变量 (HTTP_PROXY 等)，确保请求直接发送给局域网/本地 vLLM
-client = httpx.AsyncClient(timeout=600.0, trust_env=False)
+def _repair_string_body(body, quote):
+    """把单/双引号字符串体转换为合法的 JSON 字符串体"""
+    # 字符串中的裸控制字符在 JSON 中非法，转义
+    for raw_char, escaped in _CONTROL_ESCAPES.items():
+        if raw_char in body:
+            body = body.replace(raw_char, escaped)
+    if "\\'" in body or (quote == "'" and '"' in body):
+        # \' 在 JSON 中非法，单引号字符串里的 " 需要转义
+        body = _ESCAPE_OR_DQUOTE.sub(
+            lambda m: ("'" if m.group(1) == "\\'" else m.group(1)) if m.group(1) else '\\"', body)
+    return body
 
-def estimate_tokens(text):
-    return len(text) // 3
+def repair_json(text):
+    """
+    单遍修复 Qwen 常见的非标准 JSON:
+    单引号字符串 / Python 字面量 (True/False/None) / 字符串中的裸换行 /
+    尾逗号 / 输出被截断导致的未闭合字符串与括号
+    """
+    out = []
+    stack = []
+    i = 0
+    n = len(text)
+    while i < n:
+        ch = text[i]
+        if ch == '"' or ch == "'":
+            end = _STRING_BODY[ch].match(text, i + 1).end()
+            out.append('"' + _repair_string_body(text[i + 1:end], ch) + '"')
+            i = end + 1
+            continue
+        if ch == ",":
+            j = i + 1
+            while j < n and text[j] in " \t\r\n":
+                j += 1
+            if j < n and text[j] in "}]":
+                i = j
+                continue
+        elif ch in "{[":
+            stack.append(ch)
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+        elif ch.isalpha() or ch == "_":
+            word = _BAREWORD.match(text, i).group()
+            out.append(_PY_LITERALS.get(word, word))
+            i += len(word)
+            continue
+        out.append(ch)
+        i += 1
+    # 截断: 去掉悬空的逗号/冒号后补全括号
+    while out and out[-1].strip() in (",", ":", ""):
+        if out[-1].strip() == ":":
+            out.append("null")
+            break
+        out.pop()
+    for opener in reversed(stack):
+        out.append("}" if opener == "{" else "]")
+    return "".join(out)
+
+def decode_tool_call_json(text):
+    """
+    按代价从低到高依次尝试: 严格 JSON -> 提取平衡的 {...} 块 -> 宽松修复
+    返回 (数据, 策略名)；策略名为 json / brace / lenient，失败时返回 (None, None)
+    """
+    try:
+        return json.loads(text), "json"
+    except json.JSONDecodeError:
+        pass
+    span = find_json_object_span(text)
+    if span is None:
+        return None, None
+    if span != text:
+        try:
+            return json.loads(span), "brace"
+        except json.JSONDecodeError:
+            pass
+    try:
+        return json.loads(repair_json(span)), "lenient"
+    except json.JSONDecodeError:
+        return None, None
 
-def parse_hermes_xml(content):
-    """尝试从文本中提取 Hermes 风格的 <tool_code> 或 Qwen 风格的 <tool_call> XML"""
+def parse_hermes_xml(content, tool_rules=None, blocks=None):
+    """
+    尝试从文本中提取 Hermes 风格的 <tool_code> 或 Qwen 风格的 <tool_call> XML
+    tool_rules: resolve_tool_arg_rules() 的结果，按本次请求的工具 schema 修复参数
+    blocks: 已有的 iter_tool_call_blocks 结果 (避免重复扫描)
+    返回 OpenAI 形状的 tool_calls，但 function.arguments 保持为解析后的对象 (不再转回 JSON 字符串)
+    """
     tool_calls = []
     
-    # 1. 统一标签: 将 <tool_call> 替换为 <tool_code> 以便统一处理，或者支持两种
-    # 我们支持两种标签：tool_code (Hermes) 和 tool_call (Qwen)
-    
-    # 匹配模式：支持 tool_code 或 tool_call
-    # Group 1: 标签名 (tool_code|tool_call)
-    # Group 2: 内容
-    pattern = r"<(tool_code|tool_call)>\s*(?:```json)?\s*(.*?)\s*(?:```)?\s*</\1>"
-    matches = re.findall(pattern, content, re.DOTALL | re.IGNORECASE)
-    
-    if not matches:
-        # 备用：尝试匹配未闭合的标签
-        pattern_lazy = r"<(tool_code|tool_call)>\s*(?:```json)?\s*(.*?)\s*(?:```)?\s*$"
-        matches = re.findall(pattern_lazy, content, re.DOTALL | re.IGNORECASE)
-
-    for i, (tag_name, code_str) in enumerate(matches):
-        print(f"🔍 尝试解析工具内容片段 (Tag: {tag_name}): {code_str[:100]}...")
+    # 单遍扫描支持两种标签：tool_code (Hermes) 和 tool_call (Qwen)，未闭合的标签同样提取
+    for i, (_, _, tag_name, code_str) in enumerate(iter_tool_call_blocks(content) if blocks is None else blocks):
+        if log_preview_enabled():
+            logger.debug("🔍 尝试解析工具内容片段 (Tag: %s): %s", tag_name, preview(code_str, 100))
         
         try:
             # 清洗可能残留的 markdown 标记
-            clean_json = code_str.strip()
-            clean_json = re.sub(r"^```(?:json)?\s*", "", clean_json, flags=re.IGNORECASE)
-            clean_json = re.sub(r"\s*```$", "", clean_json)
-            clean_json = clean_json.strip()
+            clean_json = strip_code_fence(code_str)
             
             if not clean_json: 
-                print("⚠️ 内容为空，跳过")
+                logger.debug("⚠️ 内容为空，跳过")
                 continue
 
-            tool_call_data = None
-            
-            # 策略1: 直接 JSON 解析
-            try:
-                tool_call_data = json.loads(clean_json)
-            except json.JSONDecodeError:
-                # 策略2: 尝试 Python AST 解析 (容忍单引号)
-                try:
-                    tool_call_data = ast.literal_eval(clean_json)
-                except:
-                    pass
-            
-            # 策略3: 如果内容包含额外文本，尝试提取第一个 {...} 块
-            if tool_call_data is None:
-                json_match = re.search(r"(\{.*\})", clean_json, re.DOTALL)
-                if json_match:
-                    potential_json = json_match.group(1)
-                    try:
-                        tool_call_data = json.loads(potential_json)
-                    except:
-                        try:
-                            tool_call_data = ast.literal_eval(potential_json)
-                        except:
-                            pass
+            tool_call_data, strategy = decode_tool_call_json(clean_json)
             
-            if tool_call_data is None:
-                print(f"⚠️ 无法解析为 JSON 或 Python Dict: {clean_json}")
+            if not isinstance(tool_call_data, dict):
+                logger.warning("⚠️ 无法解析为 JSON 对象: %s", preview(clean_json))
+                record_tool_parse(None, strategy, "invalid_json")
                 continue
+            if strategy != "json":
+                logger.debug("⚠️ 使用 %s 策略解析成功", strategy)
             
             # === 适配逻辑：兼容非标准格式 (如 tool + command) ===
             # Case 1: {"tool": "bash", "command": "ls"} -> {"name": "bash", "arguments": {"command": "ls"}}
             if "name" not in tool_call_data and "tool" in tool_call_data:
-                print(f"⚠️ 检测到 'tool' 字段但无 'name'，尝试自动适配: {clean_json}")
+                if log_preview_enabled():
+                    logger.debug("⚠️ 检测到 'tool' 字段但无 'name'，尝试自动适配: %s", preview(clean_json))
                 tool_name = tool_call_data.pop("tool")
                 # 剩下的字段作为 arguments
                 # 注意：如果原本就有 arguments 字段，则合并或保留
@@ -112,12 +2070,14 @@ def parse_hermes_xml(content):
 
             # Case 2: {"function": "bash", ...}
             if "name" not in tool_call_data and "function" in tool_call_data:
-                 print(f"⚠️ 检测到 'function' 字段但无 'name'，尝试自动适配: {clean_json}")
+                 if log_preview_enabled():
+                     logger.debug("⚠️ 检测到 'function' 字段但无 'name'，尝试自动适配: %s", preview(clean_json))
                  tool_call_data["name"] = tool_call_data.pop("function")
 
             # 验证必要字段
             if "name" not in tool_call_data:
-                print(f"⚠️ 工具调用缺少 name 字段: {clean_json}")
+                logger.warning("⚠️ 工具调用缺少 name 字段: %s", preview(clean_json))
+                record_tool_parse(None, strategy, "missing_name")
                 continue
             
             # === 参数归一化与修复 ===
@@ -132,187 +2092,505 @@ def parse_hermes_xml(content):
                     pass # 可能是真正的字符串参数
             
             # 2. 针对特定工具的修复逻辑
-            # TodoWrite: 期望 {"todos": [...], "merge": bool}
-            if name in ["TodoWrite", "todo_write"]:
-                # 如果 args 是列表，说明直接输出了 todo 列表 -> 包装一下
-                if isinstance(args, list):
-                    print(f"⚠️ [TodoWrite] 检测到列表参数，自动包装为 todos")
-                    args = {"todos": args, "merge": True} # 默认 merge=True
-                # 如果 args 是单个字典且看起来像个 Todo Item (有 content) 但没有 todos key
-                elif isinstance(args, dict) and "todos" not in args and "content" in args:
-                    print(f"⚠️ [TodoWrite] 检测到单个 Item，自动包装为 todos")
-                    args = {"todos": [args], "merge": True}
-            
-                # 进一步检查 todos 列表中的必填字段 (id, status, priority)
-                if isinstance(args, dict) and "todos" in args and isinstance(args["todos"], list):
-                    for idx, item in enumerate(args["todos"]):
-                        if isinstance(item, dict):
-                            # Ensure 'id'
-                            if "id" not in item:
-                                item["id"] = f"todo_{int(time.time())}_{idx}"
-                                print(f"⚠️ [TodoWrite] Auto-generated missing id for item {idx}")
-                            
-                            # Ensure 'status'
-                            if "status" not in item:
-                                item["status"] = "pending"
-                                print(f"⚠️ [TodoWrite] Auto-filled missing status='pending' for item {idx}")
-                                
-                            # Ensure 'priority'
-                            if "priority" not in item:
-                                item["priority"] = "medium"
-                                print(f"⚠️ [TodoWrite] Auto-filled missing priority='medium' for item {idx}")
-
-            # Bash/RunCommand: 期望 {"command": "..."}
-            elif name in ["Bash", "RunCommand", "run_command", "cmd"]:
-                # 如果 args 是字符串 -> {"command": args}
-                if isinstance(args, str):
-                    print(f"⚠️ [Bash] 检测到字符串参数，自动包装为 command")
-                    args = {"command": args}
-                # 如果是 dict 但用了 cmd/script 等别名
-                elif isinstance(args, dict):
-                    if "command" not in args:
-                        for alias in ["cmd", "script", "code"]:
-                            if alias in args:
-                                args["command"] = args.pop(alias)
-                                break
-
-            # Read/Write/Glob/Grep/LS/DeleteFile: 路径参数别名修复
-            # 期望 file_path 或 path (部分工具)
-            if isinstance(args, dict):
-                # 统一 file_path 和 path
-                # 许多工具 (如 Read, Write) 期望 file_path，但模型常输出 path
-                if "path" in args and "file_path" not in args:
-                    print(f"⚠️ [{name}] 检测到 'path' 参数，自动重命名为 'file_path'")
-                    args["file_path"] = args.pop("path")
-                
-                # 某些情况下模型可能输出 filename
-                if "filename" in args and "file_path" not in args:
-                    print(f"⚠️ [{name}] 检测到 'filename' 参数，自动重命名为 'file_path'")
-                    args["file_path"] = args.pop("filename")
-                
-                # 针对 LS/Glob 工具：它们其实是用 path 参数的，如果我们上面误转成了 file_path，要转回来
-                if name in ["LS", "ls", "Glob", "glob"]:
-                     if "file_path" in args and "path" not in args:
-                         print(f"⚠️ [{name}] 修正: 将 'file_path' 还原为 'path'")
-                         args["path"] = args.pop("file_path")
-                
-                # 针对 DeleteFile 工具：期望 file_paths (列表)，模型可能输出 file_path (字符串)
-                if name in ["DeleteFile", "delete_file"]:
-                    if "file_path" in args and "file_paths" not in args:
-                         print(f"⚠️ [{name}] 检测到单个 'file_path'，自动包装为 'file_paths' 列表")
-                         args["file_paths"] = [args.pop("file_path")]
-                    elif "path" in args and "file_paths" not in args: # 上面可能已经转成了 file_path，这里防万一
-                         print(f"⚠️ [{name}] 检测到单个 'path'，自动包装为 'file_paths' 列表")
-                         args["file_paths"] = [args.pop("path")]
-                
-                # 针对 Write 工具：内容参数修复 (text/code -> content)
-                if name in ["Write", "write_file", "WriteFile"]:
-                     if "text" in args and "content" not in args:
-                         print(f"⚠️ [{name}] 检测到 'text' 参数，自动重命名为 'content'")
-                         args["content"] = args.pop("text")
-                     if "code" in args and "content" not in args:
-                         print(f"⚠️ [{name}] 检测到 'code' 参数，自动重命名为 'content'")
-                         args["content"] = args.pop("code")
-
-                # 针对 Grep 工具：pattern 修复 (regex -> pattern)
-                if name in ["Grep", "grep"]:
-                     if "regex" in args and "pattern" not in args:
-                         print(f"⚠️ [{name}] 检测到 'regex' 参数，自动重命名为 'pattern'")
-                         args["pattern"] = args.pop("regex")
-                    
-                # 针对 Read 工具的特殊检查
-                if name in ["Read", "read_file", "ReadFile"]:
-                     # 如果没有 limit，加上默认值 (虽然 API 可能有默认值，但显式给更安全)
-                     if "limit" not in args:
-                         pass # 暂时不加，避免覆盖 API 默认行为，除非报错
-                     # 如果 limit 是字符串，转 int
-                     if "limit" in args and isinstance(args["limit"], str):
-                         try:
-                             args["limit"] = int(args["limit"])
-                         except:
-                             pass
+            args = normalize_tool_arguments(name, args, tool_rules)
+            record_tool_parse(name, strategy)
             
-            # 回写修复后的参数
-            tool_call_data["arguments"] = args
-                
-            arguments = tool_call_data.get("arguments", {})
-            # 如果 arguments 还是 dict，转为 string (OpenAI 规范要求 arguments 是 JSON 字符串)
-            if isinstance(arguments, dict):
-                arguments = json.dumps(arguments)
-            elif isinstance(arguments, list): # 理论上不应该发生，上面已经处理了
-                arguments = json.dumps(arguments)
-            elif arguments is None:
-                arguments = "{}"
+            # 参数保持为对象一路传到 Claude 响应的 tool_use.input，
+            # 避免 dumps 成字符串后在 convert_openai_response_to_claude 里再 loads 回来
+            if args is None:
+                args = {}
             
             tool_calls.append({
                 "id": f"call_{i}_{os.urandom(4).hex()}",
                 "type": "function",
                 "function": {
                     "name": tool_call_data.get("name"),
-                    "arguments": arguments
+                    "arguments": args
                 }
             })
         except Exception as e:
-            print(f"⚠️ 解析工具调用发生异常: {e}\n原始内容: {code_str}")
+            logger.warning("⚠️ 解析工具调用发生异常: %s 原始内容: %s", e, preview(code_str))
+            record_tool_parse(None, None, "error")
             continue
             
     return tool_calls
 
-def convert_claude_messages_to_openai(claude_body):
+# ================= 流式工具调用解析 =================
+# 流式模式下参数边生成边输出，只能做「顶层键重命名」「顶层标量类型转换」这类无需回看整个对象的修复
+# 需要包装列表 / 补全字段的工具退回到缓冲后整体解析 (normalize_tool_arguments)
+def get_streaming_fixes(name, tool_rules=None):
+    """返回工具在流式模式下的 (顶层键重命名表, 类型转换表)，None 表示需要缓冲"""
+    rule = get_tool_arg_rule(name, tool_rules)
+    return ({}, {}) if rule is None else rule.stream_fixes()
+
+def _match_tool_call_header(buf):
+    """
+    匹配工具调用的头部: [```json] {"name": "X", "arguments":
+    返回 (name, 参数起始下标) / None (数据不足，需要继续读) / False (非标准格式)
+    """
+    n = len(buf)
+    
+    def skip_ws(i):
+        while i < n and buf[i] in " \t\r\n":
+            i += 1
+        return i
+    
+    def expect(i, token):
+        if buf.startswith(token, i):
+            return skip_ws(i + len(token))
+        return None if token.startswith(buf[i:]) else False
+    
+    i = skip_ws(0)
+    if buf.startswith("```", i) or "```".startswith(buf[i:]) and i < n:
+        line_end = buf.find("\n", i)
+        if line_end == -1:
+            return None if n - i < 16 else False
+        i = skip_ws(line_end + 1)
+    
+    for token in ("{", '"name"', ":"):
+        i = expect(i, token)
+        if not i:
+            return i
+    if i >= n:
+        return None
+    if buf[i] != '"':
+        return False
+    name_end = buf.find('"', i + 1)
+    if name_end == -1:
+        return None if n - i < 128 else False
+    name = buf[i + 1:name_end]
+    if "\\" in name or not name:
+        return False
+    i = skip_ws(name_end + 1)
+    
+    for token in (",", '"arguments"', ":"):
+        i = expect(i, token)
+        if not i:
+            return i
+    if i >= n:
+        return None
+    return name, i
+
+_JSON_STRING_SPECIAL = re.compile(r'[\\"\n\r\t]')
+
+class StreamingToolCallParser:
+    """
+    增量式、可恢复的工具调用解析器 (用于流式输出)
+    - feed(chunk) 逐块输入模型输出，finish() 在流结束时调用，均返回事件列表
+    - <tool_call>/<tool_code> 标签可以跨 chunk 边界，只扣留可能是标签开头的几个字符
+    - 标准格式 {"name": ..., "arguments": {...}} 的参数边生成边输出，并顺带修复
+      顶层键别名、字符串中的裸换行、多余的尾逗号
+    - 非标准格式或需要整体修复的工具，缓冲到闭合标签后交给 parse_hermes_xml
+    事件: ("text", str) / ("tool_start", id, name) / ("tool_delta", partial_json) / ("tool_stop",)
+    """
+    OPEN_TAGS = ("<tool_call>", "<tool_code>")
+    TAG_LEN = 11
+    
+    def __init__(self, tool_rules=None):
+        self.tool_rules = tool_rules
+        self.state = "text"
+        self.buf = ""
+        self.tag = None         # 当前工具调用的标签名 (tool_call / tool_code)
+        self.raw = ""           # 缓冲模式下从开标签起的原始文本
+        self.search_from = 0    # 缓冲模式下查找闭合标签的起点，避免重复扫描
+        self.tool_count = 0
+    
+    def feed(self, chunk):
+        events = []
+        self.buf += chunk
+        handlers = {
+            "text": self._on_text,
+            "header": self._on_header,
+            "args": self._on_args,
+            "trailer": self._on_trailer,
+            "buffer": self._on_buffer,
+        }
+        while self.buf and handlers[self.state](events):
+            pass
+        return events
+    
+    def finish(self):
+        """流结束: 输出残留文本，补全被截断 (或被 stop token 截掉闭合标签) 的工具调用"""
+        events = []
+        if self.state == "text":
+            if self.buf:
+                events.append(("text", self.buf))
+        elif self.state in ("header", "buffer"):
+            self.raw += self.buf
+            self._emit_buffered(self.raw + f"</{self.tag}>", events)
+        elif self.state == "args":
+            self._close_args(events)
+        self.buf = ""
+        self.state = "text"
+        return events
+    
+    # ---------- 普通文本 ----------
+    def _on_text(self, events):
+        buf = self.buf
+        idx = buf.find("<")
+        while idx != -1:
+            head = buf[idx:idx + self.TAG_LEN]
+            if head.lower() in self.OPEN_TAGS:
+                if idx:
+                    events.append(("text", buf[:idx]))
+                self.tag = head[1:-1].lower()
+                self.raw = head
+                self.buf = buf[idx + self.TAG_LEN:]
+                self.state = "header"
+                return True
+            if idx + len(head) == len(buf) and any(t.startswith(head.lower()) for t in self.OPEN_TAGS):
+                # 可能是跨 chunk 的标签开头，扣留
+                if idx:
+                    events.append(("text", buf[:idx]))
+                self.buf = buf[idx:]
+                return False
+            idx = buf.find("<", idx + 1)
+        events.append(("text", buf))
+        self.buf = ""
+        return False
+    
+    # ---------- 工具调用头部 ----------
+    def _on_header(self, events):
+        matched = _match_tool_call_header(self.buf)
+        if matched is None:
+            if len(self.buf) <= 512:
+                return False
+            matched = False
+        if matched is not False:
+            name, args_start = matched
+            fixes = get_streaming_fixes(name, self.tool_rules)
+            if fixes is not None and self.buf[args_start] == "{":
+                self.tool_count += 1
+                record_tool_parse(name, "stream")
+                events.append(("tool_start", f"call_{self.tool_count - 1}_{os.urandom(4).hex()}", name))
+                self.buf = self.buf[args_start:]
+                self.renames, self.coerce = fixes
+                self.seen_keys = set()      # 已出现的顶层键 (原始键名)
+                self.held = None            # 出现别名后扣留的输出，别名键位置为 [别名, 规范键] 占位
+                self.stack = []
+                self.in_string = False
+                self.escape = False
+                self.key_chars = None       # 正在读取的顶层键名
+                self.value_kind = None      # 当前顶层值需要转换的类型 (schema 中的 integer/number/boolean)
+                self.value_chars = None     # 扣留中的待转换字符串值
+                self.expect_key = False
+                self.pending_comma = False  # 扣留逗号，若后面紧跟 } 或 ] 则丢弃
+                self.last_token = ""
+                self.state = "args"
+                return True
+        # 非标准格式 / 需要整体修复: 缓冲到闭合标签
+        self.state = "buffer"
+        self.search_from = 0
+        return True
+    
+    # ---------- 参数 JSON 流式输出 ----------
+    def _on_args(self, events):
+        buf = self.buf
+        n = len(buf)
+        i = 0
+        out = []
+        done = False
+        while i < n:
+            if self.in_string:
+                target = self.key_chars if self.key_chars is not None else self.value_chars if self.value_chars is not None else out
+                if self.escape:
+                    target.append(buf[i])
+                    self.escape = False
+                    i += 1
+                    continue
+                m = _JSON_STRING_SPECIAL.search(buf, i)
+                end = m.start() if m else n
+                if end > i:
+                    target.append(buf[i:end])
+                i = end
+                if not m:
+                    break
+                ch = buf[i]
+                i += 1
+                if ch == "\\":
+                    target.append(ch)
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    if self.key_chars is not None:
+                        key = "".join(self.key_chars)
+                        self.key_chars = None
+                        new_key = self.renames.get(key)
+                        self.seen_keys.add(key)
+                        if new_key and new_key not in self.seen_keys:
+                            # 规范键可能出现在别名之后: 扣留输出到对象结束再决定是否重命名，
+                            # 与 normalize_tool_arguments 一致 (规范键已存在时保留别名)，不产生重复键
+                            if self.held is None:
+                                self.held = []
+                            out.append([key, new_key])
+                        else:
+                            out.append(f'"{key}"')
+                            self.value_kind = self.coerce.get(key)
+                    elif self.value_chars is not None:
+                        out.append(self._coerce_value("".join(self.value_chars)))
+                        self.value_chars = None
+                        self.value_kind = None
+                    else:
+                        out.append(ch)
+                    self.last_token = '"'
+                else:
+                    # 字符串中的裸控制字符在 JSON 中非法，转义
+                    target.append(_CONTROL_ESCAPES[ch])
+                continue
+            
+            ch = buf[i]
+            i += 1
+            if ch in " \t\r\n":
+                if not self.pending_comma:
+                    out.append(ch)
+                continue
+            if self.pending_comma:
+                self.pending_comma = False
+                if ch in "}]":
+                    self.expect_key = False
+                else:
+                    out.append(",")
+            if ch == '"':
+                self.in_string = True
+                if self.expect_key:
+                    self.key_chars = []
+                elif self.value_kind and len(self.stack) == 1:
+                    # 模型把数字 / 布尔值写成了字符串: 扣留到字符串闭合后再转换
+                    self.value_chars = []
+                else:
+                    out.append(ch)
+                self.expect_key = False
+                if self.value_chars is None:
+                    self.value_kind = None
+                continue
+            if ch in "{[":
+                self.stack.append(ch)
+                self.expect_key = ch == "{" and len(self.stack) == 1
+            elif ch in "}]":
+                if self.stack:
+                    self.stack.pop()
+                if not self.stack:
+                    out.append(ch)
+                    done = True
+                    break
+            elif ch == ",":
+                self.pending_comma = True
+                self.expect_key = len(self.stack) == 1 and self.stack[0] == "{"
+                if self.expect_key:
+                    self.value_kind = None
+                continue
+            out.append(ch)
+            self.last_token = ch
+        
+        self.buf = buf[i:]
+        if self.held is not None:
+            self.held.extend(out)
+            out = [self._release_held()] if done else []
+        if out:
+            events.append(("tool_delta", "".join(out)))
+        if done:
+            events.append(("tool_stop",))
+            self.state = "trailer"
+            return True
+        return False
+    
+    def _coerce_value(self, raw):
+        """顶层字符串值闭合: 按 schema 类型转换 (与 ToolArgRule.apply 一致)，无法转换时原样输出"""
+        try:
+            value = _COERCERS[self.value_kind](json.loads(f'"{raw}"'))
+        except ValueError:
+            return f'"{raw}"'
+        if isinstance(value, float) and not math.isfinite(value):
+            return f'"{raw}"'
+        return json.dumps(value)
+    
+    def _release_held(self):
+        """对象结束: 按规则顺序 (与 ToolArgRule.apply 一致)，规范键没有出现也没有被前面的别名占用时才重命名别名"""
+        held_keys = {piece[0] for piece in self.held if isinstance(piece, list)}
+        renamed = {}
+        for src, dst in self.renames.items():
+            if src in held_keys and dst not in self.seen_keys and dst not in renamed.values():
+                renamed[src] = dst
+        pieces = []
+        for piece in self.held:
+            if isinstance(piece, list):
+                piece = f'"{renamed.get(piece[0], piece[0])}"'
+            pieces.append(piece)
+        self.held = None
+        return "".join(pieces)
+    
+    def _close_args(self, events):
+        """流在参数中途结束 (max_tokens): 尽量补全为合法 JSON"""
+        out = []
+        if self.in_string:
+            if self.key_chars is not None:
+                out.append('"' + "".join(self.key_chars) + '": null')
+            elif self.value_chars is not None:
+                out.append('"' + "".join(self.value_chars) + ("\\" if self.escape else "") + '"')
+            else:
+                if self.escape:
+                    out.append("\\")
+                out.append('"')
+        elif self.last_token == ":":
+            out.append("null")
+        for opener in reversed(self.stack):
+            out.append("}" if opener == "{" else "]")
+        if self.held is not None:
+            out.insert(0, self._release_held())
+        if out:
+            events.append(("tool_delta", "".join(out)))
+        events.append(("tool_stop",))
+    
+    # ---------- 参数之后到闭合标签之间 ----------
+    def _on_trailer(self, events):
+        # 第一个开标签或本块的闭合标签 (另一种标签的闭合标签忽略)
+        for m in TOOL_TAG_RE.finditer(self.buf):
+            if not m.group(1):
+                self.buf = self.buf[m.start():]
+                break
+            if m.group(2).lower() == self.tag:
+                self.buf = self.buf[m.end():]
+                break
+        else:
+            # 只保留可能是标签开头的尾部
+            self.buf = self.buf[-(self.TAG_LEN + 1):]
+            return False
+        self.state = "text"
+        return True
+    
+    # ---------- 缓冲模式 ----------
+    def _on_buffer(self, events):
+        self.raw += self.buf
+        self.buf = ""
+        m = TOOL_CLOSE_TAG_RES[self.tag].search(self.raw, self.search_from)
+        if m is None:
+            self.search_from = max(0, len(self.raw) - len(self.tag) - 2)
+            return False
+        end = m.end()
+        self.buf = self.raw[end:]
+        self._emit_buffered(self.raw[:end], events)
+        self.raw = ""
+        self.state = "text"
+        return True
+    
+    def _emit_buffered(self, snippet, events):
+        for tool_call in parse_hermes_xml(snippet, self.tool_rules):
+            self.tool_count += 1
+            events.append(("tool_start", tool_call["id"], tool_call["function"]["name"]))
+            events.append(("tool_delta", tool_arguments_json(tool_call["function"]["arguments"])))
+            events.append(("tool_stop",))
+
+def convert_claude_content(content):
+    """将单条 Claude 消息的 content 转换为文本 (tool_use -> <tool_code>，tool_result -> <tool_output>)"""
+    text_parts = []
+    
+    # Claude 的 content 可能是列表（包含 text, tool_use, tool_result）
+    if isinstance(content, list):
+        for part in content:
+            part_type = part.get("type")
+            
+            if part_type == "text":
+                text_parts.append(part.get("text", ""))
+                
+            elif part_type == "tool_use":
+                # 将 Claude 的工具调用转换为 Hermes 的 <tool_code>
+                args_json = json.dumps(part.get("input", {}))
+                tool_xml = f"\n<tool_code>\n{{\"name\": \"{part['name']}\", \"arguments\": {args_json}}}\n</tool_code>"
+                text_parts.append(tool_xml)
+                
+            elif part_type == "tool_result":
+                # 将 Claude 的工具结果转换为 Hermes 的 <tool_output>
+                res_content = part.get("content", "")
+                res_text = ""
+                if isinstance(res_content, str):
+                    res_text = res_content
+                elif isinstance(res_content, list):
+                    for sub in res_content:
+                        if sub.get("type") == "text":
+                            res_text += sub.get("text", "")
+                
+                # 简化 output，防止过长
+                tool_output_xml = f"\n<tool_output>\n{res_text}\n</tool_output>"
+                text_parts.append(tool_output_xml)
+                
+    elif isinstance(content, str):
+        text_parts.append(content)
+        
+    return "".join(text_parts)
+
+def _freeze(value):
+    """
+    把消息内容转换为可哈希的嵌套元组，用作转换缓存的键
+    比对整条消息做 json.dumps + 哈希便宜得多 (字符串哈希在 C 层完成，不需要转义)，
+    且命中时按值比较，不存在哈希碰撞导致的错误复用
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        return tuple((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return ("[",) + tuple(_freeze(v) for v in value)
+    # True == 1 == 1.0 但序列化结果不同，带上类型区分
+    return (value.__class__, value)
+
+def convert_claude_message_native(role, content):
+    """
+    native 模式: 单条 Claude 消息 -> OpenAI 消息列表
+    tool_use -> assistant.tool_calls，tool_result -> role=tool 消息，由 vLLM 的 chat template 渲染为模型原生格式
+    """
+    if not isinstance(content, list):
+        return [{"role": role, "content": content if isinstance(content, str) else ""}]
+    texts, tool_calls, messages = [], [], []
+    for part in content:
+        part_type = part.get("type")
+        if part_type == "text":
+            texts.append(part.get("text", ""))
+        elif part_type == "tool_use":
+            tool_calls.append({
+                "id": part["id"],
+                "type": "function",
+                "function": {"name": part["name"], "arguments": tool_arguments_json(part.get("input", {}))}
+            })
+        elif part_type == "tool_result":
+            messages.append({"role": "tool", "tool_call_id": part.get("tool_use_id"), "content": _tool_result_text(part)})
+    text = "".join(texts)
+    if tool_calls:
+        messages.append({"role": role, "content": text, "tool_calls": tool_calls})
+    elif text or not messages:
+        messages.append({"role": role, "content": text})
+    return messages
+
+def convert_claude_messages_to_openai(claude_body, native=False):
     """
     将 Claude 格式的 messages 请求转换为 OpenAI 格式
-    同时处理历史记录中的 tool_use 和 tool_result，将其转换为 Hermes XML 格式
+    同时处理历史记录中的 tool_use 和 tool_result，将其转换为 Hermes XML 格式 (native=True 时转为结构化的 tool_calls / tool 消息)
+    返回的消息 dict 每次新建，调用方可以安全修改 (缓存的只是 content 字符串)
     """
     openai_messages = []
     
     # 1. 处理 system prompt
     system_content = claude_body.get("system", "")
+    if isinstance(system_content, list):
+        # Claude 允许 system 为 [{type: text, text: ...}] 列表 (Claude Code 即如此)
+        system_content = "\n\n".join(part.get("text", "") for part in system_content if part.get("type") == "text")
     if system_content:
         openai_messages.append({
             "role": "system",
             "content": system_content
         })
         
-    # 2. 处理 messages 列表
+    # 2. 处理 messages 列表 (已见过的消息直接复用缓存的转换结果，只转换新增的部分)
     for msg in claude_body.get("messages", []):
         role = msg["role"]
         content = msg["content"]
-        
-        text_parts = []
-        
-        # Claude 的 content 可能是列表（包含 text, tool_use, tool_result）
-        if isinstance(content, list):
-            for part in content:
-                part_type = part.get("type")
-                
-                if part_type == "text":
-                    text_parts.append(part.get("text", ""))
-                    
-                elif part_type == "tool_use":
-                    # 将 Claude 的工具调用转换为 Hermes 的 <tool_code>
-                    args_json = json.dumps(part.get("input", {}))
-                    tool_xml = f"\n<tool_code>\n{{\"name\": \"{part['name']}\", \"arguments\": {args_json}}}\n</tool_code>"
-                    text_parts.append(tool_xml)
-                    
-                elif part_type == "tool_result":
-                    # 将 Claude 的工具结果转换为 Hermes 的 <tool_output>
-                    res_content = part.get("content", "")
-                    res_text = ""
-                    if isinstance(res_content, str):
-                        res_text = res_content
-                    elif isinstance(res_content, list):
-                        for sub in res_content:
-                            if sub.get("type") == "text":
-                                res_text += sub.get("text", "")
-                    
-                    # 简化 output，防止过长
-                    tool_output_xml = f"\n<tool_output>\n{res_text}\n</tool_output>"
-                    text_parts.append(tool_output_xml)
-                    
-        elif isinstance(content, str):
-            text_parts.append(content)
-            
-        final_content = "".join(text_parts)
+        if native:
+            openai_messages.extend(convert_claude_message_native(role, content))
+            continue
+        key = (role, _freeze(content))
+        final_content = conversion_cache.get(key)
+        if final_content is None:
+            final_content = convert_claude_content(content)
+            conversion_cache.put(key, final_content)
         openai_messages.append({"role": role, "content": final_content})
             
     # 3. 处理 tools (提取定义用于注入 System Prompt)
@@ -327,8 +2605,107 @@ def convert_claude_messages_to_openai(claude_body):
             
     return openai_messages, raw_tools
 
+# ================= 工具定义压缩 =================
+# 含子 schema 的字段: 值为单个 schema / schema 列表，或 名称 -> schema 的映射 (键是属性名，不做过滤)
+_SUBSCHEMA_KEYS = {"items", "anyOf", "oneOf", "allOf", "not", "prefixItems", "contains", "if", "then", "else"}
+_SUBSCHEMA_MAP_KEYS = {"properties", "patternProperties", "$defs", "definitions"}
+
+tool_compaction_stats = {"requests": 0, "tokens_saved": 0, "tools_dropped": 0}
+
+def shorten_description(text, max_chars):
+    """截断过长的描述: 优先在 max_chars 内最后一个句子或段落边界处截断，找不到合适边界时硬截断"""
+    if max_chars is None or len(text) <= max_chars:
+        return text
+    if max_chars <= 0:
+        return ""
+    cut = text[:max_chars]
+    boundary = max(cut.rfind(". "), cut.rfind(".\n"), cut.rfind("\n"), cut.rfind("。"))
+    if boundary >= max_chars // 2:
+        cut = cut[:boundary + 1]
+    return cut.rstrip() + " ..."
+
+def compact_schema(schema):
+    """去掉 schema 中的冗余字段并截断参数描述，递归处理嵌套的属性与子 schema"""
+    if isinstance(schema, list):
+        return [compact_schema(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    compacted = {}
+    for key, value in schema.items():
+        if key in TOOL_SCHEMA_DROP_KEYS and not (key == "additionalProperties" and isinstance(value, dict)):
+            continue
+        if key == "description" and isinstance(value, str):
+            value = shorten_description(value, TOOL_PARAM_DESCRIPTION_MAX_CHARS)
+            if value:
+                compacted[key] = value
+        elif key in _SUBSCHEMA_MAP_KEYS and isinstance(value, dict):
+            compacted[key] = {name: compact_schema(sub) for name, sub in value.items()}
+        elif key in _SUBSCHEMA_KEYS or key == "additionalProperties":
+            compacted[key] = compact_schema(value)
+        else:
+            compacted[key] = value
+    return compacted
+
+def compact_tool_definitions(tools):
+    """压缩工具定义 (按 tools 内容哈希缓存)；输出只取决于输入与配置，跨轮次字节一致"""
+    key = hashlib.blake2b(json_dumps(tools), digest_size=16).digest()
+    compacted = tool_compaction_cache.get(key)
+    if compacted is None:
+        compacted = [{
+            "name": tool["name"],
+            "description": shorten_description(tool.get("description") or "", TOOL_DESCRIPTION_MAX_CHARS),
+            "parameters": compact_schema(tool["parameters"]),
+        } for tool in tools]
+        tool_compaction_cache.put(key, compacted)
+    return compacted
+
+def session_tool_names(body):
+    """本会话需要保留的工具: 已调用过的、tool_choice 指定的"""
+    names = set()
+    tool_choice = body.get("tool_choice") or {}
+    if tool_choice.get("type") == "tool":
+        names.add(tool_choice["name"])
+    for msg in body.get("messages", []):
+        if msg["role"] == "assistant" and isinstance(msg["content"], list):
+            names.update(part.get("name") for part in msg["content"] if part.get("type") == "tool_use")
+    return names
+
+def prompt_tool_definitions(raw_tools, body):
+    """注入 Prompt / 转发给 vLLM 的工具定义: 按配置省略未用过的工具并压缩"""
+    tools = raw_tools
+    if TOOL_COMPACT_DROP_UNUSED:
+        used = session_tool_names(body)
+        tools = [tool for tool in tools if tool["name"] in used
+                 or any(fnmatch.fnmatchcase(tool["name"], pattern) for pattern in TOOL_COMPACT_KEEP_TOOLS)]
+    if TOOL_COMPACT_ENABLED:
+        tools = compact_tool_definitions(tools)
+    return tools
+
+def record_tool_compaction(body, raw_tools):
+    """统计一个请求的工具定义压缩节省的 Token 数并返回"""
+    if not raw_tools or not (TOOL_COMPACT_ENABLED or TOOL_COMPACT_DROP_UNUSED):
+        return 0
+    prompt_tools = prompt_tool_definitions(raw_tools, body)
+    saved = tool_definition_tokens(raw_tools) - tool_definition_tokens(prompt_tools)
+    tool_compaction_stats["requests"] += 1
+    tool_compaction_stats["tokens_saved"] += saved
+    tool_compaction_stats["tools_dropped"] += len(raw_tools) - len(prompt_tools)
+    return saved
+
 def generate_tool_system_prompt(tools):
-    """生成 Qwen 2.5/3 官方推荐的工具定义 Prompt"""
+    """
+    生成 Qwen 2.5/3 官方推荐的工具定义 Prompt (按 tools 内容哈希缓存)
+    Claude Code 每轮都发送相同的工具定义，缓存后无需重复序列化数十 KB 的 schema
+    """
+    key = hashlib.blake2b(json_dumps(tools), digest_size=16).digest()
+    prompt = tool_prompt_cache.get(key)
+    if prompt is None:
+        prompt = render_tool_system_prompt(tools)
+        tool_prompt_cache.put(key, prompt)
+    return prompt
+
+def render_tool_system_prompt(tools):
+    """渲染工具定义 Prompt；规范化序列化 (键排序、无多余空白)，保证跨轮次、跨客户端字节一致，便于 vLLM 前缀缓存复用"""
     
     # 1. 转换为 OpenAI 标准格式 (type: function)
     openai_tools = []
@@ -342,7 +2719,7 @@ def generate_tool_system_prompt(tools):
             }
         })
     
-    tools_json = json.dumps(openai_tools, indent=None) # Compact JSON
+    tools_json = json.dumps(openai_tools, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
     
     prompt = f"""# Tools
 
@@ -360,8 +2737,14 @@ For each function call, return a json object with function name and arguments wi
 """
     return prompt
 
-def convert_openai_response_to_claude(openai_resp):
-    """将 OpenAI 格式的响应转换为 Claude 格式"""
+def tool_arguments_json(arguments):
+    """工具参数 -> JSON 字符串 (流式 input_json_delta 需要字符串)"""
+    if isinstance(arguments, str):
+        return arguments
+    return json_dumps(arguments).decode("utf-8")
+
+def convert_openai_response_to_claude(openai_resp, scan=None):
+    """将 OpenAI 格式的响应转换为 Claude 格式；scan: 已对 message.content 做过的 scan_tool_call_blocks 结果"""
     choice = openai_resp["choices"][0]
     message = choice["message"]
     
@@ -372,9 +2755,7 @@ def convert_openai_response_to_claude(openai_resp):
     raw_content = message.get("content", "")
     
     # 尝试移除 raw_content 中的 <tool_code> 或 <tool_call> 部分，只保留思考文本
-    display_text = re.sub(r"<(tool_code|tool_call)>.*?</\1>", "", raw_content, flags=re.DOTALL).strip()
-    # 还要移除可能的残留闭合标签
-    display_text = re.sub(r"</(tool_code|tool_call)>", "", display_text).strip()
+    display_text = strip_tool_call_blocks(raw_content or "", scan)
     
     if display_text:
         claude_content.append({
@@ -386,11 +2767,15 @@ def convert_openai_response_to_claude(openai_resp):
     if message.get("tool_calls"):
         stop_reason = "tool_use"
         for tool_call in message["tool_calls"]:
+            arguments = tool_call["function"]["arguments"]
+            # parse_hermes_xml 给出的是对象；仅上游原生 tool_calls 才是 JSON 字符串
+            if isinstance(arguments, str):
+                arguments = json_loads(arguments)
             claude_content.append({
                 "type": "tool_use",
                 "id": tool_call["id"],
                 "name": tool_call["function"]["name"],
-                "input": json.loads(tool_call["function"]["arguments"])
+                "input": arguments
             })
             
     return {
@@ -407,143 +2792,993 @@ def convert_openai_response_to_claude(openai_resp):
         }
     }
 
+def finalize_openai_response(openai_result, raw_tools):
+    """非流式: 补全被 stop 截断的闭合标签、解析 XML 工具调用 (native 模式直接使用 tool_calls)，转换为 Claude 响应"""
+    choice = openai_result["choices"][0]
+    content = choice["message"].get("content", "") or ""
+
+    # 如果因为 stop token 停止，我们需要把被截断的闭合标签补回来以便正则匹配
+    if choice.get("finish_reason") == "stop":
+         # 检查是否以未闭合的标签结尾
+         if "<tool_call>" in content and "</tool_call>" not in content:
+             content += "</tool_call>"
+         elif "<tool_code>" in content and "</tool_code>" not in content:
+             content += "</tool_code>"
+
+    scan = None
+    if choice["message"].get("tool_calls"):
+        # native 模式: vLLM 已解析出结构化 tool_calls，无需再解析 XML
+        for tool_call in choice["message"]["tool_calls"]:
+            record_tool_parse(tool_call["function"]["name"], "native")
+        logger.info("✅ vLLM 原生工具调用: %d 个工具", len(choice["message"]["tool_calls"]))
+    elif "<tool_call>" in content or "<tool_code>" in content:
+        logger.debug("🛠️ 正在解析 XML 工具调用...")
+        with observe_stage("parse_tool_calls"):
+            # 标签只扫描一次: 解析与去除工具调用块 (生成显示文本) 共用同一份块位置
+            choice["message"]["content"] = content
+            scan = scan_tool_call_blocks(content)
+            extracted_tools = parse_hermes_xml(content, resolve_tool_arg_rules(raw_tools), scan[0])
+        if extracted_tools:
+            logger.info("✅ 解析成功: %d 个工具", len(extracted_tools))
+            choice["message"]["tool_calls"] = extracted_tools
+        else:
+            logger.warning("❌ 解析失败: 找到了标签但无法提取 JSON")
+
+    # 协议转换: OpenAI -> Claude
+    with observe_stage("convert_response"):
+        return convert_openai_response_to_claude(openai_result, scan)
+
+def cached_openai_result(cached):
+    """响应缓存中的 vLLM 输出 -> 非流式 OpenAI 响应"""
+    message = {"role": "assistant", "content": cached["content"]}
+    if cached.get("tool_calls"):
+        message["tool_calls"] = list(cached["tool_calls"])
+    return {
+        "id": f"msg_{os.urandom(12).hex()}",  # 作为 Claude 响应的 id，与流式响应的格式一致
+        "choices": [{"index": 0, "message": message, "finish_reason": cached["finish_reason"]}],
+        "usage": cached.get("usage") or {"prompt_tokens": 0, "completion_tokens": 0},
+    }
+
+def claude_message_events(message, input_tokens=0):
+    """
+    把完整的 Claude 响应按流式事件顺序输出 (响应缓存命中的流式请求)，事件结构与 stream_claude_events 一致
+    input_tokens: 本地计算的 Prompt Token 数，用于 message_start；vLLM 报告的值在 message_delta 中给出
+    """
+    yield sse_event("message_start", {
+        "type": "message_start",
+        "message": {**message, "content": [], "stop_reason": None, "usage": {"input_tokens": input_tokens, "output_tokens": 0}}
+    })
+    for index, block in enumerate(message["content"]):
+        if block["type"] == "text":
+            start, delta = {"type": "text", "text": ""}, {"type": "text_delta", "text": block["text"]}
+        else:
+            start = {**block, "input": {}}
+            delta = {"type": "input_json_delta", "partial_json": tool_arguments_json(block["input"])}
+        yield sse_event("content_block_start", {"type": "content_block_start", "index": index, "content_block": start})
+        yield sse_event("content_block_delta", {"type": "content_block_delta", "index": index, "delta": delta})
+        yield sse_event("content_block_stop", {"type": "content_block_stop", "index": index})
+    yield sse_event("message_delta", {
+        "type": "message_delta",
+        "delta": {"stop_reason": message["stop_reason"], "stop_sequence": None},
+        "usage": final_stream_usage(message["usage"]["input_tokens"], message["usage"]["output_tokens"])
+    })
+    yield sse_event("message_stop", {"type": "message_stop"})
+
+def final_stream_usage(prompt_tokens, completion_tokens):
+    """message_delta 中的累计用量: vLLM 报告了 Prompt Token 数时一并给出 (取代 message_start 中的本地估算)"""
+    usage = {"output_tokens": completion_tokens}
+    if prompt_tokens:
+        usage["input_tokens"] = prompt_tokens
+    return usage
+
+TOOL_CALL_REMINDER = "\n\n(IMPORTANT: If you need to use a tool, output the JSON inside <tool_call> tags immediately. Do not explain.)"
+
+def prompt_prefix_key(openai_messages):
+    """
+    前缀亲和路由键: system (含工具 Prompt) + 第一条 user 消息
+    多轮对话中这部分保持不变 (第一轮末尾追加的工具提醒不计入)，同一会话每轮得到相同的键
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for msg in openai_messages:
+        text = message_text(msg.get("content"))
+        if msg["role"] == "user" and text.endswith(TOOL_CALL_REMINDER):
+            text = text[:-len(TOOL_CALL_REMINDER)]
+        h.update(f"{msg['role']}\0{text}\0".encode("utf-8"))
+        if msg["role"] == "user":
+            break
+    return h.hexdigest()
+
+# vLLM 不支持而被暂时关闭的特性 -> 恢复尝试的时间 (monotonic)
+feature_fallback_until = {}
+
+# 特性 -> (请求中对应的参数, 400 错误信息中的关键字, 日志说明)
+UPSTREAM_FEATURES = {
+    "native": ("tools", ("enable-auto-tool-choice", "tool-call-parser"),
+               "原生工具调用 (需 --enable-auto-tool-choice --tool-call-parser hermes)，退回 Prompt 注入模式"),
+    "guided": ("response_format", ("structural_tag", "response_format", "guided", "grammar"),
+               "结构化输出 (structural_tag)，工具调用不再受约束"),
+}
+
+def feature_available(feature):
+    return time.monotonic() >= feature_fallback_until.get(feature, 0.0)
+
+def use_native_tool_calls():
+    return TOOL_CALL_MODE == "native" and feature_available("native")
+
+def use_guided_tool_calls():
+    return GUIDED_TOOL_CALLS and feature_available("guided")
+
+def rejected_feature(openai_req, status_code, error_text):
+    """vLLM 对不支持的参数返回 400，按请求参数与错误信息判断是哪个特性，非此类错误返回 None"""
+    if status_code != 400:
+        return None
+    for feature, (param, hints, _) in UPSTREAM_FEATURES.items():
+        if openai_req.get(param) and any(hint in error_text for hint in hints):
+            return feature
+    return None
+
+def disable_feature(feature, reason):
+    """在 UPSTREAM_FEATURE_FALLBACK_SECONDS 内关闭 vLLM 不支持的特性"""
+    feature_fallback_until[feature] = time.monotonic() + UPSTREAM_FEATURE_FALLBACK_SECONDS
+    logger.warning("⚠️ vLLM 不支持%s (%ds 内不再尝试): %s",
+                   UPSTREAM_FEATURES[feature][2], UPSTREAM_FEATURE_FALLBACK_SECONDS, preview(reason))
+
+def guided_tool_call_format(tools):
+    """
+    构建 structural_tag 格式的 response_format: 每个工具一个结构，合起来即 "工具名 + 参数" 的联合
+    模型输出 <tool_call> 后只能继续写出某个工具的 {"name": ..., "arguments": <符合 input_schema 的对象>}，其余文本不受约束
+    """
+    structures = []
+    for tool in tools:
+        schema = {k: v for k, v in tool["parameters"].items() if k != "$schema"}
+        structures.append({
+            "begin": f'<tool_call>\n{{"name": {json.dumps(tool["name"], ensure_ascii=False)}, "arguments": ',
+            "schema": schema,
+            "end": "}\n</tool_call>",
+        })
+    return {"type": "structural_tag", "structures": structures, "triggers": ["<tool_call>"]}
+
+def map_tool_choice(tool_choice):
+    """Claude tool_choice -> OpenAI tool_choice"""
+    kind = (tool_choice or {}).get("type")
+    if kind == "any":
+        return "required"
+    if kind == "tool":
+        return {"type": "function", "function": {"name": tool_choice["name"]}}
+    if kind == "none":
+        return "none"
+    return "auto"
+
+def build_openai_request(body, stream=False, native=None, guided=None):
+    """
+    将 Claude 请求体转换为发送给 vLLM 的 OpenAI 请求
+    prompt 模式注入工具 Prompt (guided 时附带约束工具调用的 response_format)；native 模式转发 tools / tool_choice
+    native / guided 为 None 时按配置与特性可用状态决定
+    """
+    if native is None:
+        native = use_native_tool_calls()
+    if guided is None:
+        guided = use_guided_tool_calls()
+    native = native and bool(body.get("tools"))
+    # 协议转换: Claude -> OpenAI
+    with observe_stage("convert_messages"):
+        openai_messages, raw_tools = convert_claude_messages_to_openai(body, native=native)
+    
+    # === 核心修正：工具 Prompt 注入 ===
+    stop_tokens = [] # 动态停止词
+    prompt_tools = prompt_tool_definitions(raw_tools, body) if raw_tools else raw_tools
+    
+    if raw_tools and not native:
+        with observe_stage("tool_prompt"):
+            tool_prompt = generate_tool_system_prompt(prompt_tools)
+        stop_tokens = ["</tool_call>", "</tool_code>"] # 告诉模型写完工具调用就停
+        
+        # 策略：如果 messages 里没有 system，就新建一个。
+        # 如果有，我们在 User 消息里注入提醒，而不是仅仅修改 System Prompt
+        # 因为长对话中 System Prompt 容易被遗忘
+        
+        # A. 确保 System Prompt 存在
+        system_msg_index = -1
+        for i, msg in enumerate(openai_messages):
+            if msg["role"] == "system":
+                system_msg_index = i
+                break
+        
+        if system_msg_index >= 0:
+            # 追加到现有 system 之后 (system 在前、工具定义在后，前缀保持稳定)
+            system_content = openai_messages[system_msg_index]["content"]
+            openai_messages[system_msg_index]["content"] = f"{system_content}\n\n{tool_prompt}"
+        else:
+            # 插入新的 system 消息到开头
+            openai_messages.insert(0, {
+                "role": "system",
+                "content": tool_prompt
+            })
+        
+        # B. [关键] 在最后一条 User Message 追加强力提醒
+        # 只有当用户确实在说话时才追加
+        if openai_messages and openai_messages[-1]["role"] == "user":
+            openai_messages[-1]["content"] += TOOL_CALL_REMINDER
+        
+        logger.debug("💉 已注入 %d 个工具定义 (System + User Reminder)", len(prompt_tools))
+
+    # 构建发送给 vLLM 的请求
+    openai_req = {
+        "model": TARGET_MODEL_NAME,
+        "messages": openai_messages,
+        "max_tokens": body.get("max_tokens", 4096),
+        "temperature": body.get("temperature", 0.7),
+        "stream": stream,
+        "stop": stop_tokens if stop_tokens else None # 使用 Stop Token 防止废话
+    }
+    if stream:
+        # 让 vLLM 在最后一个 chunk 中返回 usage，用于 message_delta
+        openai_req["stream_options"] = {"include_usage": True}
+    
+    if raw_tools and not native and guided:
+        # 约束解码使用完整 schema (压缩只针对 Prompt)，工具集合与 Prompt 中的一致
+        names = {tool["name"] for tool in prompt_tools}
+        openai_req["response_format"] = guided_tool_call_format([tool for tool in raw_tools if tool["name"] in names])
+    
+    if native:
+        # native 模式: 工具定义交给 vLLM 的 chat template 与工具解析器，不注入 Prompt 与提醒
+        openai_req["tools"] = [{"type": "function", "function": tool} for tool in prompt_tools]
+        openai_req["tool_choice"] = map_tool_choice(body.get("tool_choice"))
+        if (body.get("tool_choice") or {}).get("disable_parallel_tool_use"):
+            openai_req["parallel_tool_calls"] = False
+    
+    return openai_req, raw_tools
+
+# ================= 上下文自动压缩 =================
+def _excerpt_tool_result(text):
+    """长 tool_result 只保留首尾摘录 (确定性结果，同一条消息每轮压缩结果相同)"""
+    omitted = len(text) - COMPACT_TOOL_RESULT_HEAD_CHARS - COMPACT_TOOL_RESULT_TAIL_CHARS
+    return (text[:COMPACT_TOOL_RESULT_HEAD_CHARS]
+            + f"\n...[{omitted} chars trimmed by middleware]...\n"
+            + text[-COMPACT_TOOL_RESULT_TAIL_CHARS:])
+
+def _tool_result_text(part):
+    content = part.get("content", "")
+    if isinstance(content, list):
+        return "".join(sub.get("text", "") for sub in content if sub.get("type") == "text")
+    return content if isinstance(content, str) else ""
+
+def _detach_tool_results(msg):
+    """截断点上的 user 消息: 对应的 tool_use 已被丢弃，tool_result 改为普通文本 (native 模式下孤立的 tool 消息会被 vLLM 拒绝)"""
+    if not isinstance(msg.get("content"), list):
+        return msg
+    parts = [
+        {"type": "text", "text": f"[Result of an earlier tool call]\n{_tool_result_text(part)}"}
+        if part.get("type") == "tool_result" else part
+        for part in msg["content"]
+    ]
+    return {**msg, "content": parts}
+
+def compact_claude_body(body, budget):
+    """
+    将请求压缩到 budget 以内，返回 (新 body, 统计)；system、工具定义和最近的消息保持不变
+    1. 较早消息中的长 tool_result 截为首尾摘录
+    2. 仍然超出时，按 COMPACT_DROP_STEP 对齐逐步丢弃最早的消息 (截断点落在 user 消息上，最多丢到保留区之前)
+    """
+    messages = list(body.get("messages", []))
+    keep_from = max(0, len(messages) - COMPACT_KEEP_LAST_MESSAGES)
+    stats = {"tool_results_truncated": 0, "messages_dropped": 0}
+    
+    # 阶段 1: 截断较早的 tool_result
+    for idx in range(keep_from):
+        msg = messages[idx]
+        if not isinstance(msg.get("content"), list):
+            continue
+        new_parts = None
+        for p_idx, part in enumerate(msg["content"]):
+            if part.get("type") != "tool_result":
+                continue
+            text = _tool_result_text(part)
+            if len(text) <= COMPACT_TOOL_RESULT_MAX_CHARS:
+                continue
+            if new_parts is None:
+                new_parts = list(msg["content"])
+            new_parts[p_idx] = {**part, "content": _excerpt_tool_result(text)}
+            stats["tool_results_truncated"] += 1
+        if new_parts is not None:
+            messages[idx] = {**msg, "content": new_parts}
+    
+    compacted = {**body, "messages": messages}
+    # 按 prompt 模式估算: 转换结果与 Claude 消息一一对应 (native 模式的 tool 消息会拆分)
+    openai_req, _ = build_openai_request(compacted, native=False)
+    counts = message_token_counts(openai_req["messages"])
+    total = CHAT_TEMPLATE_GENERATION_PROMPT_TOKENS + sum(counts)
+    
+    # 阶段 2: 丢弃最早的消息
+    if total > budget and keep_from > 0:
+        # openai_req["messages"] 的最后 len(messages) 条与 Claude 消息一一对应
+        message_counts = counts[len(counts) - len(messages):]
+        dropped_tokens = 0
+        cut = 0
+        step = 1
+        last = min(keep_from, len(messages) - 1)    # 截断点最远可以是保留区的第一条消息
+        user_turns = [i for i, msg in enumerate(messages) if msg.get("role") == "user"]
+        while total - dropped_tokens > budget and cut < last:
+            target = max(min(step * COMPACT_DROP_STEP, last), cut + 1)
+            # 截断点对齐到 target 及之后的第一条 user 消息，保证对话以 user 开头；
+            # 之后直到保留区都没有 user 消息时，退回 target 之前最近的一条
+            pos = bisect.bisect_left(user_turns, target)
+            if pos < len(user_turns) and user_turns[pos] <= last:
+                new_cut = user_turns[pos]
+            elif pos > 0 and user_turns[pos - 1] > cut:
+                new_cut = user_turns[pos - 1]
+            else:
+                break
+            dropped_tokens += sum(message_counts[cut:new_cut])
+            cut = new_cut
+            step += 1
+        if cut:
+            note = f"[Earlier conversation trimmed by middleware: {cut} messages omitted]\n\n"
+            first = _detach_tool_results(messages[cut])
+            if isinstance(first.get("content"), str):
+                first = {**first, "content": note + first["content"]}
+            else:
+                first = {**first, "content": [{"type": "text", "text": note}] + list(first["content"])}
+            messages = [first] + messages[cut + 1:]
+            stats["messages_dropped"] = cut
+            compacted = {**body, "messages": messages}
+    
+    return compacted, stats
+
+def sse_event(event_type, data):
+    """按 Anthropic SSE 格式编码一个事件"""
+    return b"event: " + event_type.encode("ascii") + b"\ndata: " + json_dumps(data) + b"\n\n"
+
+def map_finish_reason(finish_reason, has_tool_use):
+    """OpenAI finish_reason -> Claude stop_reason"""
+    if has_tool_use:
+        return "tool_use"
+    if finish_reason == "length":
+        return "max_tokens"
+    return "end_turn"
+
+async def stream_claude_events(upstream, message_id, tool_rules=None, on_finish=None, max_tokens=0, upstream_started=None, on_complete=None, input_tokens=0):
+    """
+    读取 vLLM 的 OpenAI SSE 流，实时翻译为 Claude 的 SSE 事件:
+    message_start -> content_block_start/delta/stop -> message_delta -> message_stop
+    工具调用由 StreamingToolCallParser 增量解析，参数以 input_json_delta 边生成边发送；
+    native 模式下 vLLM 返回的 delta.tool_calls 直接翻译为 tool_use 块
+    on_finish(ok): 上游流结束 (或出错) 时回调，ok 表示上游是否正常
+    on_complete(upstream): 流完整结束时以 vLLM 输出 (content 片段、原生 tool_calls、finish_reason、usage、耗时) 回调，用于流量录制与响应缓存
+    input_tokens: 本地计算的 Prompt Token 数，放入 message_start 的 usage
+    客户端断开时生成器被取消，finally 中关闭上游连接，vLLM 随之中止生成
+    """
+    parser = StreamingToolCallParser(tool_rules)
+    block_index = 0
+    text_block_open = False
+    pending_ws = ""     # 块之间的纯空白先扣留，避免产生空文本块
+    has_tool_use = False
+    finish_reason = None
+    usage = {"prompt_tokens": 0, "completion_tokens": 0}
+    
+    def translate(events):
+        nonlocal block_index, text_block_open, pending_ws, has_tool_use
+        for event in events:
+            kind = event[0]
+            if kind == "text":
+                text = pending_ws + event[1]
+                pending_ws = ""
+                if not text_block_open:
+                    if not text.strip():
+                        pending_ws = text
+                        continue
+                    yield sse_event("content_block_start", {
+                        "type": "content_block_start",
+                        "index": block_index,
+                        "content_block": {"type": "text", "text": ""}
+                    })
+                    text_block_open = True
+                yield sse_event("content_block_delta", {
+                    "type": "content_block_delta",
+                    "index": block_index,
+                    "delta": {"type": "text_delta", "text": text}
+                })
+            elif kind == "tool_start":
+                if text_block_open:
+                    yield sse_event("content_block_stop", {"type": "content_block_stop", "index": block_index})
+                    block_index += 1
+                    text_block_open = False
+                pending_ws = ""
+                has_tool_use = True
+                yield sse_event("content_block_start", {
+                    "type": "content_block_start",
+                    "index": block_index,
+                    "content_block": {"type": "tool_use", "id": event[1], "name": event[2], "input": {}}
+                })
+            elif kind == "tool_delta":
+                yield sse_event("content_block_delta", {
+                    "type": "content_block_delta",
+                    "index": block_index,
+                    "delta": {"type": "input_json_delta", "partial_json": event[1]}
+                })
+            elif kind == "tool_stop":
+                yield sse_event("content_block_stop", {"type": "content_block_stop", "index": block_index})
+                block_index += 1
+    
+    upstream_ok = True
+    cancelled = False
+    generated_chunks = 0    # vLLM 流式输出基本每个 chunk 一个 token
+    started_at = time.monotonic()
+    upstream_started = upstream_started or started_at
+    parse_seconds = 0.0
+    captured_chunks = [] if on_complete else None
+    captured_tool_calls = []
+    first_chunk_at = None
+    native_tool_index = None    # 正在输出的 vLLM 原生工具调用 (delta.tool_calls 的 index)
+    native_tool_count = 0
+    metric_inc(STREAMS_IN_FLIGHT)
+    try:
+        # message_start 也在 try 内: 客户端在第一个事件处断开时同样关闭上游并回调 on_finish
+        yield sse_event("message_start", {
+            "type": "message_start",
+            "message": {
+                "id": message_id,
+                "type": "message",
+                "role": "assistant",
+                "content": [],
+                "model": TARGET_MODEL_NAME,
+                "stop_reason": None,
+                "stop_sequence": None,
+                "usage": {"input_tokens": input_tokens, "output_tokens": 0}
+            }
+        })
+        async for line in upstream.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                chunk = json_loads(data)
+            except json.JSONDecodeError:  # orjson.JSONDecodeError 是其子类
+                logger.warning("⚠️ 无法解析的流式 chunk: %s", preview(data, 100))
+                continue
+            
+            if chunk.get("usage"):
+                usage = chunk["usage"]
+            if not chunk.get("choices"):
+                continue
+            
+            choice = chunk["choices"][0]
+            if choice.get("finish_reason"):
+                finish_reason = choice["finish_reason"]
+            delta = choice.get("delta") or {}
+            delta_text = delta.get("content") or ""
+            if native_tool_index is not None and delta_text:
+                events = [("tool_stop",)]
+                native_tool_index = None
+                for sse in translate(events):
+                    yield sse
+            for tool_delta in delta.get("tool_calls") or ():
+                events = []
+                function = tool_delta.get("function") or {}
+                index = tool_delta.get("index", 0)
+                if index != native_tool_index:
+                    if native_tool_index is not None:
+                        events.append(("tool_stop",))
+                    native_tool_index = index
+                    native_tool_count += 1
+                    name = function.get("name")
+                    record_tool_parse(name, "native")
+                    tool_id = tool_delta.get("id") or f"call_{index}_{os.urandom(4).hex()}"
+                    events.append(("tool_start", tool_id, name))
+                    if captured_chunks is not None:
+                        captured_tool_calls.append({"id": tool_id, "type": "function", "function": {"name": name, "arguments": ""}})
+                if function.get("arguments"):
+                    events.append(("tool_delta", function["arguments"]))
+                    if captured_chunks is not None:
+                        captured_tool_calls[-1]["function"]["arguments"] += function["arguments"]
+                for sse in translate(events):
+                    yield sse
+            if delta_text:
+                if not generated_chunks:
+                    first_chunk_at = time.monotonic()
+                    metric_observe(UPSTREAM_TTFB_SECONDS, first_chunk_at - upstream_started, "true")
+                generated_chunks += 1
+                if captured_chunks is not None:
+                    captured_chunks.append(delta_text)
+                parse_start = time.perf_counter()
+                events = parser.feed(delta_text)
+                parse_seconds += time.perf_counter() - parse_start
+                for sse in translate(events):
+                    yield sse
+    except httpx.HTTPError:
+        upstream_ok = False
+        raise
+    except (asyncio.CancelledError, GeneratorExit):
+        cancelled = True
+        raise
+    finally:
+        await upstream.aclose()
+        metric_dec(STREAMS_IN_FLIGHT)
+        metric_observe(UPSTREAM_SECONDS, time.monotonic() - upstream_started, "true")
+        metric_observe(STAGE_SECONDS, parse_seconds, "parse_tool_calls_stream")
+        if cancelled:
+            record_cancellation(max_tokens, generated_chunks, time.monotonic() - started_at, stream=True)
+        elif upstream_ok and captured_chunks is not None:
+            on_complete({
+                "chunks": captured_chunks,
+                **({"tool_calls": captured_tool_calls} if captured_tool_calls else {}),
+                "finish_reason": finish_reason,
+                "usage": usage,
+                "ttfb_seconds": round((first_chunk_at or time.monotonic()) - upstream_started, 4),
+                "seconds": round(time.monotonic() - upstream_started, 4),
+            })
+        if on_finish:
+            on_finish(upstream_ok)
+    
+    # 流结束: 关闭原生工具调用块，输出扣留的文本，补全未闭合的工具调用
+    if native_tool_index is not None:
+        for sse in translate([("tool_stop",)]):
+            yield sse
+    for sse in translate(parser.finish()):
+        yield sse
+    if text_block_open:
+        yield sse_event("content_block_stop", {"type": "content_block_stop", "index": block_index})
+    if parser.tool_count:
+        logger.info("✅ 流式解析: %d 个工具", parser.tool_count)
+    if native_tool_count:
+        logger.info("✅ vLLM 原生工具调用: %d 个工具", native_tool_count)
+    metric_inc(TOKENS_TOTAL, usage.get("prompt_tokens", 0), "prompt")
+    metric_inc(TOKENS_TOTAL, usage.get("completion_tokens", 0), "completion")
+    
+    yield sse_event("message_delta", {
+        "type": "message_delta",
+        "delta": {
+            "stop_reason": map_finish_reason(finish_reason, has_tool_use),
+            "stop_sequence": None
+        },
+        "usage": final_stream_usage(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+    })
+    yield sse_event("message_stop", {"type": "message_stop"})
+
+class MiddlewareStatsCollector:
+    """
+    抓取时把副本池、准入队列、断开取消、响应缓存、在途请求合并与各缓存的统计导出为 Prometheus 指标
+    这些统计保存在进程内，多进程模式下不跨进程汇总，只反映处理该次抓取的工作进程
+    """
+    
+    def collect(self):
+        pool = upstream_pool.stats()
+        outstanding = GaugeMetricFamily("qwen_middleware_upstream_outstanding", "In-flight requests per vLLM replica", labels=["backend"])
+        healthy = GaugeMetricFamily("qwen_middleware_upstream_healthy", "1 if the replica passes health checks and its breaker is closed", labels=["backend"])
+        for b in pool["backends"]:
+            outstanding.add_metric([b["base_url"]], b["outstanding"])
+            healthy.add_metric([b["base_url"]], int(b["healthy"] and b["breaker"] == "closed"))
+        yield outstanding
+        yield healthy
+        yield GaugeMetricFamily("qwen_middleware_upstream_inflight_ratio", "Middleware requests in flight to vLLM / UPSTREAM_MAX_CONNECTIONS (not connection-pool state)", value=pool["transport"]["inflight_ratio"])
+        connection_pool = pool["transport"]["connection_pool"]
+        if connection_pool is not None:
+            connections = GaugeMetricFamily("qwen_middleware_upstream_connections", "Open connections in the httpx pool to vLLM (health checks included)", labels=["state"])
+            connections.add_metric(["active"], connection_pool["active"])
+            connections.add_metric(["idle"], connection_pool["idle"])
+            yield connections
+            yield GaugeMetricFamily("qwen_middleware_upstream_connection_queue", "Requests waiting for a connection from the httpx pool", value=connection_pool["queued"])
+        for key in ("retries", "connect_errors", "first_byte_timeouts", "breaker_opens", "fast_failures"):
+            yield CounterMetricFamily(f"qwen_middleware_upstream_{key}", f"Upstream transport {key.replace('_', ' ')}", value=pool["transport"][key])
+        for key in ("hits", "misses", "spills", "reused_prefill_tokens"):
+            yield CounterMetricFamily(f"qwen_middleware_prefix_affinity_{key}", f"Prefix affinity routing {key.replace('_', ' ')}", value=pool["prefix_affinity"][key])
+        
+        adm = admission.stats()
+        yield GaugeMetricFamily("qwen_middleware_admission_inflight_requests", "Requests admitted and not yet finished", value=adm["inflight_requests"])
+        yield GaugeMetricFamily("qwen_middleware_admission_inflight_tokens", "Prompt + max_tokens of admitted requests", value=adm["inflight_tokens"])
+        yield GaugeMetricFamily("qwen_middleware_admission_queue_depth", "Requests waiting for admission", value=adm["queue_depth"])
+        for key in ("admitted", "queued", "rejected", "timeouts"):
+            yield CounterMetricFamily(f"qwen_middleware_admission_{key}", f"Admission control {key}", value=adm[key])
+        
+        for key, value in cancellation_stats.items():
+            yield CounterMetricFamily(f"qwen_middleware_{key}", f"Client disconnects: {key.replace('_', ' ')}", value=value)
+        for key, value in tool_compaction_stats.items():
+            yield CounterMetricFamily(f"qwen_middleware_tool_compaction_{key}", f"Tool-definition compaction: {key.replace('_', ' ')}", value=value)
+        
+        cache_hits = CounterMetricFamily("qwen_middleware_cache_hits", "Cache hits", labels=["cache"])
+        cache_misses = CounterMetricFamily("qwen_middleware_cache_misses", "Cache misses", labels=["cache"])
+        for name, cache in (("token", token_cache), ("tool_prompt", tool_prompt_cache), ("tool_compaction", tool_compaction_cache), ("conversion", conversion_cache)):
+            cache_hits.add_metric([name], cache.hits)
+            cache_misses.add_metric([name], cache.misses)
+        yield cache_hits
+        yield cache_misses
+        
+        rc = response_cache.stats()
+        response_hits = CounterMetricFamily("qwen_middleware_response_cache_hits", "Response cache hits", labels=["tier"])
+        response_hits.add_metric(["memory"], rc["hits_memory"])
+        response_hits.add_metric(["disk"], rc["hits_disk"])
+        yield response_hits
+        for key in ("misses", "bypassed", "stores", "expired", "disk_errors"):
+            yield CounterMetricFamily(f"qwen_middleware_response_cache_{key}", f"Response cache {key.replace('_', ' ')}", value=rc[key])
+        yield GaugeMetricFamily("qwen_middleware_response_cache_entries", "Responses held in the in-memory cache tier", value=rc["entries"])
+        yield GaugeMetricFamily("qwen_middleware_response_cache_bytes", "Size of the in-memory cache tier", value=rc["bytes"])
+        sf = inflight_requests.stats()
+        for key in ("leaders", "coalesced", "waiter_limit", "leader_failures"):
+            yield CounterMetricFamily(f"qwen_middleware_single_flight_{key}", f"Single-flight coalescing {key.replace('_', ' ')}", value=sf[key])
+        yield GaugeMetricFamily("qwen_middleware_single_flight_inflight", "Deterministic requests that others can attach to", value=sf["inflight"])
+        yield GaugeMetricFamily("qwen_middleware_single_flight_waiters", "Requests attached to an in-flight identical request", value=sf["waiters"])
+        yield CounterMetricFamily("qwen_middleware_log_records_dropped", "Log records dropped because the log queue was full", value=DroppingQueueHandler.dropped)
+
+if prometheus_client is not None:
+    METRICS_REGISTRY.register(MiddlewareStatsCollector())
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 抓取接口"""
+    if prometheus_client is None:
+        return FastJSONResponse(content={"error": "prometheus_client is not installed (pip install prometheus_client)"}, status_code=503)
+    registry = METRICS_REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # 多进程模式: 汇总所有工作进程的直方图与计数器 (需在启动前设置该目录)
+        from prometheus_client import multiprocess
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        # 进程内统计无法经多进程目录汇总，仍导出本进程的值
+        registry.register(MiddlewareStatsCollector())
+    return Response(content=prometheus_client.generate_latest(registry), media_type=prometheus_client.CONTENT_TYPE_LATEST)
+
+@app.get("/upstream/stats")
+async def upstream_stats():
+    """各副本负载、健康状况、前缀亲和命中、准入队列、客户端断开、流量录制、响应缓存、在途请求合并与工具定义压缩统计，以及本进程的 CPU 时间 (压测用)"""
+    return {
+        **upstream_pool.stats(),
+        "admission": admission.stats(),
+        "cancellation": cancellation_stats,
+        "capture": traffic_recorder.stats(),
+        "response_cache": response_cache.stats(),
+        "single_flight": inflight_requests.stats(),
+        "tool_compaction": {
+            **tool_compaction_stats,
+            "avg_tokens_saved": round(tool_compaction_stats["tokens_saved"] / max(tool_compaction_stats["requests"], 1), 1),
+        },
+        "process": {"pid": os.getpid(), "cpu_seconds": time.process_time()},
+    }
+
+@app.post("/v1/messages/count_tokens")
+@app.post("/messages/count_tokens")
+async def count_claude_tokens(request: Request):
+    """Anthropic token 计数接口: 走与 /v1/messages 相同的转换与工具注入流程，返回 vLLM 实际看到的 Prompt 大小，不占用 GPU"""
+    start_request_log(request)
+    try:
+        body = json_loads(await request.body())
+        openai_req, _ = build_openai_request(body)
+        input_tokens = count_request_tokens(openai_req)
+        logger.info("📏 [count_tokens] %d tokens", input_tokens)
+        return FastJSONResponse(content={"input_tokens": input_tokens})
+    except Exception as e:
+        logger.warning("❌ count_tokens 错误: %s", e)
+        return FastJSONResponse(
+            content={"type": "error", "error": {"type": "invalid_request_error", "message": str(e)}},
+            status_code=400
+        )
+
 @app.post("/v1/messages")
 @app.post("/messages")
 async def proxy_claude_messages(request: Request):
+    metric_inc(REQUESTS_IN_FLIGHT)
+    request_id = start_request_log(request)
+    flight = None
     try:
-        body = await request.json()
-        print("\n📨 [Claude Request] 收到 /v1/messages 请求")
+        body = json_loads(await request.body())
+        # 录制客户端发来的原始请求 (自动压缩之前)，回放时重走完整流程
+        capture_body = body if traffic_recorder.sampled() else None
         
-        # 1. 估算 Token (80k 保护)
-        total_chars = 0
-        if "system" in body:
-             total_chars += len(body["system"])
-        for msg in body.get("messages", []):
-            content = msg.get("content", "")
-            if isinstance(content, str):
-                total_chars += len(content)
+        # 1 + 2. 协议转换并构建发送给 vLLM 的请求
+        stream = bool(body.get("stream", False))
+        logger.info("📨 [Claude Request] 收到 /v1/messages 请求", extra={"fields": {
+            "stream": stream, "messages": len(body.get("messages", [])), "tools": len(body.get("tools") or [])
+        }})
+        openai_req, raw_tools = build_openai_request(body, stream=stream)
+        declared_tools_var.set(frozenset(tool["name"] for tool in raw_tools))
         
-        if (total_chars // 3) > MAX_CONTEXT_TOKENS:
-             return JSONResponse(
+        # 3. 精确计算 Prompt Token (80k 保护，含工具 Prompt 与历史中的 tool_use/tool_result)
+        with observe_stage("count_tokens"):
+            prompt_tokens = count_request_tokens(openai_req)
+            tool_tokens_saved = record_tool_compaction(body, raw_tools)
+        logger.info("📏 Prompt Token: %d (工具定义压缩节省 %d，Token 缓存 %.0f%% 命中，转换缓存 %.0f%% 命中)",
+                    prompt_tokens, tool_tokens_saved, token_cache.stats()["hit_rate"] * 100, conversion_cache.stats()["hit_rate"] * 100,
+                    extra={"fields": {"prompt_tokens": prompt_tokens, "tool_tokens_saved": tool_tokens_saved}})
+        response_headers = {"X-Request-Id": request_id}
+        if prompt_tokens > MAX_CONTEXT_TOKENS and AUTO_COMPACT_ENABLED:
+            with observe_stage("compact"):
+                body, compaction = compact_claude_body(body, MAX_CONTEXT_TOKENS)
+                openai_req, raw_tools = build_openai_request(body, stream=stream)
+                compacted_tokens = count_request_tokens(openai_req)
+            compaction["trimmed_tokens"] = prompt_tokens - compacted_tokens
+            logger.info("🗜️ 自动压缩: %d -> %d tokens (截断 %d 个 tool_result，丢弃 %d 条消息)",
+                        prompt_tokens, compacted_tokens, compaction["tool_results_truncated"], compaction["messages_dropped"])
+            prompt_tokens = compacted_tokens
+            response_headers.update({
+                "X-Context-Trimmed-Tokens": str(compaction["trimmed_tokens"]),
+                "X-Context-Truncated-Tool-Results": str(compaction["tool_results_truncated"]),
+                "X-Context-Dropped-Messages": str(compaction["messages_dropped"]),
+            })
+        if prompt_tokens > MAX_CONTEXT_TOKENS:
+             return FastJSONResponse(
                 content={
                     "type": "error",
                     "error": {
                         "type": "invalid_request_error",
-                        "message": f"Context limit reached! Please run /compact."
+                        "message": f"Context limit reached ({prompt_tokens} > {MAX_CONTEXT_TOKENS} tokens)! Please run /compact."
                     }
                 },
                 status_code=400
             )
 
-        # 2. 协议转换: Claude -> OpenAI
-        openai_messages, raw_tools = convert_claude_messages_to_openai(body)
-        
-        # === 核心修正：工具 Prompt 注入 ===
-        stop_tokens = [] # 动态停止词
-        
-        if raw_tools:
-            tool_prompt = generate_tool_system_prompt(raw_tools)
-            stop_tokens = ["</tool_call>", "</tool_code>"] # 告诉模型写完工具调用就停
-            
-            # 策略：如果 messages 里没有 system，就新建一个。
-            # 如果有，我们在 User 消息里注入提醒，而不是仅仅修改 System Prompt
-            # 因为长对话中 System Prompt 容易被遗忘
-            
-            # A. 确保 System Prompt 存在
-            system_msg_index = -1
-            for i, msg in enumerate(openai_messages):
-                if msg["role"] == "system":
-                    system_msg_index = i
-                    break
-            
-            if system_msg_index >= 0:
-                # 替换或追加到现有 system
-                openai_messages[system_msg_index]["content"] += "\n\n" + tool_prompt
+        # 4. 响应缓存: 确定性请求命中时直接返回，不排队、不占用 GPU
+        request_key = cache_key = None
+        bypass = request.headers.get(RESPONSE_CACHE_BYPASS_HEADER, "0").lower() not in ("", "0", "false")
+        if (response_cache.enabled or inflight_requests.enabled) and is_deterministic(openai_req):
+            request_key = response_cache_key(openai_req, raw_tools)
+        if response_cache.enabled and request_key:
+            cache_key = request_key
+            if bypass:
+                response_cache.count("bypassed")
+                response_headers["X-Cache"] = "BYPASS"
             else:
-                # 插入新的 system 消息到开头
-                openai_messages.insert(0, {
-                    "role": "system",
-                    "content": tool_prompt
-                })
-            
-            # B. [关键] 在最后一条 User Message 追加强力提醒
-            # 只有当用户确实在说话时才追加
-            if openai_messages and openai_messages[-1]["role"] == "user":
-                reminder = "\n\n(IMPORTANT: If you need to use a tool, output the JSON inside <tool_call> tags immediately. Do not explain.)"
-                openai_messages[-1]["content"] += reminder
-            
-            print(f"💉 已注入 {len(raw_tools)} 个工具定义 (System + User Reminder)")
-
-        # 3. 构建发送给 vLLM 的请求
-        openai_req = {
-            "model": TARGET_MODEL_NAME,
-            "messages": openai_messages,
-            "max_tokens": body.get("max_tokens", 4096),
-            "temperature": body.get("temperature", 0.7),
-            "stream": False,
-            "stop": stop_tokens if stop_tokens else None # 使用 Stop Token 防止废话
-        }
+                cached = await response_cache.get(cache_key)
+                if cached is not None:
+                    logger.info("💾 响应缓存命中", extra={"fields": {"cache": "hit"}})
+                    response_headers["X-Cache"] = "HIT"
+                    claude_response = finalize_openai_response(cached_openai_result(cached), raw_tools)
+                    if stream:
+                        return StreamingResponse(
+                            claude_message_events(claude_response, prompt_tokens),
+                            media_type="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **response_headers}
+                        )
+                    return FastJSONResponse(content=claude_response, headers=response_headers)
+                response_headers["X-Cache"] = "MISS"
+
+        # 5. 在途请求合并: 相同的确定性请求正在生成时，订阅它的输出 / 等待它的结果，不再访问 vLLM
+        if inflight_requests.enabled and request_key and not bypass:
+            leader = inflight_requests.get(request_key)
+            if leader is not None:
+                logger.info("🔗 合并到在途的相同请求 %s (等待者 %d)", leader.request_id, leader.followers + 1,
+                            extra={"fields": {"coalesced_with": leader.request_id}})
+                coalesced = await inflight_requests.follow(request, leader, stream)
+                if coalesced is not None:
+                    response_headers["X-Coalesced-With"] = leader.request_id
+                    kind, value = coalesced
+                    if kind == "events":
+                        return ClosingStreamingResponse(
+                            value,
+                            on_close=functools.partial(inflight_requests.detach, leader),
+                            media_type="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **response_headers}
+                        )
+                    claude_response = finalize_openai_response(cached_openai_result(value), raw_tools)
+                    if stream:
+                        return StreamingResponse(
+                            claude_message_events(claude_response, prompt_tokens),
+                            media_type="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **response_headers}
+                        )
+                    return FastJSONResponse(content=claude_response, headers=response_headers)
+                logger.info("🔗 在途请求 %s 未能返回结果，自行请求 vLLM", leader.request_id)
+            flight = inflight_requests.lead(request_key, stream, request_id)
+        # leader 的客户端断开后，只要还有相同请求在等待就继续生成
+        keep_alive = (lambda: flight.followers > 0) if flight else None
+
+        # 6. 准入控制: 在途请求数 / Token 预算已满时按优先级排队
+        request_tokens = prompt_tokens + openai_req["max_tokens"]
+        try:
+            priority = int(request.headers.get(ADMISSION_PRIORITY_HEADER, 0))
+        except ValueError:
+            priority = 0
+        try:
+            waited = await cancel_on_disconnect(request, admission.acquire(request_tokens, priority), keep_alive)
+        except ClientDisconnected:
+            cancellation_stats["cancelled_while_queued"] += 1
+            raise
+        metric_observe(STAGE_SECONDS, waited, "admission_wait")
+        if waited:
+            logger.info("⏳ 排队 %.2fs 后放行 (队列剩余 %d)", waited, len(admission.queue), extra={"fields": {"queue_wait_s": round(waited, 3)}})
+        admitted_at = time.monotonic()
+        handed_off = False
+        admission_released = False
         
-        # 🚫 删除 API 参数
-        if "tools" in openai_req: del openai_req["tools"]
-        if "tool_choice" in openai_req: del openai_req["tool_choice"]
-
-        print(f"🚀 转发给 vLLM (端口 8001)...")
-        response = await client.post(
-            f"{VLLM_API_BASE}/chat/completions",
-            json=openai_req,
-            headers={"Authorization": f"Bearer {VLLM_API_KEY}"},
-            timeout=600.0
-        )
+        def release_admission():
+            """归还准入名额 (只归还一次): 流式请求由生成器的 finally 或响应的 on_close 兜底调用"""
+            nonlocal admission_released
+            if not admission_released:
+                admission_released = True
+                admission.release(request_tokens, time.monotonic() - admitted_at)
         
-        if response.status_code != 200:
-            print(f"❌ vLLM 报错 (Status {response.status_code}): {response.text}")
-            return JSONResponse(content={"error": f"vLLM Error: {response.text}"}, status_code=response.status_code)
+        try:
+            # 7. 选择上游副本 (前缀亲和一致性哈希，过载或不可用时退回最少在途请求 / 在途 Token) 并发送
+            upstream_started = time.monotonic()
+            try:
+                backend, upstream = await cancel_on_disconnect(request, send_upstream(
+                    openai_req,
+                    request_tokens,
+                    prefix_key=prompt_prefix_key(openai_req["messages"]),
+                    prompt_tokens=prompt_tokens
+                ), keep_alive)
+                while upstream.status_code == 400 and (openai_req.get("tools") or openai_req.get("response_format")):
+                    # vLLM 不支持 native 工具调用或结构化输出: 关闭该特性后重发 (每个特性最多一次)
+                    error_text = (await upstream.aread()).decode("utf-8", errors="replace")
+                    await upstream.aclose()
+                    upstream_pool.release(backend, request_tokens, ok=True)
+                    feature = rejected_feature(openai_req, upstream.status_code, error_text)
+                    if feature is None:
+                        logger.error("❌ vLLM 报错 (Status %d): %s", upstream.status_code, preview(error_text))
+                        return FastJSONResponse(content={"error": f"vLLM Error: {error_text}"}, status_code=upstream.status_code)
+                    disable_feature(feature, error_text)
+                    openai_req, raw_tools = build_openai_request(body, stream=stream)
+                    backend, upstream = await cancel_on_disconnect(request, send_upstream(
+                        openai_req,
+                        request_tokens,
+                        prefix_key=prompt_prefix_key(openai_req["messages"]),
+                        prompt_tokens=prompt_tokens
+                    ), keep_alive)
+            except ClientDisconnected:
+                record_cancellation(openai_req["max_tokens"], 0, time.monotonic() - admitted_at, stream=stream)
+                raise
+
+            if stream:
+                # 流式模式: 先检查状态码，再把 chunk 边收边转
+                logger.info("🚀 转发给 vLLM (流式, %s)...", backend.base_url)
+                if upstream.status_code != 200:
+                    error_text = (await upstream.aread()).decode("utf-8", errors="replace")
+                    await upstream.aclose()
+                    upstream_pool.release(backend, request_tokens, ok=upstream.status_code < 500)
+                    logger.error("❌ vLLM 报错 (Status %d): %s", upstream.status_code, preview(error_text))
+                    return FastJSONResponse(content={"error": f"vLLM Error: {error_text}"}, status_code=upstream.status_code)
             
-        openai_result = response.json()
-        
-        # === 调试日志 ===
-        raw_response_content = openai_result["choices"][0]["message"].get("content", "")
-        print(f"🔍 [Model Response Preview]: {raw_response_content[:200]}...")
-        if "<tool_call>" in raw_response_content or "<tool_code>" in raw_response_content:
-            print("✨ 检测到 XML 标记！")
-        else:
-            print("⚠️ 未检测到 XML 标记 (可能是纯文本回复)")
-        # ==============
+                message_id = f"msg_{os.urandom(12).hex()}"
+                
+                # 副本与准入名额随流结束一起释放 (副本只释放一次)
+                backend_released = False
+                
+                def release_backend(ok):
+                    nonlocal backend_released
+                    if not backend_released:
+                        backend_released = True
+                        upstream_pool.release(backend, request_tokens, ok)
+                
+                def finish_stream(ok):
+                    release_backend(ok)
+                    release_admission()
+                
+                # 兜底: body 从未开始迭代 (或在首个事件前被取消) 时生成器的 finally 不会执行，由响应关闭上游并释放副本与准入名额
+                async def close_stream():
+                    await upstream.aclose()
+                    finish_stream(True)
+                
+                # 完整结束的流: 录制 / 写入响应缓存 / 把结果交给等待中的相同请求
+                def complete_stream(upstream_result):
+                    if capture_body:
+                        capture_exchange(capture_body, request_id, True, upstream_result)
+                    if cache_key:
+                        response_cache.put(cache_key, upstream_result)
+                    if flight:
+                        inflight_requests.finish(flight, upstream_result)
+                events = stream_claude_events(
+                    upstream, message_id, resolve_tool_arg_rules(raw_tools),
+                    on_finish=finish_stream,
+                    max_tokens=openai_req["max_tokens"],
+                    upstream_started=upstream_started,
+                    on_complete=complete_stream if capture_body or cache_key or flight else None,
+                    input_tokens=prompt_tokens
+                )
+                if flight:
+                    # 由后台任务读取 vLLM，leader 与相同的流式请求都订阅它的输出
+                    events = inflight_requests.broadcast(flight, events, close_stream)
+                handed_off = True
+                return ClosingStreamingResponse(
+                    events,
+                    on_close=functools.partial(inflight_requests.detach, flight, leader=True) if flight else close_stream,
+                    media_type="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **response_headers}
+                )
 
-        # 4. 检查并修复 XML 工具调用
-        choice = openai_result["choices"][0]
-        content = choice["message"].get("content", "") or ""
-        
-        # 如果因为 stop token 停止，我们需要把被截断的闭合标签补回来以便正则匹配
-        if openai_result["choices"][0].get("finish_reason") == "stop":
-             # 检查是否以未闭合的标签结尾
-             if "<tool_call>" in content and "</tool_call>" not in content:
-                 content += "</tool_call>"
-             elif "<tool_code>" in content and "</tool_code>" not in content:
-                 content += "</tool_code>"
+            logger.info("🚀 转发给 vLLM (%s)...", backend.base_url)
+            # 非流式响应头与完整结果一起返回，首字节时间即 vLLM 排队 + 生成时间
+            metric_observe(UPSTREAM_TTFB_SECONDS, time.monotonic() - upstream_started, "false")
+            try:
+                await cancel_on_disconnect(request, upstream.aread(), keep_alive)
+            except ClientDisconnected:
+                upstream_pool.release(backend, request_tokens, ok=True)
+                record_cancellation(openai_req["max_tokens"], 0, time.monotonic() - admitted_at)
+                raise
+            except httpx.HTTPError:
+                upstream_pool.release(backend, request_tokens, ok=False)
+                raise
+            finally:
+                await upstream.aclose()
+            # 连接错误与 5xx 计为副本失败；4xx (如参数错误) 与副本无关
+            upstream_pool.release(backend, request_tokens, ok=upstream.status_code < 500)
+            metric_observe(UPSTREAM_SECONDS, time.monotonic() - upstream_started, "false")
+            response = upstream
         
-        if "<tool_call>" in content or "<tool_code>" in content:
-            print(f"🛠️ 正在解析 XML 工具调用...")
-            extracted_tools = parse_hermes_xml(content)
-            if extracted_tools:
-                print(f"✅ 解析成功: {len(extracted_tools)} 个工具")
-                choice["message"]["tool_calls"] = extracted_tools
-            else:
-                print(f"❌ 解析失败: 找到了标签但无法提取 JSON")
+            if response.status_code != 200:
+                logger.error("❌ vLLM 报错 (Status %d): %s", response.status_code, preview(response.text))
+                return FastJSONResponse(content={"error": f"vLLM Error: {response.text}"}, status_code=response.status_code)
+            
+            openai_result = json_loads(response.content)
+            usage = openai_result.get("usage") or {}
+            if capture_body or cache_key or flight:
+                upstream_seconds = round(time.monotonic() - upstream_started, 4)
+                message = openai_result["choices"][0]["message"]
+                upstream_result = {
+                    "chunks": [message.get("content") or ""],
+                    **({"tool_calls": message["tool_calls"]} if message.get("tool_calls") else {}),
+                    "finish_reason": openai_result["choices"][0].get("finish_reason"),
+                    "usage": usage,
+                    "ttfb_seconds": upstream_seconds,
+                    "seconds": upstream_seconds,
+                }
+                if capture_body:
+                    capture_exchange(capture_body, request_id, False, upstream_result)
+                if cache_key:
+                    response_cache.put(cache_key, upstream_result)
+                if flight:
+                    inflight_requests.finish(flight, upstream_result)
+            metric_inc(TOKENS_TOTAL, usage.get("prompt_tokens", 0), "prompt")
+            metric_inc(TOKENS_TOTAL, usage.get("completion_tokens", 0), "completion")
         
-        # 5. 协议转换: OpenAI -> Claude
-        claude_response = convert_openai_response_to_claude(openai_result)
+            # === 调试日志 ===
+            if log_preview_enabled():
+                raw_response_content = openai_result["choices"][0]["message"].get("content") or ""
+                logger.debug("🔍 [Model Response Preview]: %s", preview(raw_response_content))
+                if "<tool_call>" in raw_response_content or "<tool_code>" in raw_response_content:
+                    logger.debug("✨ 检测到 XML 标记！")
+                else:
+                    logger.debug("⚠️ 未检测到 XML 标记 (可能是纯文本回复)")
+            # ==============
+
+            # 8. 解析工具调用并转换为 Claude 响应
+            claude_response = finalize_openai_response(openai_result, raw_tools)
         
-        return JSONResponse(content=claude_response)
+            return FastJSONResponse(content=claude_response, headers=response_headers)
+        finally:
+            if not handed_off:
+                release_admission()
 
+    except ClientDisconnected:
+        # 客户端已经收不到响应，返回值只是为了结束请求
+        return FastJSONResponse(content={"error": "Client disconnected"}, status_code=499)
+    except AdmissionRejected as e:
+        logger.warning("🚦 准入拒绝: %s", e)
+        return FastJSONResponse(
+            content={"type": "error", "error": {"type": "overloaded_error", "message": str(e)}},
+            status_code=429,
+            headers={"retry-after": str(e.retry_after)}
+        )
+    except UpstreamUnavailable as e:
+        logger.error("⛔ %s", e)
+        return FastJSONResponse(
+            content={"type": "error", "error": {"type": "overloaded_error", "message": str(e)}},
+            status_code=503,
+            headers={"retry-after": str(e.retry_after)}
+        )
+    except httpx.TimeoutException as e:
+        logger.error("⏱️ vLLM 请求超时: %r", e)
+        return FastJSONResponse(content={"error": f"vLLM upstream timeout: {e!r}"}, status_code=504)
+    except httpx.HTTPError as e:
+        logger.error("❌ 无法连接 vLLM: %r", e)
+        return FastJSONResponse(content={"error": f"vLLM upstream error: {e!r}"}, status_code=502)
     except Exception as e:
-        print(f"❌ 严重错误: {e}")
-        return JSONResponse(content={"error": str(e)}, status_code=500)
+        logger.exception("❌ 严重错误: %s", e)
+        return FastJSONResponse(content={"error": str(e)}, status_code=500)
+    finally:
+        if flight is not None and flight.task is None:
+            # 流式输出已交给后台任务时由它结束在途请求
+            inflight_requests.abandon(flight)
+        metric_dec(REQUESTS_IN_FLIGHT)
 
 if __name__ == "__main__":
-    print(f"🚀 Claude 协议兼容层已启动 (vLLM 400 修复版 + 增强调试)")
-    print(f"🎯 目标模型: {TARGET_MODEL_NAME}")
-    print(f"🔑 API Key: {VLLM_API_KEY}")
-    print(f"📡 监听端口: {PORT}")
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    logger.info("🚀 Claude 协议兼容层已启动 (vLLM 400 修复版 + 增强调试)")
+    logger.info("🎯 目标模型: %s", TARGET_MODEL_NAME)
+    # 与配置覆盖日志一致，不输出 Key 本身
+    logger.info("🔑 API Key: %s", "未设置" if VLLM_API_KEY in ("", "empty") else "已设置 (已隐藏)")
+    logger.info("📡 监听端口: %s (工作进程 %d)", PORT, WORKERS)
+    if WORKERS > 1:
+        # 多进程: 各工作进程重新导入本模块 (配置经环境变量传入)，在启动时各自创建上游客户端
+        module_dir, module_file = os.path.split(os.path.abspath(__file__))
+        uvicorn.run(f"{os.path.splitext(module_file)[0]}:app", host=HOST, port=PORT, workers=WORKERS, app_dir=module_dir)
+    else:
+        uvicorn.run(app, host=HOST, port=PORT)
@@ -0,0 +1,358 @@
+"""
+Replay traffic captured by the middleware (CAPTURE_PATH) for performance regression testing.
+
+Offline mode (default) needs no vLLM. Every recorded Claude request goes through the
+request conversion and token counting of a middleware version: the one next to this
+script, or another checkout via --middleware. The recorded vLLM output then goes
+through its tool-call parser and response conversion. Streaming records keep their
+original chunk boundaries and run through the streaming translator. The report gives
+the time spent in each stage.
+
+Backend mode (--backend) starts fake_vllm.py serving the recorded outputs and the
+middleware in front of it. It sends every request over HTTP and reports end-to-end
+and added latency.
+
+--out saves the per-request results. --compare OLD.json diffs stage timings and parse
+outcomes (stop reason, text digest, tool names and inputs) against an earlier run,
+e.g. of the previous middleware version.
+
+Usage:
+    python replay_capture.py captures/traffic.jsonl.gz
+    python replay_capture.py captures/*.gz --middleware /tmp/old/middleware_fix_qwen.py --out old.json
+    python replay_capture.py captures/*.gz --out new.json --compare old.json
+    python replay_capture.py captures/traffic.jsonl.gz --backend --concurrency 8
+"""
+import argparse
+import asyncio
+import gzip
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import sys
+import time
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def iter_capture(paths):
+    """Yield records from .jsonl.gz / .jsonl capture files, in the given order."""
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+            except EOFError:
+                # the writer was killed before flushing; keep the records read so far
+                print(f"warning: {path} is truncated", file=sys.stderr)
+
+
+def replay_request_id(index):
+    """Request id sent in backend mode; fake_vllm.py --capture maps it back to the record."""
+    return f"replay-{index}"
+
+
+def load_middleware(path):
+    if path is None:
+        sys.path.insert(0, HERE)
+        import middleware_fix_qwen as module
+    else:
+        path = os.path.abspath(path)
+        sys.path.insert(0, os.path.dirname(path))
+        spec = importlib.util.spec_from_file_location("middleware_under_test", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    # the pipeline logs per request; keep the report readable
+    logging.getLogger("qwen_middleware").setLevel(logging.ERROR)
+    return module
+
+
+# ----------------------------------------------------------------------------- outcomes
+
+def outcome_from_blocks(blocks, stop_reason):
+    """Comparable summary of a Claude response (tool ids are random and left out)."""
+    summary = []
+    for block in blocks:
+        if block.get("type") == "text":
+            text = block.get("text", "")
+            summary.append(["text", len(text), hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]])
+        elif block.get("type") == "tool_use":
+            summary.append(["tool_use", block.get("name"), block.get("input")])
+    return {"stop_reason": stop_reason, "blocks": summary}
+
+
+def blocks_from_sse(events):
+    """Rebuild content blocks and the stop reason from Claude SSE event payloads."""
+    blocks, partial, stop_reason = [], {}, None
+    for event in events:
+        kind = event["type"]
+        if kind == "content_block_start":
+            blocks.append(dict(event["content_block"]))
+        elif kind == "content_block_delta":
+            delta = event["delta"]
+            if delta["type"] == "text_delta":
+                blocks[event["index"]]["text"] += delta["text"]
+            else:
+                partial[event["index"]] = partial.get(event["index"], "") + delta["partial_json"]
+        elif kind == "content_block_stop" and event["index"] in partial:
+            raw = partial.pop(event["index"]) or "{}"
+            try:
+                blocks[event["index"]]["input"] = json.loads(raw)
+            except ValueError:
+                blocks[event["index"]]["input"] = {"_invalid_json": raw}
+        elif kind == "message_delta":
+            stop_reason = event["delta"].get("stop_reason")
+    return blocks, stop_reason
+
+
+def parse_sse_payloads(raw):
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf-8")
+    return [json.loads(line[5:]) for line in raw.splitlines() if line.startswith("data:")]
+
+
+# ----------------------------------------------------------------------------- offline
+
+class RecordedStream:
+    """Minimal stand-in for the httpx response that stream_claude_events reads from."""
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+
+    @staticmethod
+    def line(delta, finish_reason=None):
+        return f"data: {json.dumps({'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]})}"
+
+    async def aiter_lines(self):
+        for piece in self.upstream["chunks"]:
+            yield self.line({"content": piece})
+        # native-mode records: vLLM's structured tool calls, streamed as it does (name first, then the arguments)
+        for index, call in enumerate(self.upstream.get("tool_calls") or ()):
+            yield self.line({"tool_calls": [{"index": index, "id": call["id"], "type": "function",
+                                             "function": {"name": call["function"]["name"], "arguments": ""}}]})
+            yield self.line({"tool_calls": [{"index": index, "function": {"arguments": call["function"]["arguments"]}}]})
+        yield self.line({}, self.upstream.get("finish_reason"))
+        yield f"data: {json.dumps({'choices': [], 'usage': self.upstream.get('usage') or {}})}"
+        yield "data: [DONE]"
+
+    async def aclose(self):
+        pass
+
+
+async def replay_offline(mw, record, index):
+    clock = time.perf_counter
+    stages = {}
+    stream = bool(record["stream"])
+    upstream = record["upstream"]
+
+    t0 = clock()
+    openai_req, raw_tools = mw.build_openai_request(record["request"], stream=stream)
+    t1 = clock()
+    mw.count_prompt_tokens(openai_req["messages"])
+    t2 = clock()
+    stages["convert_request"], stages["count_tokens"] = t1 - t0, t2 - t1
+    tool_rules = mw.resolve_tool_arg_rules(raw_tools)
+
+    if stream:
+        events = []
+        async for sse in mw.stream_claude_events(RecordedStream(upstream), f"msg_replay_{index}", tool_rules):
+            events.extend(parse_sse_payloads(sse))
+        t3 = clock()
+        stages["stream_translate"] = t3 - t2
+        blocks, stop_reason = blocks_from_sse(events)
+    else:
+        content = "".join(upstream["chunks"])
+        openai_result = {
+            "id": f"chatcmpl-replay-{index}",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": upstream.get("finish_reason")}],
+            "usage": upstream.get("usage") or {"prompt_tokens": 0, "completion_tokens": 0},
+        }
+        # native-mode records carry vLLM's structured tool calls; the middleware then skips the XML parser
+        tool_calls = list(upstream.get("tool_calls") or [])
+        if not tool_calls and ("<tool_call>" in content or "<tool_code>" in content):
+            tool_calls = mw.parse_hermes_xml(content, tool_rules)
+        t3 = clock()
+        if tool_calls:
+            openai_result["choices"][0]["message"]["tool_calls"] = tool_calls
+        response = mw.convert_openai_response_to_claude(openai_result)
+        t4 = clock()
+        stages["parse_tool_calls"], stages["convert_response"] = t3 - t2, t4 - t3
+        blocks, stop_reason = response["content"], response["stop_reason"]
+    stages["total"] = clock() - t0
+    return {"index": index, "stream": stream, "stages": stages, "outcome": outcome_from_blocks(blocks, stop_reason)}
+
+
+async def run_offline(mw, records):
+    return [await replay_offline(mw, record, i) for i, record in enumerate(records)]
+
+
+# ----------------------------------------------------------------------------- backend
+
+async def replay_backend(client, url, record, index):
+    body = dict(record["request"], stream=bool(record["stream"]))
+    headers = {"x-request-id": replay_request_id(index)}
+    started = time.perf_counter()
+    if body["stream"]:
+        async with client.stream("POST", url, json=body, headers=headers) as resp:
+            raw = await resp.aread()
+        status = resp.status_code
+        blocks, stop_reason = blocks_from_sse(parse_sse_payloads(raw)) if status == 200 else ([], None)
+    else:
+        resp = await client.post(url, json=body, headers=headers)
+        status = resp.status_code
+        data = resp.json() if status == 200 else {}
+        blocks, stop_reason = data.get("content", []), data.get("stop_reason")
+    return {"index": index, "stream": body["stream"], "status": status, "request_id": headers["x-request-id"],
+            "latency": time.perf_counter() - started, "outcome": outcome_from_blocks(blocks, stop_reason)}
+
+
+async def run_backend(url, records, concurrency, timeout):
+    results = [None] * len(records)
+    pending = iter(range(len(records)))
+    async with httpx.AsyncClient(timeout=timeout, trust_env=False) as client:
+        async def worker():
+            for i in pending:
+                results[i] = await replay_backend(client, url, records[i], i)
+
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, len(records)) or 1)))
+    return results
+
+
+def backend_mode(args, capture_paths, records):
+    from load_test import free_port, start_process, stop_process, wait_ready
+
+    procs = []
+    try:
+        fake_port, mw_port = free_port(), free_port()
+        procs.append(start_process([
+            sys.executable, os.path.join(HERE, "fake_vllm.py"), "--port", str(fake_port),
+            "--ttft", str(args.ttft), "--tpot", str(args.tpot), "--capture", *capture_paths,
+        ], "fake_vllm.py"))
+        wait_ready(f"http://127.0.0.1:{fake_port}/health", procs[-1])
+        procs.append(start_process([
+            sys.executable, args.middleware or os.path.join(HERE, "middleware_fix_qwen.py"),
+            "--host", "127.0.0.1", "--port", str(mw_port),
+            "--vllm-api-base", f"http://127.0.0.1:{fake_port}/v1", "--log-level", "WARNING",
+        ], "middleware"))
+        wait_ready(f"http://127.0.0.1:{mw_port}/upstream/stats", procs[-1])
+        started = time.perf_counter()
+        results = asyncio.run(run_backend(f"http://127.0.0.1:{mw_port}/v1/messages", records,
+                                          args.concurrency, args.timeout))
+        elapsed = time.perf_counter() - started
+        timings = httpx.get(f"http://127.0.0.1:{fake_port}/fake/timings", timeout=30).json()
+    finally:
+        for proc in reversed(procs):
+            stop_process(proc)
+    for result in results:
+        upstream = timings.get(result["request_id"])
+        result["stages"] = {"latency": result["latency"]}
+        if upstream is not None:
+            result["stages"]["added_latency"] = result["latency"] - upstream["service"]
+    return results, elapsed
+
+
+# ----------------------------------------------------------------------------- report
+
+def stage_stats(results):
+    """{stage: {"n", "mean_ms", "p50_ms", "p95_ms"}} over the records that ran the stage."""
+    from load_test import percentile
+
+    stats = {}
+    stages = []
+    for result in results:
+        stages.extend(s for s in result["stages"] if s not in stages)
+    stages.sort(key=lambda s: s == "total")
+    for stage in stages:
+        values = [r["stages"][stage] for r in results if stage in r["stages"]]
+        stats[stage] = {
+            "n": len(values),
+            "mean_ms": round(sum(values) / len(values) * 1e3, 3),
+            "p50_ms": round(percentile(values, 50) * 1e3, 3),
+            "p95_ms": round(percentile(values, 95) * 1e3, 3),
+        }
+    return stats
+
+
+def print_stages(stats, baseline=None):
+    header = f"{'stage':<20}{'n':>6}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}"
+    print(header + ("   mean vs baseline" if baseline else ""))
+    for stage, s in stats.items():
+        line = f"{stage:<20}{s['n']:>6}{s['mean_ms']:>10.3f}{s['p50_ms']:>10.3f}{s['p95_ms']:>10.3f}"
+        old = (baseline or {}).get(stage)
+        if old and old["mean_ms"]:
+            line += f"   {old['mean_ms']:.3f} -> {s['mean_ms']:.3f} ({(s['mean_ms'] / old['mean_ms'] - 1) * 100:+.1f}%)"
+        print(line)
+
+
+def diff_outcomes(results, baseline_results, show):
+    old_by_index = {r["index"]: r for r in baseline_results}
+    diffs = [(r, old_by_index[r["index"]]) for r in results
+             if r["index"] in old_by_index and r["outcome"] != old_by_index[r["index"]]["outcome"]]
+    compared = sum(r["index"] in old_by_index for r in results)
+    print(f"\nparse outcomes: {len(diffs)} of {compared} records differ from the baseline")
+    for new, old in diffs[:show]:
+        print(f"  record {new['index']} ({'stream' if new['stream'] else 'non-stream'})")
+        print(f"    baseline: {json.dumps(old['outcome'], ensure_ascii=False)[:300]}")
+        print(f"    current:  {json.dumps(new['outcome'], ensure_ascii=False)[:300]}")
+    return len(diffs)
+
+
+def build_arg_parser():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("capture", nargs="+", help="capture files (.jsonl.gz or .jsonl)")
+    ap.add_argument("--middleware", help="path of the middleware_fix_qwen.py version to test (default: the one next to this script)")
+    ap.add_argument("--limit", type=int, help="replay only the first N records")
+    ap.add_argument("--out", help="write per-request results and the stage summary to this JSON file")
+    ap.add_argument("--compare", help="results file of an earlier run to diff timings and outcomes against")
+    ap.add_argument("--show-diffs", type=int, default=10, help="outcome differences to print")
+    ap.add_argument("--fail-on-diff", action="store_true", help="exit non-zero if any outcome differs from --compare")
+    group = ap.add_argument_group("backend mode")
+    group.add_argument("--backend", action="store_true", help="replay over HTTP through the middleware and fake_vllm.py")
+    group.add_argument("--concurrency", type=int, default=1)
+    group.add_argument("--ttft", type=float, default=0.0, help="fake_vllm.py delay before the first chunk")
+    group.add_argument("--tpot", type=float, default=0.0, help="fake_vllm.py delay per recorded chunk")
+    group.add_argument("--timeout", type=float, default=300.0)
+    return ap
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    records = list(iter_capture(args.capture))
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        raise SystemExit("no records in the capture")
+    print(f"{len(records)} records ({sum(bool(r['stream']) for r in records)} streaming) from {len(args.capture)} file(s)")
+
+    if args.backend:
+        results, elapsed = backend_mode(args, args.capture, records)
+        failed = [r for r in results if r["status"] != 200]
+        print(f"{len(results) - len(failed)} ok, {len(failed)} failed, {len(results) / elapsed:.1f} req/s\n")
+    else:
+        mw = load_middleware(args.middleware)
+        results = asyncio.run(run_offline(mw, records))
+        print()
+
+    stats = stage_stats(results)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_stages(stats, baseline and baseline["stages"])
+    diffs = diff_outcomes(results, baseline["results"], args.show_diffs) if baseline else 0
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"middleware": args.middleware, "mode": "backend" if args.backend else "offline",
+                       "stages": stats, "results": results}, f, ensure_ascii=False)
+    raise SystemExit(1 if diffs and args.fail_on_diff else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Test server-side context compaction (compact_claude_body) against the production code
+import sys
+
+import middleware_fix_qwen as mw
+
+BUDGET = 80000
+BIG = "x" * 60000      # roughly 20k tokens with the character estimate, more with the tokenizer
+failures = 0
+
+
+def request_tokens(body, native=False):
+    openai_req, _ = mw.build_openai_request(body, native=native)
+    return mw.count_request_tokens(openai_req)
+
+
+def check(name, ok, detail=""):
+    global failures
+    print(f"  {'✅' if ok else '❌'} {name} {detail}")
+    failures += not ok
+
+
+def chat_session(n_old, n_recent):
+    """n_old large alternating user/assistant messages followed by n_recent small ones"""
+    messages = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"{i} {BIG}"} for i in range(n_old)]
+    messages += [{"role": "user" if (n_old + i) % 2 == 0 else "assistant", "content": f"recent {i}"} for i in range(n_recent)]
+    return {"model": "m", "max_tokens": 100, "messages": messages}
+
+
+def tool_session(turns):
+    """Claude Code style: one prompt, then assistant tool_use / user tool_result pairs"""
+    messages = [{"role": "user", "content": "fix the bug"}]
+    for i in range(turns):
+        messages.append({"role": "assistant", "content": [
+            {"type": "text", "text": f"step {i} {BIG}"},
+            {"type": "tool_use", "id": f"toolu_{i}", "name": "Read", "input": {"file_path": f"/src/{i}.py"}},
+        ]})
+        messages.append({"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": f"toolu_{i}", "content": f"contents of {i}.py"},
+        ]})
+    tools = [{"name": "Read", "description": "Read a file", "input_schema": {"type": "object", "properties": {"file_path": {"type": "string"}}}}]
+    return {"model": "m", "max_tokens": 100, "tools": tools, "messages": messages}
+
+
+def orphaned_tool_results(messages):
+    seen = set()
+    orphans = []
+    for msg in messages:
+        for part in msg["content"] if isinstance(msg.get("content"), list) else ():
+            if part.get("type") == "tool_use":
+                seen.add(part["id"])
+            elif part.get("type") == "tool_result" and part["tool_use_id"] not in seen:
+                orphans.append(part["tool_use_id"])
+    return orphans
+
+
+print("=== Running Compaction Tests ===")
+for label, body in (
+    # Shorter than COMPACT_DROP_STEP + COMPACT_KEEP_LAST_MESSAGES: the cut has to land on the kept tail itself
+    ("short session (14 messages)", chat_session(8, 6)),
+    ("long session (40 messages)", chat_session(34, 6)),
+):
+    print("-" * 20)
+    print(label)
+    before = request_tokens(body)
+    compacted, stats = mw.compact_claude_body(body, BUDGET)
+    after = request_tokens(compacted)
+    check("fits the budget", after <= BUDGET, f"({before} -> {after} tokens, {stats['messages_dropped']} dropped)")
+    check("starts with a user turn", compacted["messages"][0]["role"] == "user")
+    check("recent messages kept", compacted["messages"][-1] == body["messages"][-1])
+
+print("-" * 20)
+print("native tool session")
+body = tool_session(12)
+compacted, stats = mw.compact_claude_body(body, BUDGET)
+after = request_tokens(compacted, native=True)
+check("fits the budget", after <= BUDGET, f"({after} tokens, {stats['messages_dropped']} dropped)")
+check("no tool_result without its tool_use", not orphaned_tool_results(compacted["messages"]),
+      str(orphaned_tool_results(compacted["messages"])))
+openai_req, _ = mw.build_openai_request(compacted, native=True)
+first = next(m for m in openai_req["messages"] if m["role"] != "system")
+check("converted conversation starts with a user message", first["role"] == "user", f"(got {first['role']})")
+
+sys.exit(1 if failures else 0)
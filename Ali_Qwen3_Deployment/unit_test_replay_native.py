@@ -0,0 +1,112 @@
+# Round trip of native tool-call mode through traffic capture and replay: the tool calls the
+# middleware returned live must come back from replay_capture.py, offline and through fake_vllm.py --capture
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import httpx
+
+import replay_capture
+from load_test import CLAUDE_CODE_TOOLS, free_port, start_process, stop_process, wait_ready
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+failures = 0
+
+
+def check(name, ok, detail=""):
+    global failures
+    print(f"  {'✅' if ok else '❌'} {name} {detail}")
+    failures += not ok
+
+
+def start_with_env(cmd, name, **env):
+    """start_process with extra environment variables for the child only"""
+    saved = {key: os.environ.get(key) for key in env}
+    os.environ.update(env)
+    try:
+        return start_process(cmd, name)
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key)
+            else:
+                os.environ[key] = value
+
+
+def tool_names(outcome):
+    return [block[1] for block in outcome["blocks"] if block[0] == "tool_use"]
+
+
+async def send_live(url, bodies):
+    """Claude outcomes the middleware returned live, in request order"""
+    outcomes = []
+    async with httpx.AsyncClient(timeout=60, trust_env=False) as client:
+        for body in bodies:
+            if body["stream"]:
+                async with client.stream("POST", url, json=body) as resp:
+                    blocks, stop_reason = replay_capture.blocks_from_sse(replay_capture.parse_sse_payloads(await resp.aread()))
+            else:
+                data = (await client.post(url, json=body)).json()
+                blocks, stop_reason = data["content"], data["stop_reason"]
+            outcomes.append(replay_capture.outcome_from_blocks(blocks, stop_reason))
+    return outcomes
+
+
+workdir = tempfile.mkdtemp(prefix="replay_native_")
+capture_path = os.path.join(workdir, "traffic.jsonl.gz")
+bodies = [
+    {"model": "m", "max_tokens": 500, "stream": i % 2 == 1, "tools": CLAUDE_CODE_TOOLS,
+     "messages": [{"role": "user", "content": f"task {i}: fix the failing test"}]}
+    for i in range(8)
+]
+
+print("=== Running Native Capture Replay Tests ===")
+procs = []
+try:
+    fake_port, mw_port = free_port(), free_port()
+    procs.append(start_process([sys.executable, os.path.join(HERE, "fake_vllm.py"), "--port", str(fake_port),
+                                "--ttft", "0", "--tool-ratio", "1", "--messy-ratio", "0"], "fake_vllm.py"))
+    wait_ready(f"http://127.0.0.1:{fake_port}/health", procs[-1])
+    procs.append(start_with_env([sys.executable, os.path.join(HERE, "middleware_fix_qwen.py"), "--host", "127.0.0.1",
+                                 "--port", str(mw_port), "--vllm-api-base", f"http://127.0.0.1:{fake_port}/v1",
+                                 "--log-level", "WARNING"], "middleware",
+                                QWEN_MW_TOOL_CALL_MODE="native", QWEN_MW_CAPTURE_PATH=capture_path,
+                                QWEN_MW_CAPTURE_ANONYMIZE="false"))
+    wait_ready(f"http://127.0.0.1:{mw_port}/upstream/stats", procs[-1])
+    live = asyncio.run(send_live(f"http://127.0.0.1:{mw_port}/v1/messages", bodies))
+finally:
+    # stopping the middleware flushes the capture file
+    for proc in reversed(procs):
+        stop_process(proc)
+
+records = list(replay_capture.iter_capture([capture_path]))
+print("-" * 20)
+print("capture")
+check("every request recorded", len(records) == len(bodies), f"({len(records)} records)")
+check("live responses contain tool calls", all(tool_names(outcome) for outcome in live))
+check("records carry structured tool_calls", all(record["upstream"].get("tool_calls") for record in records))
+
+print("-" * 20)
+print("offline replay")
+mw = replay_capture.load_middleware(None)
+offline = asyncio.run(replay_capture.run_offline(mw, records))
+mismatched = [r["index"] for r in offline if r["outcome"] != live[r["index"]]]
+check("same outcomes as the live responses", not mismatched, f"(records {mismatched})" if mismatched else "")
+anonymized = asyncio.run(replay_capture.run_offline(mw, [mw.anonymize_capture(record) for record in records]))
+check("anonymized records keep the tool calls",
+      all(tool_names(r["outcome"]) == tool_names(live[r["index"]]) for r in anonymized))
+
+print("-" * 20)
+print("backend replay (fake_vllm.py --capture)")
+results_path = os.path.join(workdir, "backend.json")
+subprocess.run([sys.executable, os.path.join(HERE, "replay_capture.py"), capture_path, "--backend", "--out", results_path],
+               cwd=HERE, check=True, stdout=subprocess.DEVNULL)
+with open(results_path, encoding="utf-8") as f:
+    backend = json.load(f)["results"]
+mismatched = [r["index"] for r in backend if r["status"] != 200 or r["outcome"] != live[r["index"]]]
+check("same outcomes as the live responses", not mismatched, f"(records {mismatched})" if mismatched else "")
+
+sys.exit(1 if failures else 0)
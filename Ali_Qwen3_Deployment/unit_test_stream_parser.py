@@ -0,0 +1,83 @@
+# Test the streaming tool-call parser (StreamingToolCallParser) against the non-streaming parser in the middleware
+import json
+import sys
+
+import middleware_fix_qwen as mw
+
+STR = {"type": "string"}
+TOOLS = [
+    {"name": "Edit", "parameters": {"type": "object", "properties": {
+        "file_path": STR, "old_string": STR, "new_string": STR, "replace_all": {"type": "boolean"}}}},
+    {"name": "Bash", "parameters": {"type": "object", "properties": {
+        "command": STR, "description": STR, "timeout": {"type": "number"}, "run_in_background": {"type": "boolean"}}}},
+]
+RULES = mw.resolve_tool_arg_rules(TOOLS)
+failures = 0
+
+
+def check(name, ok, detail=""):
+    global failures
+    print(f"  {'✅' if ok else '❌'} {name} {detail}")
+    failures += not ok
+
+
+def tool_call(name, arguments):
+    return f"<tool_call>\n{json.dumps({'name': name, 'arguments': arguments})}\n</tool_call>"
+
+
+def stream(content, size):
+    """按 size 个字符一块输入，返回 (工具参数对象, 第一个 tool_start 出现在第几块, 块数, 参数是否有重复键)"""
+    parser = mw.StreamingToolCallParser(RULES)
+    events, first_start = [], None
+    chunks = [content[i:i + size] for i in range(0, len(content), size)]
+    for n, chunk in enumerate(chunks):
+        events += parser.feed(chunk)
+        if first_start is None and any(e[0] == "tool_start" for e in events):
+            first_start = n
+    events += parser.finish()
+    duplicates = []
+
+    def no_duplicates(pairs):
+        if len({key for key, _ in pairs}) != len(pairs):
+            duplicates.append(pairs)
+        return dict(pairs)
+
+    args = json.loads("".join(e[1] for e in events if e[0] == "tool_delta"), object_pairs_hook=no_duplicates)
+    return args, first_start, len(chunks), bool(duplicates)
+
+
+def expected(content):
+    return mw.parse_hermes_xml(content, RULES)[0]["function"]["arguments"]
+
+
+print("=== Running Streaming Parser Tests ===")
+print("-" * 20)
+print("large Edit with a boolean field streams incrementally")
+edit = tool_call("Edit", {"file_path": "/app/main.py", "old_string": "x = 1\n" * 400, "new_string": "x = 2\n" * 400, "replace_all": "true"})
+check("schema coercions do not force buffering", mw.get_streaming_fixes("Edit", RULES) is not None)
+args, first_start, chunks, _ = stream(edit, 20)
+check("tool_start before the closing tag", first_start is not None and first_start < chunks // 10, f"(chunk {first_start} of {chunks})")
+check("replace_all coerced to a boolean", args.get("replace_all") is True, f"(got {args.get('replace_all')!r})")
+check("same arguments as the non-streaming parser", args == expected(edit))
+
+for label, name, arguments in (
+    ("Bash with numeric and boolean strings", "Bash", {"command": "sleep 1", "timeout": "5000", "run_in_background": "False"}),
+    ("Bash with a value that cannot be coerced", "Bash", {"command": "ls", "timeout": "soon", "run_in_background": False}),
+    ("Bash with an alias and its canonical key", "Bash", {"cmd": "ls", "timeout": "1.5", "command": "pwd"}),
+    ("Edit with two aliases of the same key", "Edit", {"filename": "/a", "path": "/b", "old_string": "x", "new_string": "y"}),
+    ("Edit with an escaped string value", "Edit", {"file_path": "/a", "old_string": "\"q\"\n", "new_string": "", "replace_all": " TRUE "}),
+):
+    print("-" * 20)
+    print(label)
+    content = tool_call(name, arguments)
+    want = expected(content)
+    bad = [size for size in (1, 3, 7, 20, len(content)) if stream(content, size)[0] != want or stream(content, size)[3]]
+    check("same arguments as the non-streaming parser at every chunk size", not bad, f"(chunk sizes {bad})" if bad else f"{want}")
+
+print("-" * 20)
+print("Edit truncated inside a coerced value")
+truncated = edit[:edit.index('"true"') + 4]
+args, _, _, _ = stream(truncated, 20)
+check("arguments are closed into valid JSON", args.get("replace_all") == "tru", f"(got {args.get('replace_all')!r})")
+
+sys.exit(1 if failures else 0)